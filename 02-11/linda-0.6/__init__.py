@@ -24,3 +24,5 @@
 
 import linda.kernel as kernel
 from linda.kernel import connect, disconnect, universe, uts, TupleSpace, NotConnected, getStatsTS
+from linda.kernel import TupleSpaceFull, NotDurable, block_when_full, fail_when_full, evict_when_full
+from linda.template import Range, OneOf, Prefix, Predicate
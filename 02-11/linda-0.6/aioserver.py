@@ -0,0 +1,346 @@
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+## \namespace aioserver
+## \brief This module contains a server that handles all its connections on a single asyncio event loop
+## \internal
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+
+import asyncio
+import concurrent.futures
+import os
+import socket
+import threading
+import traceback
+
+from .messages import *
+
+from .connections import connections
+from . import codec
+from . import durability
+from . import framing
+from . import server
+from . import spill
+from . import utils
+
+## The messages that are handled on the event loop itself, as long as they don't need to wait for the disk or another
+## server. Everything else is handled by a thread in the server's pool.
+##
+## decrement_ref isn't among them. Its handler takes the tuplespace's killlock, which is held until the previous
+## reference dropped has been dealt with, and dropping the last reference deletes the tuplespace, whose tuples may
+## hold references of their own that are dropped with messages to this server. If the loop waited for the killlock
+## those messages would never be answered.
+inline_messages = set([register_process, register_thread, register_waiter, unregister_thread, create_tuplespace,
+                       get_node_id, get_neighbours, read_tuple, in_tuple, out_tuple, rd_many, in_many, out_many,
+                       increment_ref])
+
+## \class Request
+## \internal
+## \brief Stands in for the socket that a threaded connection handler is given, so the handlers in
+## server.LindaConnection can be used unchanged.
+##
+## Anything sent is written to the connection's transport. Tuples for blocked processes are sent by the delivery
+## pipeline's threads, so writes from other threads are passed to the event loop rather than made directly.
+class Request(codec.Framed):
+    def __init__(self, transport, server):
+        codec.Framed.__init__(self, None, codec.accept_pickle)
+        self.transport = transport
+        self.server = server
+
+    def sendall(self, data, flags=0):
+        if self.transport.is_closing():
+            return # we'll find out the connection has gone when the transport tells the protocol
+        if threading.get_ident() == self.server.thread:
+            self.transport.write(data)
+        else:
+            self.server.loop.call_soon_threadsafe(self.transport.write, data)
+
+    def write(self, data, flags=0):
+        if self.transport.is_closing():
+            return
+        frame = (framing.header.pack(len(data)), data)
+        if threading.get_ident() == self.server.thread:
+            self.transport.writelines(frame)
+        else:
+            self.server.loop.call_soon_threadsafe(self.transport.writelines, frame)
+
+    def writeMany(self, messages, flags=0):
+        if self.transport.is_closing():
+            return
+        frames = []
+        for data in messages:
+            frames.append(framing.header.pack(len(data)))
+            frames.append(data)
+        if threading.get_ident() == self.server.thread:
+            self.transport.writelines(frames)
+        else:
+            self.server.loop.call_soon_threadsafe(self.transport.writelines, frames)
+
+    def getsockname(self):
+        return self.transport.get_extra_info("sockname")
+
+    def setblocking(self, flag):
+        pass
+
+    def shutdown(self, how):
+        self.close()
+
+    def close(self):
+        if threading.get_ident() == self.server.thread:
+            self.transport.close()
+        else:
+            self.server.loop.call_soon_threadsafe(self.transport.close)
+
+## \class AsyncLindaConnection
+## \internal
+## \brief Handles one connection to the server as an asyncio protocol.
+##
+## The messages are the same as those handled by server.LindaConnection, and are handled by the same methods, but no
+## thread waits for the connection. Bytes are gathered as they arrive and each complete message is handled in turn.
+## Messages that could wait, on the disk, another server or space in a full tuplespace, are handed to the server's
+## thread pool and the connection reads nothing more until the reply has been sent, so the messages from one
+## connection are still handled in the order they were sent.
+##
+## A process blocked on a rd or in costs nothing but its entry in server.blocked_processes. When a matching tuple is
+## output the delivery pipeline sends it to the process through the connection's Request, just as it would write it to
+## the socket of a threaded connection.
+##
+## A connection from another server is handed to a thread of its own, as links between servers are few, long lived and
+## read by connections.Connection.
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+class AsyncLindaConnection(server.LindaConnection, asyncio.Protocol):
+    def __init__(self, server):
+        self.server = server
+        self.buffer = bytearray()
+        self.session = False # true once the other end has begun the session
+        self.busy = False # true while a message is being handled by the thread pool
+        self.handed_off = False # true once the connection has been given to a threaded handler
+        self.setup()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.request = Request(transport, self.server)
+        if transport.get_extra_info("socket") is not None:
+            framing.configure(transport.get_extra_info("socket"))
+        self.client_address = transport.get_extra_info("peername")
+
+        # check that the connection comes from an allowed source
+        if self.server.allowed_peers and not isinstance(self.client_address, str) and not self.allowed():
+            print("DENIED ACCESS FROM", self.client_address)
+            transport.close()
+
+    def data_received(self, data):
+        self.buffer += data
+        self.process()
+
+    def connection_lost(self, exc):
+        if not self.handed_off:
+            self.finish()
+
+    ## \brief Handle each complete message that has arrived, unless we're waiting for the thread pool
+    def process(self):
+        start = 0 # where the next message starts in the buffer
+        try:
+            while not self.busy and not self.transport.is_closing():
+                if len(self.buffer) - start < framing.header.size:
+                    return
+                size = framing.header.unpack_from(self.buffer, start)[0]
+                end = start + framing.header.size + size
+                if len(self.buffer) < end:
+                    return
+                try:
+                    message = self.request.decode(self.buffer[start + framing.header.size:end])
+                    start = end
+
+                    msgid = None
+                    if self.pipelined:
+                        msgid, message = message
+
+                    # encoded messages hold the message itself, pickled ones pickle it a second time
+                    m = message if type(message) is tuple else self.request.decode(message)
+                except codec.CodecError as e:
+                    print("REFUSED MESSAGE FROM", self.client_address, e)
+                    self.transport.close()
+                    return
+                if not self.session:
+                    self.beginSession(m)
+                elif m[0] == close_connection:
+                    utils.send(self.request, None, msgid, done)
+                    self.transport.close()
+                elif m[0] == get_new_node_id or (m[0] == my_name_is and utils.isNodeId(m[1]) and m[1] != server.node_id):
+                    self.handOff(m)
+                elif self.mayBlock(m[0], m[1:]):
+                    self.busy = True
+                    f = self.server.loop.run_in_executor(self.server.pool, self.handle_msg, msgid, m[0], m[1:])
+                    f.add_done_callback(self.handled)
+                else:
+                    self.handle_msg(msgid, m[0], m[1:])
+        finally:
+            # the messages that have been handled are removed from the buffer together, not one at a time
+            del self.buffer[:start]
+
+    ## \brief Called on the event loop once the thread pool has handled a message
+    def handled(self, f):
+        self.busy = False
+        if f.exception() is not None:
+            # the exception would have ended a threaded connection, so it ends this one too
+            traceback.print_exception(type(f.exception()), f.exception(), f.exception().__traceback__)
+            self.transport.close()
+            return
+        self.process()
+
+    ## \brief Wait for the other end to begin the session
+    def beginSession(self, m):
+        if m[0] == begin_session:
+            if len(m) > 2 and codec.negotiate(m[2]) is not None:
+                self.request.use(codec.negotiate(m[2]))
+            if len(m) > 1 and m[1]:
+                self.pipelined = True
+                utils.send(self.request, None, None, pipelined)
+            else:
+                utils.send(self.request, None, None, done)
+            self.session = True
+            self.key = id(self)
+            connections[self.key] = self.request
+        else:
+            print("Unknown Session Setup Message: %s" % (m[0], ))
+            utils.send(self.request, None, None, dont_know)
+
+    ## \brief Returns true if the message may have to wait, and so must be handled by the thread pool
+    def mayBlock(self, message, data):
+        if message not in inline_messages:
+            return True
+        if durability.log is not None or spill.manager.budget is not None:
+            return True # looking at a tuplespace may read it from the disk
+
+        if message in (read_tuple, in_tuple, rd_many, in_many):
+            # taking a tuple that holds tuplespace references counts them with a message to this server
+            return data[0] in server.local_ts and server.local_ts[data[0]].holds_references
+        if message in (out_tuple, out_many, increment_ref):
+            if data[0] not in server.local_ts: # the message will be forwarded and we must wait for the reply
+                return True
+            if message in (out_tuple, out_many):
+                if holdsReferences(data[1]):
+                    return True # each reference is counted with a message to this server, which waits for the reply
+                ts = server.local_ts[data[0]]
+                return ts.bounded and ts.when_full == block_when_full
+        return False
+
+    ## \brief Give the connection to a thread running the threaded connection handler, which handles m first
+    def handOff(self, m):
+        self.handed_off = True
+        self.transport.pause_reading()
+
+        # the transport closes its own socket, so the thread is given a copy
+        sock = socket.socket(fileno=os.dup(self.transport.get_extra_info("socket").fileno()))
+        sock.setblocking(True)
+        self.transport.close()
+        if self.key is not None:
+            del connections[self.key]
+
+        t = threading.Thread(target=HandedOffConnection, args=(sock, self.client_address, self.server, m))
+        t.daemon = True
+        t.start()
+
+## \brief Returns true if the tuple, or tuples, in an out_tuple or out_many message may hold tuplespace references
+def holdsReferences(tups):
+    if type(tups) is bytes: # pickled, where a reference names its class
+        return b"TupleSpace" in tups
+    found = []
+    utils.containsTS(tups, found.append)
+    return len(found) > 0
+
+## \class HandedOffConnection
+## \internal
+## \brief The threaded handler for a connection from another server that was accepted by the event loop.
+##
+## The session has already begun, so instead the handler starts with the message that showed us the other end was a
+## server.
+class HandedOffConnection(server.LindaConnection):
+    def __init__(self, request, client_address, linda_server, first):
+        self.first = first
+        server.LindaConnection.__init__(self, request, client_address, linda_server)
+
+    def allowed(self):
+        return True # it was checked when the connection was made
+
+    def beginSession(self):
+        self.handle_msg(None, self.first[0], self.first[1:])
+
+## \class AsyncLindaServer
+## \internal
+## \brief A server that accepts connections on TCP and, if given an address, a Unix domain socket, and handles them all
+## on a single asyncio event loop.
+##
+## Like server.LindaServer it stops once close is set to true, checking once a second.
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+class AsyncLindaServer:
+    def __init__(self, address, handler=AsyncLindaConnection, allowed_peers=[], domain_address=None, workers=64):
+        self.address = address
+        self.handler = handler
+        self.allowed_peers = allowed_peers
+        self.domain_address = domain_address
+        self.close = False
+
+        self.loop = asyncio.new_event_loop()
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="aioserver")
+        self.thread = None # the id of the thread running the event loop
+
+        # like socketserver.TCPServer we listen as soon as we're created, so connections can be made before
+        # serve_forever is called
+        self.listeners = self.loop.run_until_complete(self.listen())
+
+    def serve_forever(self):
+        self.thread = threading.get_ident()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.thread = None
+
+    async def listen(self):
+        listeners = [await self.loop.create_server(lambda: self.handler(self), self.address[0] or None,
+                                                   self.address[1], reuse_address=True)]
+        if self.domain_address is not None:
+            if os.path.exists(self.domain_address):
+                os.unlink(self.domain_address)
+            listeners.append(await self.loop.create_unix_server(lambda: self.handler(self), self.domain_address))
+        return listeners
+
+    async def serve(self):
+        try:
+            while not self.close:
+                await asyncio.sleep(1.0)
+        finally:
+            if self.close:
+                for listener in self.listeners:
+                    listener.close()
+                if self.domain_address is not None and os.path.exists(self.domain_address):
+                    os.unlink(self.domain_address)
+
+    ## \brief Handle a connection made by this server to another server, in a thread of its own
+    def process_request(self, request, client_address):
+        t = threading.Thread(target=server.LindaConnection, args=(request, client_address, self))
+        t.daemon = True
+        t.start()
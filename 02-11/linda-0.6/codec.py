@@ -0,0 +1,328 @@
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+## \namespace codec
+## \brief This module contains the binary encoding used for messages between client processes and servers
+## \internal
+##
+## An encoded value starts with a two byte header, a marker byte that can't begin a pickle followed by the version of
+## the encoding, so a decoder can tell an encoded value from a pickled one. Then comes the value itself, as a one byte
+## tag giving its type followed by its contents:
+##
+## \li None, True and False are just the tag.
+## \li Integers are 8 bytes, or a 4 byte length followed by the bytes of a larger integer. Floats are 8 bytes.
+## \li Strings and bytes are a 4 byte length followed by the (UTF-8) bytes. A string that is the name of a message,
+## such as "out_tuple" or "done", is sent as a one byte opcode instead.
+## \li Tuples and lists are a 4 byte count followed by their elements, and dictionaries a count followed by the keys
+## and values in turn.
+## \li Classes used as formal template elements are a one byte index into a table of the classes we know.
+## \li References to tuplespaces are the tuplespace's id. Constraints such as Range are a one byte index into a table
+## of the constraint classes, followed by the tuple of arguments they were created with.
+## \li Anything else is pickled, with a 4 byte length. Servers started with --no-pickle refuse these, so nothing
+## a client sends them can run code when it is decoded.
+##
+## Clients offer the version they speak in begin_session, and a server that speaks it replies in the same encoding.
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+
+import pickle
+import struct
+
+from .messages import *
+from . import framing
+from . import template
+
+## The first byte of an encoded value. Pickles start with a PROTO opcode, 0x80, or an ASCII opcode.
+marker = 0xfe
+## The version of the encoding written by encode
+version = 1
+
+## How deeply tuples, lists, dictionaries and constraints may be nested in a value that is decoded. Each level is a
+## call of _decode, so without a limit a small message could exhaust the stack.
+max_depth = 64
+
+## Whether decode should accept pickled values, either whole or inside an encoded value. The server turns this off
+## with --no-pickle.
+accept_pickle = True
+
+class CodecError(Exception):
+    """\internal
+    \brief Raised when a value can't be decoded, either because it is malformed or because it is pickled and pickled
+    values aren't accepted
+    """
+    pass
+
+(NONE, TRUE, FALSE, INT, BIGINT, FLOAT, STR, BYTES, TUPLE, LIST, DICT, OPCODE, CLASS, TUPLESPACE, CONSTRAINT,
+ PICKLE) = range(16)
+
+_header = struct.Struct("!BB")
+_length = struct.Struct("!I")
+_int = struct.Struct("!q")
+_float = struct.Struct("!d")
+# a tag followed by a length, integer or float, so both are packed at once
+_tag_length = struct.Struct("!BI")
+_tag_int = struct.Struct("!Bq")
+_tag_float = struct.Struct("!Bd")
+
+## The messages that are sent as opcodes. New messages must be added to the end, as the position of a message in this
+## list is its opcode.
+opcodes = [done, dont_know, register_process, register_thread, register_waiter, unregister_thread, unregister_process,
+           my_name_is, create_tuplespace, get_connect_details, get_new_node_id, get_node_id, read_tuple, in_tuple,
+           out_tuple, out_many, rd_many, in_many, tuplespace_full, unblock, return_tuple, return_tuples, collect,
+           copy_collect, multiple_in, increment_ref, decrement_ref, get_references, get_reference_graph,
+           get_neighbours, know_server, get_blocked_list, get_graph, get_threads, get_stats, block_when_full,
+           fail_when_full, evict_when_full, not_permitted, kill_server, support_domain, support_shm, begin_session,
+           pipelined, yes, no, close_connection, not_durable]
+_opcode = dict([(m, bytes((OPCODE, i))) for i, m in enumerate(opcodes)])
+
+## The classes that can be sent as formal template elements. The tuplespace class is added once the kernel has been
+## imported.
+classes = [int, float, str, bytes, bool, complex, tuple, list, dict, type(None)]
+_class = dict([(c, bytes((CLASS, i))) for i, c in enumerate(classes)])
+
+## The constraint classes, in the order of their index
+constraints = [template.Range, template.OneOf, template.Prefix, template.Predicate]
+_constraint = dict([(c, bytes((CONSTRAINT, i))) for i, c in enumerate(constraints)])
+
+## Functions that convert instances of other classes into something we can encode, indexed by class
+converters = {}
+
+## \brief Register a function that converts instances of the given class into a value that can be encoded
+def register(cls, func):
+    converters[cls] = func
+
+_prefix = _header.pack(marker, version)
+_none = bytes((NONE, ))
+_true = bytes((TRUE, ))
+_false = bytes((FALSE, ))
+
+## \brief Returns the given value encoded
+def encode(value):
+    out = bytearray(_prefix)
+    _encode(value, out)
+    return bytes(out)
+
+def _encode(value, out):
+    t = value.__class__
+    if t is str:
+        op = _opcode.get(value)
+        if op is None:
+            value = value.encode("utf-8")
+            out += _tag_length.pack(STR, len(value))
+            out += value
+        else:
+            out += op
+    elif t is tuple or t is list:
+        out += _tag_length.pack(TUPLE if t is tuple else LIST, len(value))
+        for e in value:
+            _encode(e, out)
+    elif t is int:
+        if -0x8000000000000000 <= value <= 0x7fffffffffffffff:
+            out += _tag_int.pack(INT, value)
+        else:
+            value = value.to_bytes((value.bit_length() + 8) // 8, "big", signed=True)
+            out += _tag_length.pack(BIGINT, len(value))
+            out += value
+    elif t is bytes:
+        out += _tag_length.pack(BYTES, len(value))
+        out += value
+    elif value is None:
+        out += _none
+    elif value is True:
+        out += _true
+    elif value is False:
+        out += _false
+    elif t is float:
+        out += _tag_float.pack(FLOAT, value)
+    elif t is dict:
+        out += _tag_length.pack(DICT, len(value))
+        for k, v in value.items():
+            _encode(k, out)
+            _encode(v, out)
+    elif t is type and value in _class:
+        out += _class[value]
+    elif t is kernel.TupleSpace:
+        ts = value._id.encode("utf-8")
+        out += _tag_length.pack(TUPLESPACE, len(ts))
+        out += ts
+    elif t in _constraint:
+        out += _constraint[t]
+        _encode(value._key(), out)
+    elif t in converters:
+        _encode(converters[t](value), out)
+    else:
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        out += _tag_length.pack(PICKLE, len(value))
+        out += value
+
+## \brief Returns the value in the given data, which may be encoded or pickled
+## \param allow_pickle If False a CodecError is raised rather than unpickling anything
+def decode(data, allow_pickle=True):
+    if len(data) == 0 or data[0] != marker:
+        if not allow_pickle:
+            raise CodecError("pickled messages are not accepted")
+        return pickle.loads(data)
+
+    if len(data) < 2 or data[1] != version:
+        raise CodecError("unknown encoding version %r" % (data[1:2], ))
+    try:
+        value, pos = _decode(data, 2, allow_pickle, 0)
+    except (IndexError, KeyError, ValueError, TypeError, struct.error, UnicodeDecodeError, RecursionError) as e:
+        raise CodecError("malformed message: %s" % (e, ))
+    if pos != len(data):
+        raise CodecError("%i bytes left over after the message" % (len(data) - pos, ))
+    return value
+
+def _decode(data, pos, allow_pickle, depth):
+    tag = data[pos]
+    pos += 1
+    if tag in (TUPLE, LIST, DICT, CONSTRAINT):
+        depth += 1
+        if depth > max_depth:
+            raise CodecError("values are nested more than %i deep" % (max_depth, ))
+    if tag == TUPLE or tag == LIST:
+        n = _length.unpack_from(data, pos)[0]
+        pos += 4
+        r = []
+        append = r.append
+        for i in range(n):
+            # strings, opcodes and integers are decoded here, to save a call for each of them
+            t = data[pos]
+            if t == OPCODE:
+                append(opcodes[data[pos + 1]])
+                pos += 2
+            elif t == STR:
+                size = _length.unpack_from(data, pos + 1)[0]
+                pos += 5
+                if pos + size > len(data):
+                    raise ValueError("string runs past the end of the message")
+                append(data[pos:pos + size].decode("utf-8"))
+                pos += size
+            elif t == INT:
+                append(_int.unpack_from(data, pos + 1)[0])
+                pos += 9
+            else:
+                e, pos = _decode(data, pos, allow_pickle, depth)
+                append(e)
+        if tag == TUPLE:
+            return tuple(r), pos
+        return r, pos
+    elif tag == OPCODE:
+        return opcodes[data[pos]], pos + 1
+    elif tag == STR:
+        return _bytes(data, pos).decode("utf-8"), pos + 4 + _length.unpack_from(data, pos)[0]
+    elif tag == INT:
+        return _int.unpack_from(data, pos)[0], pos + 8
+    elif tag == BYTES:
+        return _bytes(data, pos), pos + 4 + _length.unpack_from(data, pos)[0]
+    elif tag == NONE:
+        return None, pos
+    elif tag == TRUE:
+        return True, pos
+    elif tag == FALSE:
+        return False, pos
+    elif tag == FLOAT:
+        return _float.unpack_from(data, pos)[0], pos + 8
+    elif tag == BIGINT:
+        return int.from_bytes(_bytes(data, pos), "big", signed=True), pos + 4 + _length.unpack_from(data, pos)[0]
+    elif tag == DICT:
+        n = _length.unpack_from(data, pos)[0]
+        pos += 4
+        r = {}
+        for i in range(n):
+            k, pos = _decode(data, pos, allow_pickle, depth)
+            v, pos = _decode(data, pos, allow_pickle, depth)
+            r[k] = v
+        return r, pos
+    elif tag == CLASS:
+        return classes[data[pos]], pos + 1
+    elif tag == TUPLESPACE:
+        return _tuplespace(_bytes(data, pos).decode("utf-8")), pos + 4 + _length.unpack_from(data, pos)[0]
+    elif tag == CONSTRAINT:
+        cls = constraints[data[pos]]
+        args, pos = _decode(data, pos + 1, allow_pickle, depth)
+        if type(args) is not tuple:
+            raise ValueError("constraint arguments must be a tuple")
+        return cls(*args), pos
+    elif tag == PICKLE:
+        if not allow_pickle:
+            raise CodecError("pickled values are not accepted")
+        return pickle.loads(_bytes(data, pos)), pos + 4 + _length.unpack_from(data, pos)[0]
+    raise ValueError("unknown tag %i" % (tag, ))
+
+## \brief Returns the bytes at pos, which are preceded by their length
+def _bytes(data, pos):
+    size = _length.unpack_from(data, pos)[0]
+    pos += 4
+    if pos + size > len(data):
+        raise ValueError("value runs past the end of the message")
+    return bytes(data[pos:pos + size])
+
+## \brief Returns a reference to a tuplespace, as unpickling one would
+def _tuplespace(tsid):
+    ts = kernel.TupleSpace.__new__(kernel.TupleSpace)
+    ts.__setstate__([tsid])
+    return ts
+
+## \class Framed
+## \internal
+## \brief A socket, and how the messages sent and received on it are encoded.
+##
+## utils.send and utils.recv use the encode and decode of a framed socket. Messages are pickled until use is called,
+## once the other end has agreed in begin_session, but both encoded and pickled messages can always be received unless
+## allow_pickle is False.
+class Framed(framing.Framer):
+    def __init__(self, socket, allow_pickle=True):
+        framing.Framer.__init__(self, socket)
+        self.allow_pickle = allow_pickle
+        self.version = None # the version of the encoding we send, or None if we pickle
+        self.encode = pickle.dumps
+
+    ## \brief Start sending messages in the given version of the encoding
+    def use(self, v):
+        self.version = v
+        self.encode = encode
+
+    def decode(self, data):
+        return decode(data, self.allow_pickle)
+
+    def sendall(self, data, flags=0):
+        return self.socket.sendall(data, flags)
+    def recv(self, size):
+        return self.socket.recv(size)
+    def getsockname(self):
+        return self.socket.getsockname()
+    def setblocking(self, flag):
+        return self.socket.setblocking(flag)
+    def shutdown(self, how):
+        return self.socket.shutdown(how)
+    def close(self):
+        return self.socket.close()
+
+## \brief Choose the version of the encoding to use with the other end of a connection
+## \param offered The version the other end offered in begin_session
+## \return The version to use, or None to keep pickling
+def negotiate(offered):
+    if offered == version:
+        return version
+    return None
+
+from . import kernel
+_class[kernel.TupleSpace] = bytes((CLASS, len(classes)))
+classes.append(kernel.TupleSpace)
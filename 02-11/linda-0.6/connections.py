@@ -16,9 +16,11 @@
 #    along with PyLinda; if not, write to the Free Software
 #    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import collections
 import struct
 import _thread
 import threading
+import time
 import socket
 
 from .messages import *
@@ -27,78 +29,132 @@ neighbours = {}
 
 connections = {}
 
-msg_header_size = struct.calcsize("!Iiiii")
+## The header of a message between servers: the length of the rest of the message, the server it is for, and the
+## message's id, which is the server that sent the request, the server it was sent to and a number
+header = struct.Struct("!Iiiii")
+## The part of the header after the length, which framing::Framer leaves at the start of the message
+routing = struct.Struct("!iiii")
 
+## \class Reply
+## \internal
+## \brief The reply to a message sent to another server, once it has arrived.
+##
+## Only the thread that sent the message waits for the reply, so a lock that is held until the reply is set is all
+## that's needed, rather than a threading.Event.
+class Reply:
+    __slots__ = ("lock", "value", "pending", "lost", "sent")
+
+    def __init__(self):
+        self.lock = _thread.allocate_lock()
+        self.lock.acquire()
+        self.value = None
+        self.pending = True
+        self.lost = False # set if the connection closed before the reply arrived
+        self.sent = time.time()
+
+    def set(self, value):
+        self.value = value
+        self.pending = False
+        self.lock.release()
+
+    ## \brief Wake the thread waiting for a reply that will never arrive
+    def cancel(self):
+        self.lost = True
+        self.pending = False
+        self.lock.release()
+
+    def result(self):
+        self.lock.acquire()
+        return self.value
+
+## \class Connection
+## \internal
+## \brief A link to another server, shared by every thread that sends a message to it.
+##
+## A thread reads each message as it arrives. Requests from the other server are queued for the connection's handler,
+## server.LindaConnection, which takes them with recv. Replies are passed to the thread waiting for them, and messages
+## for other servers are passed on. A Reply is put in the replies table before a request is sent, so the reply can't
+## arrive before there's somewhere to put it.
+##
+## The connection counts how long requests wait in the queue before they're handled, and how long replies take to
+## arrive, see queueStats.
 class Connection:
     def __init__(self, socket):
-        def socket_watcher():
-            buf = ""
-            while True:
-                size = 0
-                r = ""
-                if buf == "":
-                    r = self.socket.recv(1024)
-                    if r == "":
-                        self.close()
-                        return
-                msg = buf + r
-                size = struct.unpack("!I", msg[:4])[0]
-                prevlen = len(msg)
-                while len(msg) < size:
-                    msg += self.socket.recv(size - len(msg))
-                    if len(msg) == prevlen:
-                        self.close()
-                        return
-                    prevlen = len(msg)
-                size, dest_id, src, dest, msgid = struct.unpack("!Iiiii", msg[:msg_header_size])
-                #print "recieved", size, dest_id, src, dest, msgid, repr(msg[msg_header_size:])
-                msgid = (src, dest, msgid)
-                msg, buf = msg[msg_header_size:size], msg[size:]
-                if dest_id != server.node_id:
-                    utils.send(getNeighbourDetails(dest_id), dest_id, msgid, decode(msg))
-                elif dest == server.node_id:
-                    self.store_lock.acquire()
-                    try:
-                        self.message_store.append((msgid, decode(msg)))
-                        #print "%i %i messages stored" % (len(self.message_store), len(self.return_message_store))
-                        self.recv_lock.set()
-                    finally:
-                        self.store_lock.release()
-                else:
-                    self.store_lock.acquire()
-                    try:
-                        self.return_message_store[msgid] = decode(msg)
-                        if msgid in self.blocked_store:
-                            self.blocked_store[msgid].set()
-                    finally:
-                        self.store_lock.release()
-
-        self.socket = socket
+        # a connection that was handled by server.LindaConnection before it was known to be from a server is already
+        # framed, and any bytes it has read beyond the last message are ours
+        if not isinstance(socket, framing.Framer):
+            socket = framing.Framer(socket)
+        self.framer = socket
+        self.socket = socket.socket
         self.send_lock = threading.Semaphore()
-        self.recv_lock = threading.Event()
-        self.store_lock = threading.Semaphore()
-        self.message_store = [] # this stores messages sent to us
-        self.return_message_store = {} # this stores return messages to message we sent
-        self.blocked_store = {} # this stores threads waiting for a message
+        self.lock = threading.Lock() # guards everything below
+        self.ready = threading.Condition(self.lock) # notified when a request is queued or the connection is closed
+        self.inbound = collections.deque() # (time queued, msgid, message) for each request waiting to be handled
+        self.replies = {} # msgid -> Reply, for each message sent that is waiting for its reply
         self.closed = False
 
-        thread = threading.Thread(target=socket_watcher)
-        _thread.setDaemon(True)
-        _thread.start()
+        self.max_queued = 0 # the longest the queue of requests has been
+        self.requests = 0 # the number of requests taken from the queue...
+        self.request_wait = 0.0 # ... and the total time they spent in it, in seconds
+        self.replied = 0 # the number of replies received...
+        self.reply_wait = 0.0 # ... and the total time spent waiting for them, in seconds
+
+        thread = threading.Thread(target=self.watch, name="pylinda-connection")
+        thread.daemon = True
+        thread.start()
+
+    ## \brief Read messages from the other server until the connection is closed
+    def watch(self):
+        while True:
+            try:
+                msg = self.framer.read()
+            except socket.error:
+                msg = None
+            if msg is None:
+                self.close()
+                return
+
+            dest_id, src, dest, n = routing.unpack_from(msg)
+            msgid = (src, dest, n)
+            msg = decode(msg[routing.size:])
+            if dest_id != server.node_id:
+                utils.send(getNeighbourDetails(dest_id), dest_id, msgid, msg)
+                continue
+
+            self.lock.acquire()
+            try:
+                if dest == server.node_id:
+                    self.inbound.append((time.time(), msgid, msg))
+                    if len(self.inbound) > self.max_queued:
+                        self.max_queued = len(self.inbound)
+                    self.ready.notify()
+                else:
+                    reply = self.replies.get(msgid)
+                    if reply is not None and reply.pending:
+                        reply.set(msg)
+            finally:
+                self.lock.release()
 
     def send(self, dest_node, msgid, msg):
         if self.closed:
             return None
         assert dest_node is not None or msgid is not None
         if msgid is None:
+            # a new request, whose reply we'll wait for
             msgid = (server.node_id, dest_node, getMsgId())
+            self.lock.acquire()
+            try:
+                if self.closed:
+                    return None
+                self.replies[msgid] = Reply()
+            finally:
+                self.lock.release()
         elif dest_node is None:
             dest_node = msgid[0] # we have a msgid so we're returning the message to the source
         msg = encode(msg)
         self.send_lock.acquire()
-        #print "sending", dest_node, msgid[0], msgid[1], msgid[2], repr(msg)
         try:
-            self.socket.sendall(struct.pack("!Iiiii", msg_header_size + len(msg), dest_node, msgid[0], msgid[1], msgid[2]) + msg)
+            framing.send(self.socket, header.pack(routing.size + len(msg), dest_node, msgid[0], msgid[1], msgid[2]), msg)
         finally:
             self.send_lock.release()
         return msgid
@@ -107,55 +163,72 @@ class Connection:
         if self.closed:
             return None, ""
         if msgid is None:
-            while True:
-                if self.closed:
-                    break
-                self.store_lock.acquire()
-                try:
-                    if len(self.message_store) > 0:
-                        r, self.message_store = self.message_store[0], self.message_store[1:]
-                        if len(self.message_store) == 0:
-                            self.recv_lock.clear()
-                        return r
-                finally:
-                     self.store_lock.release()
-                self.recv_lock.wait()
-            return None, ""
+            # wait for a request from the other server
+            self.lock.acquire()
+            try:
+                while len(self.inbound) == 0:
+                    if self.closed:
+                        return None, ""
+                    self.ready.wait()
+                queued, msgid, msg = self.inbound.popleft()
+                self.requests += 1
+                self.request_wait += time.time() - queued
+            finally:
+                self.lock.release()
+            return msgid, msg
         else:
-            self.store_lock.acquire()
-            if msgid in self.return_message_store:
-                try:
-                    return self.return_message_store[msgid]
-                finally:
-                    del self.return_message_store[msgid]
-                    self.store_lock.release()
-            else:
-                try:
-                     self.blocked_store[msgid] = threading.Event()
-                finally:
-                     self.store_lock.release()
-                self.blocked_store[msgid].wait()
-                del self.blocked_store[msgid]
-                self.store_lock.acquire()
-                try:
-                    return self.return_message_store[msgid]
-                finally:
-                    del self.return_message_store[msgid]
-                    self.store_lock.release()
+            # wait for the reply to a message we sent
+            self.lock.acquire()
+            try:
+                reply = self.replies.get(msgid)
+            finally:
+                self.lock.release()
+            if reply is None: # the message wasn't sent as the connection is closed
+                return None, ""
+            r = reply.result()
+            self.lock.acquire()
+            try:
+                self.replies.pop(msgid, None) # gone already if the connection was closed
+                if not reply.lost:
+                    self.replied += 1
+                    self.reply_wait += time.time() - reply.sent
+            finally:
+                self.lock.release()
+            if reply.lost:
+                return None, ""
+            return r
+
+    ## \brief Returns the number of requests waiting to be handled and the most there have been, the number of replies
+    ## being waited for, and how long, in microseconds, requests have waited to be handled and replies to arrive
+    def queueStats(self):
+        self.lock.acquire()
+        try:
+            return {"queued": len(self.inbound), "max_queued": self.max_queued,
+                    "requests": self.requests, "request_wait_us": int(self.request_wait * 1e6),
+                    "awaiting_reply": len(self.replies),
+                    "replies": self.replied, "reply_wait_us": int(self.reply_wait * 1e6)}
+        finally:
+            self.lock.release()
 
     def setblocking(self, value):
         self.socket.setblocking(value)
     def getsockname(self):
         return self.socket.getsockname()
-        
+
     def shutdown(self, i):
         self.socket.shutdown(i)
     def close(self):
-        self.closed = True
+        self.lock.acquire()
+        try:
+            self.closed = True
+            for reply in self.replies.values():
+                if reply.pending:
+                    reply.cancel()
+            self.replies.clear()
+            self.ready.notify_all()
+        finally:
+            self.lock.release()
         self.socket.close()
-        self.recv_lock.set()
-        for e in list(self.blocked_store.values()):
-            e.set()
 
 def getNeighbourDetails(node):
     if node not in neighbours:
@@ -270,6 +343,7 @@ def broadcast_firstreplyonly(*args):
 
     return dont_know
 
+from . import framing
 from . import utils
 from .utils import encode, decode
 getMsgId = utils.Counter()
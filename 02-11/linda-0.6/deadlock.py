@@ -0,0 +1,141 @@
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+## \namespace deadlock
+## \brief This module contains the background deadlock detector
+## \internal
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+
+import threading
+import time
+import traceback
+
+from .messages import get_graph, get_threads
+
+from . import kernel
+from . import utils
+
+## \class DeadlockDetector
+## \internal
+## \brief Checks tuplespaces for deadlocks in a background thread.
+##
+## A deadlock can only appear when a process blocks or a reference to a tuplespace is removed, so rather than
+## searching for a deadlock there and then the tuplespace just tells the detector it has changed. Every interval
+## seconds the detector checks each tuplespace that has changed since the last check, and if it is deadlocked
+## unblocks one of its processes.
+##
+## Every change to a tuplespace's references or blocked processes gives it a new epoch number. The detector keeps
+## the references and blocked processes it last saw for each tuplespace along with their epoch, and only fetches them
+## again if the epoch has changed. Other servers are sent the epoch we have, and only reply with the full details if
+## theirs is different.
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+class DeadlockDetector:
+    def __init__(self, interval=1.0):
+        self.interval = interval
+
+        self.lock = threading.Semaphore()
+        self.started = False
+        self.dirty = {} # tuplespace id -> TupleSpace, for those that have changed since the last check
+
+        self.graphs = {} # tuplespace id -> (epoch, references, blocked threads)
+        self.threads = {} # process id -> threads, only kept for one check as we have no epoch for processes
+
+    ## \brief Record that the references or blocked processes of a tuplespace have changed
+    def changed(self, ts):
+        self.lock.acquire()
+        try:
+            self.dirty[ts._id] = ts
+            if not self.started:
+                t = threading.Thread(target=self.run, name="deadlock-detector")
+                t.daemon = True
+                t.start()
+                self.started = True
+        finally:
+            self.lock.release()
+
+    ## \brief Throw away what we know about a tuplespace that has been deleted
+    def forget(self, ts_id):
+        self.lock.acquire()
+        try:
+            self.dirty.pop(ts_id, None)
+            self.graphs.pop(ts_id, None)
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except:
+                # an error checking one tuplespace must not stop us checking in future
+                traceback.print_exc()
+
+    ## \brief Check each tuplespace that has changed since the last check, unblocking a process in any that are
+    ## deadlocked
+    def check(self):
+        self.lock.acquire()
+        try:
+            dirty, self.dirty = self.dirty, {}
+        finally:
+            self.lock.release()
+
+        self.threads = {}
+        for ts in dirty.values():
+            if ts.ts is None or len(ts.blocked_list) == 0: # garbage, or nothing is blocked so it can't be deadlocked
+                continue
+            if ts.isDeadLocked():
+                ts.unblockRandom()
+
+    ## \brief Returns the epoch, references and blocked threads of a tuplespace
+    def getGraph(self, ts_id):
+        from . import server
+
+        cached = self.graphs.get(ts_id)
+
+        try:
+            ts = server.local_ts[ts_id]
+        except KeyError:
+            graph = utils.decode(kernel.message(get_graph, ts_id, cached and cached[0]))
+            if graph[0] is None: # the tuplespace no longer exists
+                self.graphs.pop(ts_id, None)
+                return graph
+            elif graph[1] is None: # the tuplespace hasn't changed since we last asked
+                return cached
+        else:
+            if cached is not None and cached[0] == ts.epoch:
+                return cached
+            graph = ts.getGraph()
+
+        self.graphs[ts_id] = graph
+        return graph
+
+    ## \brief Returns the threads of a process
+    def getThreads(self, pid):
+        try:
+            return self.threads[pid]
+        except KeyError:
+            threads = self.threads[pid] = utils.decode(kernel.message(get_threads, pid))
+            return threads
+
+## The detector for the tuplespaces on this server
+detector = DeadlockDetector()
@@ -0,0 +1,171 @@
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+## \namespace delivery
+## \brief This module delivers tuples to processes that were blocked waiting for them
+## \internal
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+
+import queue
+import threading
+import time
+import traceback
+
+from .messages import return_tuples
+
+from . import stats
+from . import utils
+
+## \class DeliveryPipeline
+## \internal
+## \brief A bounded queue of tuples waiting to be returned to blocked processes, and a small pool of threads that
+## sends them.
+##
+## When a tuple is output that wakes blocked processes the tuplespace just queues the tuple for each of them, rather
+## than starting a thread per process. The workers take the waiting tuples off the queue in batches. The tuples for
+## processes connected to this server are grouped by connection, so a client with many processes waiting on one
+## pipelined connection is sent all of its tuples at once, and the tuples for processes on other servers are grouped
+## so each server is sent a single return_tuples message for the whole batch. A tuple that can't be delivered is
+## reported, and doesn't stop the rest of the batch being delivered.
+##
+## If the queue is full then the tuplespace waits for space, which slows down processes that are outputting tuples
+## faster than they can be delivered. Tuples are only queued once the tuplespace's locks have been released, so
+## other processes can carry on using it while it waits.
+##
+## The depth of the queue and the time tuples spend waiting in it are recorded in the server statistics.
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+class DeliveryPipeline:
+    def __init__(self, workers=4, size=4096, batch_size=64):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.queue = queue.Queue(size)
+
+        self.lock = threading.Semaphore()
+        self.started = False
+
+        self.delivered = 0
+        self.latency = 0.0 # total time, in seconds, that the delivered tuples spent in the queue
+
+    ## \brief Queue a tuple to be returned to a blocked process
+    ## \param tid The thread id of the blocked process
+    ## \param tup The tuple to return
+    def put(self, tid, tup):
+        if not self.started:
+            self.start()
+
+        self.queue.put((tid, tup, time.time()))
+
+        depth = self.queue.qsize()
+        stats.set_stat("delivery_queue_depth", depth)
+        if depth > stats.getstat("delivery_queue_peak"):
+            stats.set_stat("delivery_queue_peak", depth)
+
+    ## \brief Start the worker threads, if they haven't been started already
+    def start(self):
+        self.lock.acquire()
+        try:
+            if self.started:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self.run, name="delivery-%i" % (i, ))
+                t.daemon = True
+                t.start()
+            self.started = True
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while True:
+            # wait for a tuple to deliver, then take any others that are waiting up to the batch size
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            stats.set_stat("delivery_queue_depth", self.queue.qsize())
+
+            try:
+                self.deliver(batch)
+            except:
+                # a failed delivery must not kill the worker, or the tuples behind it would never be delivered
+                traceback.print_exc()
+
+    ## \brief Send a batch of tuples to the processes waiting for them
+    ## \param batch A list of (thread id, tuple, time queued) tuples
+    def deliver(self, batch):
+        from . import server
+        from .connections import sendMessageToNode
+
+        local = {} # id of connection -> (connection, semaphore, list of encoded replies)
+        remote = {} # node id -> list of (thread id, pickled tuple)
+        for tid, tup, queued in batch:
+            try:
+                # the process now holds any tuplespaces in the tuple, so update their references
+                utils.containsTS(tup, lambda x: x._addreference(utils.getProcessIdFromThreadId(tid)))
+
+                waiter = server.takeBlocked(tid)
+                if waiter is None:
+                    remote.setdefault(utils.getNodeFromThreadId(tid), []).append((tid, utils.encode(tup)))
+                else:
+                    s, semaphore, msgid = waiter
+                    local.setdefault(id(s), (s, semaphore, []))[2].append(utils.frame(s, msgid, utils.pack(s, tup)))
+            except:
+                print("Unable to return tuple to %s" % (tid, ))
+                traceback.print_exc()
+
+        for s, semaphore, frames in local.values():
+            semaphore.acquire()
+            try:
+                utils.sendMany(s, frames)
+            except:
+                print("Unable to return %i tuples to a connection" % (len(frames), ))
+                traceback.print_exc()
+            finally:
+                semaphore.release()
+
+        for node, tuples in remote.items():
+            if node == server.node_id:
+                print("Unable to return tuple to %s, it is not blocked" % (", ".join([t[0] for t in tuples]), ))
+                continue
+            try:
+                sendMessageToNode(node, None, return_tuples, tuples)
+            except:
+                print("Unable to return tuples to %s" % (", ".join([t[0] for t in tuples]), ))
+                traceback.print_exc()
+
+        now = time.time()
+        self.lock.acquire()
+        try:
+            for tid, tup, queued in batch:
+                latency = now - queued
+                self.latency += latency
+                if latency * 1e6 > stats.getstat("delivery_latency_max_us"):
+                    stats.set_stat("delivery_latency_max_us", int(latency * 1e6))
+            self.delivered += len(batch)
+            stats.set_stat("delivery_total", self.delivered)
+            stats.set_stat("delivery_latency_avg_us", int(self.latency / self.delivered * 1e6))
+        finally:
+            self.lock.release()
+
+## The pipeline shared by all the tuplespaces on this server
+pipeline = DeliveryPipeline()
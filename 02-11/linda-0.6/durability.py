@@ -0,0 +1,488 @@
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+## \namespace durability
+## \brief This module keeps the tuplespaces on disk, so they survive the server being restarted
+## \internal
+##
+## Every change to a tuplespace is appended to an operation log, and every so often a snapshot of all the tuplespaces
+## is written so the old logs can be thrown away. When the server starts it loads the snapshot and replays the logs
+## written since.
+##
+## The log is a series of log.NNNNNNNN files in the durability directory, each holding records made up of a four byte
+## length followed by a pickled (sequence number, operation, tuplespace id, ...) tuple. The operations are
+##  - ("create", ts, capacity) when a tuplespace is created,
+##  - ("drop", ts) when it is deleted or emptied by the garbage collector,
+##  - ("out", ts, tuple, deadline) when a tuple is stored, with the time its lease expires or None,
+##  - ("take", ts, tuple) when a tuple is removed, for whatever reason.
+##
+## The snapshot file starts with a header giving the position and length of its index. Before the index are the
+## tuples of each tuplespace, pickled as one list of (tuple, deadline) pairs per tuplespace. The index is a pickled
+## dictionary holding the number of the first log that must be replayed and a list of (ts, capacity, sequence number,
+## offset, length, references) tuples, one for each tuplespace. The sequence number is that of the last log record
+## included in the snapshot of that tuplespace, and references lists the tuplespaces its tuples refer to. The file is
+## memory mapped when the server starts, and each tuplespace's tuples are only unpickled the first time it is used.
+##
+## Only a server that isn't connected to another server when it starts should be made durable, as the others are
+## given a new node id each time and so can't take back their tuplespaces.
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+import traceback
+import weakref
+
+from . import utils
+
+## The operation log that changes are written to, or None if the server isn't durable
+log = None
+## The Store that writes snapshots, or None if the server isn't durable
+store = None
+
+header = struct.Struct("!8sQQ") # magic, index offset, index length
+snapshot_magic = b"PYLINDA1"
+length = struct.Struct("!I")
+
+def logName(directory, number):
+    return os.path.join(directory, "log.%08i" % (number, ))
+
+## \brief Returns the numbers of the log files in a directory, in order
+def logNumbers(directory):
+    numbers = []
+    for name in os.listdir(directory):
+        if name.startswith("log."):
+            try:
+                numbers.append(int(name[4:]))
+            except ValueError:
+                pass
+    numbers.sort()
+    return numbers
+
+## \brief Returns the records in a log file, stopping at the end of the file or at a record that was only partly
+## written when the server stopped
+def readLog(filename):
+    fp = open(filename, "rb")
+    try:
+        data = fp.read()
+    finally:
+        fp.close()
+
+    records = []
+    pos = 0
+    while pos + length.size <= len(data):
+        size = length.unpack_from(data, pos)[0]
+        pos += length.size
+        if pos + size > len(data):
+            break
+        try:
+            records.append(pickle.loads(data[pos:pos + size]))
+        except Exception:
+            print("Ignoring corrupt record in %s" % (filename, ))
+            break
+        pos += size
+    return records
+
+## \brief Raised by OperationLog.wait when a record couldn't be written to disk
+class LogError(Exception):
+    pass
+
+## \class OperationLog
+## \internal
+## \brief An append-only log of the changes made to the tuplespaces.
+##
+## Records are appended to a list in memory, and a writer thread writes everything that has been appended and syncs
+## it to disk in one go. Processes whose operation has been logged wait until their record is on disk before they are
+## replied to, so while the disk is being synced the records of other processes build up and are written together
+## next time. The records are only pickled by the writer, so the tuplespace locks aren't held while they are.
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+class OperationLog:
+    def __init__(self, directory, number, seq):
+        self.directory = directory
+
+        self.lock = threading.Lock()
+        self.appended = threading.Condition(self.lock) # notified when there are records to write
+        self.synced = threading.Condition(self.lock) # notified when records have been written
+        self.write_semaphore = threading.Semaphore() # held while writing, so the file can't be changed underneath us
+        self.started = False
+
+        self.pending = [] # records that have not been written yet
+        self.seq = seq # the sequence number of the last record appended...
+        self.synced_seq = seq # ... and of the last one on disk
+        self.error = None # set when a write fails, after which nothing more is written
+
+        self.number = number
+        self.file = open(logName(directory, number), "ab")
+
+    ## \brief Add a record to the log
+    ## \return The sequence number of the record, to be passed to wait
+    def append(self, record):
+        self.lock.acquire()
+        try:
+            self.seq += 1
+            self.pending.append((self.seq, ) + record)
+            self.appended.notify()
+            if not self.started:
+                t = threading.Thread(target=self.run, name="operation-log")
+                t.daemon = True
+                t.start()
+                self.started = True
+            return self.seq
+        finally:
+            self.lock.release()
+
+    ## \brief Wait until the record with the given sequence number is on disk
+    ## \throws LogError if it couldn't be written
+    def wait(self, seq):
+        self.lock.acquire()
+        try:
+            while self.synced_seq < seq:
+                if self.error is not None:
+                    raise LogError("Unable to write to the operation log: %s" % (self.error, ))
+                self.synced.wait()
+        finally:
+            self.lock.release()
+
+    ## \brief Returns the sequence number of the last record appended
+    def lastSeq(self):
+        self.lock.acquire()
+        try:
+            return self.seq
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while True:
+            self.lock.acquire()
+            try:
+                while len(self.pending) == 0:
+                    self.appended.wait()
+            finally:
+                self.lock.release()
+
+            try:
+                self.flush()
+            except:
+                # an error writing one batch must not stop us writing in future
+                traceback.print_exc()
+
+    ## \brief Write everything that has been appended, and wake the processes waiting for it
+    def flush(self):
+        self.write_semaphore.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                records, self.pending = self.pending, []
+            finally:
+                self.lock.release()
+            self.write(records)
+        finally:
+            self.write_semaphore.release()
+
+    ## \brief Write and sync a list of records. The write semaphore must be held.
+    def write(self, records):
+        if len(records) == 0:
+            return
+        error = self.error
+        if error is None:
+            try:
+                data = []
+                for record in records:
+                    record = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+                    data.append(length.pack(len(record)))
+                    data.append(record)
+                self.file.write(b"".join(data))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except Exception as e:
+                # part of a record may have reached the file, which would stop the records after it being replayed,
+                # and once a sync has failed we can't tell what is on disk, so nothing more is written
+                print("Unable to write to the operation log, changes will no longer be kept: %s" % (e, ))
+                error = e
+
+        self.lock.acquire()
+        try:
+            if error is None:
+                self.synced_seq = records[-1][0]
+            else:
+                self.error = error # the processes waiting for these records are told they weren't written
+            self.synced.notify_all()
+        finally:
+            self.lock.release()
+
+    ## \brief Start a new log file, so the old ones can be deleted once a snapshot has been written
+    ## \return The number of the new log file
+    def rotate(self):
+        self.write_semaphore.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                records, self.pending = self.pending, []
+            finally:
+                self.lock.release()
+            self.write(records)
+
+            self.file.close()
+            self.number += 1
+            self.file = open(logName(self.directory, self.number), "ab")
+            return self.number
+        finally:
+            self.write_semaphore.release()
+
+## \class Snapshot
+## \internal
+## \brief A memory mapped snapshot file
+class Snapshot:
+    def __init__(self, filename):
+        fp = open(filename, "rb")
+        try:
+            self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fp.close() # the map stays valid after the file is closed, or replaced by a new snapshot
+
+        magic, offset, size = header.unpack_from(self.map, 0)
+        if magic != snapshot_magic:
+            raise ValueError("%s is not a snapshot" % (filename, ))
+        self.index = pickle.loads(self.map[offset:offset + size])
+
+    ## \brief Returns the list of (tuple, deadline) pairs stored at the given position
+    def load(self, offset, size):
+        return pickle.loads(self.map[offset:offset + size])
+
+    ## \brief Returns the pickled tuples stored at the given position, without unpickling them
+    def raw(self, offset, size):
+        return self.map[offset:offset + size]
+
+## \class Store
+## \internal
+## \brief Recovers the tuplespaces when the server starts, and writes snapshots of them while it runs.
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+class Store:
+    def __init__(self, directory, interval=300.0):
+        self.directory = directory
+        self.interval = interval
+
+        self.load_semaphore = threading.Semaphore() # held while a tuplespace is loaded from the snapshot
+        self.recovering = False
+        self.restored = [] # weak references to the tuplespace references restored while recovering
+
+    ## \brief Load the tuplespaces from the last snapshot and replay the logs written since
+    ## \return The sequence number of the last log record, and the number of the last log file
+    def recover(self, container):
+        self.recovering = True
+
+        seqs = {} # tuplespace id -> sequence number of the last record included in its snapshot
+        first_log = 0
+        filename = os.path.join(self.directory, "snapshot")
+        if os.path.exists(filename):
+            snapshot = Snapshot(filename)
+            first_log = snapshot.index["log"]
+            for ts, capacity, seq, offset, size, refs in snapshot.index["spaces"]:
+                container.newTupleSpace(ts, *capacity)
+                container.ts[ts].pending = (snapshot, offset, size, refs)
+                seqs[ts] = seq
+            # the references held by tuples are restored now, so a tuplespace that is only referred to by another
+            # that hasn't been loaded yet isn't taken for garbage
+            for ts, capacity, seq, offset, size, refs in snapshot.index["spaces"]:
+                for ref in refs:
+                    if ref in container.ts:
+                        container.addReference(ref, ts)
+
+        last_seq = 0
+        numbers = [n for n in logNumbers(self.directory) if n >= first_log]
+        for number in numbers:
+            for record in readLog(logName(self.directory, number)):
+                last_seq = max(last_seq, record[0])
+                self.replay(container, seqs, record)
+
+        self.recovering = False
+        # the tuplespace references we restored can now drop their references when they're deleted, as normal
+        for ref in self.restored:
+            t = ref()
+            if t is not None:
+                t._gc = True
+        self.restored = []
+
+        return last_seq, numbers and numbers[-1] or first_log
+
+    ## \brief Apply a log record to the tuplespaces
+    def replay(self, container, seqs, record):
+        seq, op, ts = record[:3]
+        if op == "create":
+            if ts not in container.ts:
+                container.newTupleSpace(ts, *record[3])
+        elif op == "drop":
+            if ts in container.ts:
+                obj = container[ts]
+                if obj.ts is not None:
+                    for tup in obj.ts.matchAllTuples():
+                        utils.containsTS(tup, lambda t: self.release(container, t, ts))
+                del container.ts[ts]
+        elif seq > seqs.get(ts, 0) and ts in container.ts: # otherwise the snapshot already includes the change
+            obj = container[ts]
+            if obj.ts is None:
+                return
+            if op == "out":
+                tup, deadline = record[3:]
+                utils.containsTS(tup, lambda t: self.adopt(container, t, ts, True))
+                obj.restore(tup, deadline)
+            elif op == "take":
+                # the references read from the log aren't real references, so they mustn't be dropped when deleted
+                utils.containsTS(record[3], self.ignore)
+                tup = obj.discard(record[3])
+                if tup is not None:
+                    utils.containsTS(tup, lambda t: self.release(container, t, ts))
+
+    ## \brief Make a tuplespace reference that has been read from disk belong to the tuplespace holding it
+    ## \param count True if the reference should be added to the tuplespace it refers to
+    def adopt(self, container, t, owner, count):
+        t.owner = owner
+        if self.recovering:
+            # dropping the reference while we're recovering would message the server, which isn't running yet
+            t._gc = False
+            self.restored.append(weakref.ref(t))
+        if count:
+            try:
+                container.addReference(t._id, owner)
+            except KeyError: # the tuplespace it refers to is gone
+                t._gc = False
+
+    ## \brief Stop a tuplespace reference dropping a reference when it is deleted
+    def ignore(self, t):
+        t._gc = False
+
+    ## \brief Drop the reference held by a tuple that has been removed while recovering
+    def release(self, container, t, owner):
+        t._gc = False
+        if t._id in container.ts:
+            container.deleteReference(t._id, owner)
+
+    ## \brief Load the tuples of a tuplespace from the snapshot, if they haven't been already
+    def load(self, ts):
+        self.load_semaphore.acquire()
+        try:
+            if ts.pending is None: # loaded by another thread while we waited
+                return
+            snapshot, offset, size, refs = ts.pending
+            for tup, deadline in snapshot.load(offset, size):
+                # the references these tuples hold were added when the snapshot was opened
+                utils.containsTS(tup, lambda t: self.adopt(None, t, ts._id, False))
+                ts.restore(tup, deadline)
+            ts.pending = None
+        finally:
+            self.load_semaphore.release()
+
+    def run(self, container):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.snapshot(container)
+            except:
+                # an error in one snapshot must not stop us writing them in future
+                traceback.print_exc()
+
+    ## \brief Write a snapshot of every tuplespace, and delete the logs it replaces
+    def snapshot(self, container):
+        # Changes made after the new log is started are replayed, so the snapshot needs everything made before. Any
+        # tuplespace created before this is in the list we take next, and each tuplespace is copied as it is when we
+        # copy it, along with the sequence number of its last change, so later changes are replayed and earlier ones
+        # skipped.
+        first_log = log.rotate()
+
+        container.semaphore.acquire()
+        try:
+            spaces = list(container.ts.items())
+        finally:
+            container.semaphore.release()
+
+        copies = []
+        for ts_id, ts in spaces:
+            self.load_semaphore.acquire() # so a tuplespace can't be loaded while we copy it
+            try:
+                locks = ts.acquireAll()
+                try:
+                    copy = ts.copy()
+                    seq = log.lastSeq()
+                finally:
+                    ts.releaseAll(locks)
+            finally:
+                self.load_semaphore.release()
+            if copy is not None:
+                copies.append((ts_id, seq) + copy)
+
+        filename = os.path.join(self.directory, "snapshot")
+        fp = open(filename + ".new", "wb")
+        try:
+            fp.write(header.pack(snapshot_magic, 0, 0))
+            index = []
+            offset = header.size
+            for ts_id, seq, capacity, tuples, refs in copies:
+                if isinstance(tuples, list):
+                    tuples = pickle.dumps(tuples, pickle.HIGHEST_PROTOCOL)
+                fp.write(tuples)
+                index.append((ts_id, capacity, seq, offset, len(tuples), refs))
+                offset += len(tuples)
+            data = pickle.dumps({"log": first_log, "spaces": index}, pickle.HIGHEST_PROTOCOL)
+            fp.write(data)
+            fp.seek(0)
+            fp.write(header.pack(snapshot_magic, offset, len(data)))
+            fp.flush()
+            os.fsync(fp.fileno())
+        finally:
+            fp.close()
+        os.rename(filename + ".new", filename)
+
+        for number in logNumbers(self.directory):
+            if number < first_log:
+                os.remove(logName(self.directory, number))
+
+## \brief Make the server durable, recovering the tuplespaces it held when it last ran
+## \return The highest tuplespace number recovered for the given node, so new tuplespaces aren't given the same ids
+## \param directory The directory to keep the log and snapshots in
+## \param container The TupleSpaceContainer to recover the tuplespaces into
+## \param node The node id of this server
+## \param interval How often, in seconds, to write a snapshot
+def enable(directory, container, node, interval=300.0):
+    global log, store
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    store = Store(directory, interval)
+    seq, number = store.recover(container)
+    log = OperationLog(directory, number + 1, seq)
+
+    t = threading.Thread(target=store.run, args=(container, ), name="snapshot")
+    t.daemon = True
+    t.start()
+
+    highest = 0
+    for ts in container.ts:
+        n, i = ts.split(":")
+        if int(n) == node:
+            highest = max(highest, int(i))
+    return highest
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+# Benchmark for durable tuplespaces. It first times out and in on a tuplespace with durability off and then on, using
+# several threads so the operation log can write their records together, and then times how long a server takes to
+# recover tuplespaces of different sizes, from the log alone and from a snapshot. Recovering from a snapshot only reads
+# its index, so the time taken to load the tuples when the tuplespace is first used is shown separately.
+
+import linda.durability as durability
+from linda.tscontainer import TupleSpaceContainer
+
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+threads = 16
+count = 2000
+if len(sys.argv) > 1:
+    count = int(sys.argv[1])
+
+def run(container):
+    ts = container["0:0"]
+    def worker(n):
+        for i in range(count // threads):
+            ts._out(("task", n, i))
+            ts._in("1!1!%i" % (n, ), ("task", n, int), False)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(n, )) for n in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return (count // threads) * threads * 2 / (time.perf_counter() - start)
+
+def recover(directory):
+    # recovering with the benchmark's own log still open would log the recovery itself
+    log, durability.log = durability.log, None
+    try:
+        container = TupleSpaceContainer()
+        store = durability.Store(directory)
+        durability.store = store
+        start = time.perf_counter()
+        store.recover(container)
+        recovered = time.perf_counter() - start
+        start = time.perf_counter()
+        container["0:0"]
+        loaded = time.perf_counter() - start
+        return recovered, loaded
+    finally:
+        durability.log = log
+
+container = TupleSpaceContainer()
+container.newTupleSpace("0:0")
+off = run(container)
+
+directory = tempfile.mkdtemp()
+try:
+    container = TupleSpaceContainer()
+    durability.enable(directory, container, 1, 1e9)
+    container.newTupleSpace("0:0")
+    on = run(container)
+finally:
+    shutil.rmtree(directory)
+
+print("durability\tops/s")
+print("off\t%i" % (off, ))
+print("on\t%i" % (on, ))
+print()
+
+print("tuples\tsource\trecover ms\tload ms")
+for size in (1000, 10000, 100000):
+    directory = tempfile.mkdtemp()
+    try:
+        container = TupleSpaceContainer()
+        durability.enable(directory, container, 1, 1e9)
+        container.newTupleSpace("0:0")
+        ts = container["0:0"]
+        for i in range(size):
+            ts.insert(("data", i, "x" * 20), None) # the log would make us wait for each tuple in turn
+            durability.log.append(("out", "0:0", ("data", i, "x" * 20), None))
+        durability.log.flush()
+
+        recovered, loaded = recover(directory)
+        print("%i\tlog\t%.1f\t%.1f" % (size, recovered * 1e3, loaded * 1e3))
+
+        durability.store.snapshot(container)
+        recovered, loaded = recover(directory)
+        print("%i\tsnapshot\t%.1f\t%.1f" % (size, recovered * 1e3, loaded * 1e3))
+    finally:
+        shutil.rmtree(directory)
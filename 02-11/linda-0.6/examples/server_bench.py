@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+# Benchmark for the server core. A server is started in a process of its own, either threaded or on an asyncio event
+# loop, and then 10, 100 and 1000 clients connect to it at once. The clients work in pairs, one outputting tuples and
+# the other taking them, so most of the takers are blocked waiting for a tuple at any one time. The clients speak the
+# wire protocol directly from a single event loop, so the benchmark itself doesn't need a thread per client.
+#
+# usage: server_bench.py [threaded|asyncio] [messages per client]
+
+import asyncio
+import multiprocessing
+import pickle
+import struct
+import sys
+import time
+
+from linda.messages import *
+
+port = 2199
+mode = "asyncio"
+count = 200
+if len(sys.argv) > 1:
+    mode = sys.argv[1]
+if len(sys.argv) > 2:
+    count = int(sys.argv[2])
+
+def serve(mode, port):
+    import os
+    import linda.server as server
+
+    sys.stdout = open(os.devnull, "w") # the server reports every connection that closes
+
+    server.local_ts.newTupleSpace("0:0")
+    if mode == "asyncio":
+        from linda import aioserver
+        s = aioserver.AsyncLindaServer(("127.0.0.1", port))
+    else:
+        # the default backlog of 5 resets most of the connections when 1000 clients connect at once
+        server.LindaServer.request_queue_size = 1024
+        s = server.LindaServer(("127.0.0.1", port), server.LindaConnection)
+    s.serve_forever()
+
+async def request(reader, writer, *msg):
+    body = pickle.dumps(pickle.dumps(msg))
+    writer.write(struct.pack("!I", len(body)) + body)
+    size = struct.unpack("!I", await reader.readexactly(4))[0]
+    return pickle.loads(await reader.readexactly(size))
+
+async def client(n, latencies):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    await request(reader, writer, begin_session)
+    pid = await request(reader, writer, register_process)
+    tid = await request(reader, writer, register_thread, pid)
+
+    for i in range(count):
+        start = time.perf_counter()
+        if n % 2 == 0:
+            await request(reader, writer, out_tuple, "0:0", pickle.dumps(("bench", n // 2, i)), None)
+        else:
+            pickle.loads(await request(reader, writer, in_tuple, "0:0", ("bench", n // 2, int), tid, False))
+        latencies.append(time.perf_counter() - start)
+
+    await request(reader, writer, close_connection)
+    writer.close()
+
+async def run(clients):
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(n, latencies) for n in range(clients)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return len(latencies) / elapsed, latencies[len(latencies) // 2], latencies[len(latencies) * 99 // 100]
+
+if __name__ == "__main__":
+    p = multiprocessing.Process(target=serve, args=(mode, port))
+    p.daemon = True
+    p.start()
+    time.sleep(1.0)
+
+    print("%s server, %i messages per client" % (mode, count))
+    print("%8s %12s %12s %12s" % ("clients", "msgs/s", "p50 ms", "p99 ms"))
+    for clients in (10, 100, 1000):
+        rate, p50, p99 = asyncio.run(run(clients))
+        print("%8i %12.0f %12.2f %12.2f" % (clients, rate, p50 * 1000, p99 * 1000))
+
+    p.terminate()
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Microbenchmark for the tuple container. For tuples of 4 to 10 fields it times add, match and delete, and measures
+# the memory each operation allocates while it runs (the peak traced memory above what was in use before the
+# operation), which is the garbage the server has to create and free for every tuple it handles.
+
+import linda.tuplecontainer as tc
+
+import random
+import sys
+import time
+import tracemalloc
+
+count = 2000
+if len(sys.argv) > 1:
+    count = int(sys.argv[1])
+
+def maketuples(fields):
+    return [tuple(["task"] + [random.randint(0, 1000) for x in range(fields - 1)]) for i in range(count)]
+
+def timeit(func, tuples):
+    start = time.perf_counter()
+    for tup in tuples:
+        func(tup)
+    return (time.perf_counter() - start) / len(tuples) * 1e6
+
+def allocated(func, tuples):
+    total = 0
+    tracemalloc.start()
+    for tup in tuples:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        func(tup)
+        total += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return total / len(tuples)
+
+print("fields\top\tus/op\tbytes/op")
+for fields in range(4, 11):
+    tuples = maketuples(fields)
+    template = tuple(["task"] + [int] * (fields - 1))
+
+    t = tc.TupleContainer()
+    add_time = timeit(t.add, tuples)
+    match = lambda tup: t.matchOneTuple(tup)
+    match_time = timeit(match, tuples)
+    formal = lambda tup: t.matchOneTuple(template)
+    formal_time = timeit(formal, tuples)
+    delete_time = timeit(t.delete, tuples)
+
+    t = tc.TupleContainer()
+    add_bytes = allocated(t.add, tuples)
+    match_bytes = allocated(match, tuples)
+    formal_bytes = allocated(formal, tuples)
+    delete_bytes = allocated(t.delete, tuples)
+
+    print("%i\tadd\t%.2f\t%i" % (fields, add_time, add_bytes))
+    print("%i\tmatch\t%.2f\t%i" % (fields, match_time, match_bytes))
+    print("%i\tformal\t%.2f\t%i" % (fields, formal_time, formal_bytes))
+    print("%i\tdelete\t%.2f\t%i" % (fields, delete_time, delete_bytes))
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Reports the memory used to store tuples in the old tuple container layout (a full object per node, with [count,
+# child] list entries) and in the current compact one. The tuples are built before measuring starts so only the
+# memory used by the container itself is counted.
+#
+# Usage: trie_memory.py [number of tuples, default 1000000]
+
+import linda.tuplecontainer as tc
+
+import random
+import sys
+import tracemalloc
+
+count = 1000000
+if len(sys.argv) > 1:
+    count = int(sys.argv[1])
+
+# The layout used before the nodes were compacted, kept here for comparison
+class OldTupleContainer:
+    def __init__(self):
+        self.contain = {}
+        self.types = {}
+
+    def add(self, tup):
+        node = self
+        last = len(tup) - 1
+        for i in range(last + 1):
+            entry = node.contain.get(tup[i])
+            if entry is None:
+                entry = node.contain[tup[i]] = [0, None]
+                try:
+                    node.types[tup[i].__class__][tup[i]] = None
+                except KeyError:
+                    node.types[tup[i].__class__] = {tup[i]: None}
+            if i == last:
+                entry[0] += 1
+            else:
+                if entry[1] is None:
+                    entry[1] = OldTupleContainer()
+                node = entry[1]
+
+def measure(container, tuples):
+    tracemalloc.start()
+    t = container()
+    for tup in tuples:
+        t.add(tup)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size
+
+shapes = [("task bag", lambda i: ("task", i, random.random(), "payload")),
+          ("graph edges", lambda i: ("edge", random.randint(0, 1000), random.randint(0, 1000), random.random())),
+          ("wide rows", lambda i: ("row", i % 100, i, i * 2, random.random(), "a", "b", i % 7))]
+
+print("%i tuples" % (count, ))
+print("shape\t\told MB\tnew MB\tbytes/tuple old\tnew")
+for name, make in shapes:
+    tuples = [make(i) for i in range(count)]
+    old = measure(OldTupleContainer, tuples)
+    new = measure(tc.TupleContainer, tuples)
+    print("%s\t%.1f\t%.1f\t%i\t\t%i" % (name, old / 1e6, new / 1e6, old / count, new / count))
+    del tuples
@@ -0,0 +1,191 @@
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+## \namespace expiry
+## \brief This module contains the timer wheel that removes tuples whose lease has expired
+## \internal
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+
+import threading
+import time
+import traceback
+
+from . import stats
+
+## \class Lease
+## \internal
+## \brief A lease on one copy of a tuple in a tuplespace. When the lease expires the tuple is removed.
+##
+## Copies of a tuple can't be told apart, so when a process takes a tuple that leaves fewer copies than leases the
+## lease that would expire first is cancelled. Cancelled leases are left in the timer wheel and ignored when they
+## expire.
+class Lease:
+    __slots__ = ("ts", "tup", "deadline", "tick", "cancelled")
+
+    def __init__(self, ts, tup, deadline):
+        self.ts = ts
+        self.tup = tup
+        self.deadline = deadline
+        self.tick = None # the tick of the timer wheel that the lease expires on
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+    ## \brief Cancel the lease, dropping the tuple so any tuplespaces it refers to can be garbage collected
+    def cancel(self):
+        self.cancelled = True
+        self.ts = None
+        self.tup = None
+
+## \class TimerWheel
+## \internal
+## \brief A hierarchical timer wheel holding the leases of every tuple on this server.
+##
+## Time is divided into ticks of resolution seconds. The first wheel has a slot for each of the next slots ticks, the
+## second a slot for each of the next slots * slots ticks and so on. A lease is put in the slot of the smallest wheel
+## that can hold it, and when the first wheel comes round to a slot of a larger wheel the leases in that slot are
+## moved down to the smaller wheels. Adding a lease or expiring one therefore costs the same however many leases
+## there are. Leases that expire beyond the largest wheel are put in its last slot, and moved again when reached.
+##
+## Every tick the expired leases are grouped by their tuplespace, and each tuplespace removes its expired tuples in
+## one batch while holding its locks.
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+class TimerWheel:
+    def __init__(self, resolution=0.1, slots=64, levels=4):
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+
+        self.lock = threading.Semaphore()
+        self.started = False
+        self.wheels = [[[] for i in range(slots)] for l in range(levels)]
+        self.start_time = time.time()
+        self.tick = 0 # the last tick that has been processed
+        self.count = 0 # the number of leases in the wheels
+
+        self.expired = 0
+
+    ## \brief Add a lease to the wheel
+    def add(self, lease):
+        lease.tick = max(int((lease.deadline - self.start_time) / self.resolution) + 1, 1)
+
+        self.lock.acquire()
+        try:
+            if self.count == 0:
+                # nothing is waiting so we can skip straight to the current time, rather than ticking through the time
+                # the wheel was empty
+                self.tick = max(self.tick, int((time.time() - self.start_time) / self.resolution))
+            self.schedule(lease)
+            self.count += 1
+            if not self.started:
+                t = threading.Thread(target=self.run, name="expiry")
+                t.daemon = True
+                t.start()
+                self.started = True
+        finally:
+            self.lock.release()
+
+    ## \brief Put a lease in the slot of the smallest wheel that will reach its tick. The wheel lock must be held.
+    def schedule(self, lease):
+        tick = max(lease.tick, self.tick + 1)
+        delta = tick - self.tick
+        span = 1
+        for level in range(self.levels):
+            if delta < span * self.slots:
+                self.wheels[level][(tick // span) % self.slots].append(lease)
+                return
+            span *= self.slots
+        # too far in the future for any wheel, so wait in the last slot of the largest one
+        span //= self.slots
+        self.wheels[-1][(self.tick // span + self.slots - 1) % self.slots].append(lease)
+
+    ## \brief Move the wheels forward to the given time
+    ## \return A list of the leases that have expired
+    def advance(self, now):
+        target = int((now - self.start_time) / self.resolution)
+        expired = []
+
+        self.lock.acquire()
+        try:
+            while self.tick < target:
+                if self.count == 0:
+                    self.tick = target
+                    break
+                self.tick += 1
+
+                # when a larger wheel reaches a new slot its leases are spread over the smaller wheels
+                span = self.slots
+                for level in range(1, self.levels):
+                    if self.tick % span != 0:
+                        break
+                    slot = self.wheels[level][(self.tick // span) % self.slots]
+                    self.wheels[level][(self.tick // span) % self.slots] = []
+                    for lease in slot:
+                        if lease.tick <= self.tick:
+                            expired.append(lease)
+                        else:
+                            self.schedule(lease)
+                    span *= self.slots
+
+                slot = self.wheels[0][self.tick % self.slots]
+                self.wheels[0][self.tick % self.slots] = []
+                expired.extend(slot)
+
+            self.count -= len(expired)
+        finally:
+            self.lock.release()
+
+        return expired
+
+    def run(self):
+        while True:
+            time.sleep(self.resolution)
+            try:
+                self.expire(self.advance(time.time()))
+            except:
+                # an error in one tuplespace must not stop tuples expiring in the others
+                traceback.print_exc()
+
+    ## \brief Remove the tuples whose leases have expired from their tuplespaces
+    ## \param leases A list of expired leases
+    def expire(self, leases):
+        spaces = {} # TupleSpace -> list of leases
+        for lease in leases:
+            ts = lease.ts
+            if ts is not None: # the lease hasn't been cancelled
+                spaces.setdefault(ts, []).append(lease)
+
+        removed = 0
+        for ts, ts_leases in spaces.items():
+            removed += ts.expire(ts_leases)
+
+        if removed > 0:
+            self.lock.acquire()
+            try:
+                self.expired += removed
+                stats.set_stat("tuples_expired", self.expired)
+            finally:
+                self.lock.release()
+
+## The timer wheel for the tuples on this server
+wheel = TimerWheel()
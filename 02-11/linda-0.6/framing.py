@@ -0,0 +1,178 @@
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+## \namespace framing
+## \brief This module contains the framing of messages on a socket
+## \internal
+##
+## Every message is sent as a 4 byte length followed by the message. A Framer reads from its socket into a buffer it
+## keeps, as much as has arrived up to the size of the buffer, so a reader that is behind takes each message that has
+## already arrived from the buffer without a system call. The header and the message are sent with a single sendmsg
+## rather than being joined together first.
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+
+import socket
+import struct
+
+## The header of a frame, the length of the message that follows
+header = struct.Struct("!I")
+
+## The size of a Framer's buffer. A message that doesn't fit is read into a buffer of its own.
+buffer_size = 16 * 1024
+
+## Whether to turn off Nagle's algorithm on TCP connections. Requests and replies are small and each is waited for, so
+## holding one back until the last has been acknowledged only adds delay.
+nodelay = True
+## The size to set the kernel's send and receive buffers to for each connection, or None to leave them alone
+socket_buffer_size = None
+
+_sendmsg = hasattr(socket.socket, "sendmsg")
+
+## \brief Apply the policy above to a newly connected socket
+def configure(s):
+    try:
+        if nodelay and s.family in (socket.AF_INET, getattr(socket, "AF_INET6", socket.AF_INET)):
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if socket_buffer_size is not None:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, socket_buffer_size)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, socket_buffer_size)
+    except socket.error:
+        pass # the policy is only advice, a socket that won't take it works without it
+
+## \brief Send a header and the data that follows it on the given socket, without joining them together
+def send(s, head, data, flags=0):
+    if not _sendmsg:
+        s.sendall(head + data, flags)
+        return
+    sent = s.sendmsg([head, data], [], flags)
+    if sent < len(head) + len(data):
+        # the socket took part of the frame. The rest must follow it whatever the flags, or the stream would be broken.
+        if sent < len(head):
+            s.sendall(head[sent:])
+            sent = len(head)
+        s.sendall(memoryview(data)[sent - len(head):])
+
+## The most buffers passed to a single sendmsg, which is well under the limit the kernel puts on them
+max_buffers = 512
+
+## \brief Send several messages on the given socket, each as a frame, with as few system calls as we can
+def sendFrames(s, messages, flags=0):
+    buffers = []
+    for data in messages:
+        buffers.append(header.pack(len(data)))
+        buffers.append(data)
+    if not _sendmsg:
+        s.sendall(b"".join(buffers), flags)
+        return
+    for i in range(0, len(buffers), max_buffers):
+        chunk = buffers[i:i + max_buffers]
+        sent = s.sendmsg(chunk, [], flags)
+        if sent < sum(map(len, chunk)):
+            # as in send, the rest must follow whatever the flags
+            s.sendall(memoryview(b"".join(chunk))[sent:])
+
+## \brief Read exactly size bytes from a socket that has no Framer
+## \return A bytearray, or None if the connection was closed first
+def readExactly(s, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    got = 0
+    while got < size:
+        n = s.recv_into(view[got:])
+        if n == 0:
+            return None
+        got += n
+    return buf
+
+## \brief Read a frame from a socket that has no Framer. Only the frame is read, so nothing that follows it is lost if
+## the socket is later given to something else.
+## \return The message, or None if the connection was closed
+def read(s):
+    head = readExactly(s, header.size)
+    if head is None:
+        return None
+    return readExactly(s, header.unpack(head)[0])
+
+## \class Framer
+## \internal
+## \brief A socket, and the bytes received on it that haven't been read yet.
+##
+## The unread bytes are those between start and end in the buffer. They are moved back to the start of the buffer when
+## there is no room after them for the rest of the frame being read.
+class Framer:
+    def __init__(self, socket):
+        self.socket = socket
+        self.start = 0
+        self.end = 0
+        if socket is not None:
+            self.buffer = bytearray(buffer_size)
+            self.view = memoryview(self.buffer)
+            configure(socket)
+
+    ## \brief Returns the next message received, or None if the connection has been closed
+    def read(self):
+        while True:
+            available = self.end - self.start
+            if available >= header.size:
+                size = header.unpack_from(self.buffer, self.start)[0]
+                if available >= header.size + size:
+                    start = self.start + header.size
+                    msg = bytes(self.view[start:start + size])
+                    self.start = start + size
+                    if self.start == self.end:
+                        self.start = self.end = 0
+                    return msg
+                if header.size + size > len(self.buffer):
+                    return self.readLarge(size)
+                needed = header.size + size
+            else:
+                needed = header.size
+
+            if self.start + needed > len(self.buffer):
+                # make room for the rest of the frame by moving what we have to the start of the buffer
+                self.buffer[:available] = self.buffer[self.start:self.end]
+                self.start, self.end = 0, available
+            n = self.socket.recv_into(self.view[self.end:])
+            if n == 0:
+                return None
+            self.end += n
+
+    ## \brief Returns a message that is bigger than the buffer, which is read into a buffer of its own
+    def readLarge(self, size):
+        msg = bytearray(size)
+        have = self.end - self.start - header.size
+        msg[:have] = self.view[self.start + header.size:self.end]
+        self.start = self.end = 0
+
+        view = memoryview(msg)
+        while have < size:
+            n = self.socket.recv_into(view[have:])
+            if n == 0:
+                return None
+            have += n
+        return msg
+
+    ## \brief Send a message
+    def write(self, data, flags=0):
+        send(self.socket, header.pack(len(data)), data, flags)
+
+    ## \brief Send several messages at once
+    def writeMany(self, messages, flags=0):
+        sendFrames(self.socket, messages, flags)
@@ -0,0 +1,182 @@
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+## \namespace garbage
+## \brief This module contains the background collector that finds tuplespaces that are no longer needed
+## \internal
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+
+import threading
+import time
+import traceback
+
+from .messages import get_reference_graph
+
+from . import durability
+from . import kernel
+from . import stats
+from . import utils
+
+## \class GarbageCollector
+## \internal
+## \brief Finds and empties tuplespaces that can only be reached from other unreachable tuplespaces.
+##
+## A tuplespace can only become garbage when a reference to it is removed, so when that happens it is marked as a
+## candidate. Every interval seconds the collector sweeps all the candidates together. It follows the references
+## back from each candidate, one level at a time, asking each server for the references of all the tuplespaces it
+## holds at that level in a single get_reference_graph message. A tuplespace is live if it is referenced by a
+## process, a server or the universal tuplespace, or by another live tuplespace. Everything else that was found is
+## garbage, so a whole cycle of tuplespaces is found in one sweep.
+##
+## Garbage tuplespaces on this server are emptied. This drops the references held by their tuples, so their
+## reference counts fall to zero and the tuplespace container deletes them. Tuplespaces on other servers lose their
+## references in the same way, which makes them candidates for that server's collector.
+##
+## The time taken by each sweep, and the number of tuplespaces emptied, are recorded in the server statistics.
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+class GarbageCollector:
+    def __init__(self, interval=1.0):
+        self.interval = interval
+
+        self.lock = threading.Semaphore()
+        self.started = False
+        self.candidates = {} # tuplespace id -> TupleSpace
+
+    ## \brief Mark a tuplespace that has lost a reference as possibly being garbage
+    def candidate(self, ts):
+        if ts._id == "0:0": # the universal tuplespace is never garbage
+            return
+        self.lock.acquire()
+        try:
+            self.candidates[ts._id] = ts
+            if not self.started:
+                t = threading.Thread(target=self.run, name="garbage-collector")
+                t.daemon = True
+                t.start()
+                self.started = True
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sweep()
+            except:
+                # an error in one sweep must not stop us collecting in future
+                traceback.print_exc()
+
+    ## \brief Find which of the candidates are garbage, and empty them
+    ## \return The number of tuplespaces emptied
+    def sweep(self):
+        self.lock.acquire()
+        try:
+            candidates, self.candidates = self.candidates, {}
+        finally:
+            self.lock.release()
+        if len(candidates) == 0:
+            return 0
+
+        start = time.time()
+
+        graph = self.getGraph(list(candidates.keys()))
+
+        # Work out which tuplespaces are live. held maps each tuplespace to those it holds a reference to, so
+        # liveness can be passed on from a tuplespace to the ones it holds.
+        live = []
+        held = {}
+        for ts, refs in graph.items():
+            for ref in refs:
+                if utils.isTupleSpaceId(ref) and ref != "0:0":
+                    held.setdefault(ref, []).append(ts)
+                else:
+                    # referenced by a process, a server or the universal tuplespace
+                    live.append(ts)
+                    break
+        alive = set(live)
+        while len(live) > 0:
+            ts = live.pop()
+            for other in held.get(ts, ()):
+                if other not in alive:
+                    alive.add(other)
+                    live.append(other)
+
+        from . import server
+        reclaimed = 0
+        for ts in graph:
+            if ts in alive or ts not in server.local_ts:
+                continue
+            try:
+                obj = server.local_ts[ts]
+            except KeyError: # deleted while we were sweeping
+                continue
+            if obj.ts is not None:
+                # emptying the tuplespace drops the references it holds to other tuplespaces
+                obj.ts = None
+                for leases in obj.leases.values():
+                    for lease in leases:
+                        lease.cancel()
+                obj.leases = {}
+                if durability.log is not None:
+                    durability.log.append(("drop", ts))
+                reclaimed += 1
+
+        pause = int((time.time() - start) * 1e6)
+        stats.inc_stat("gc_sweeps")
+        stats.set_stat("gc_reclaimed", stats.getstat("gc_reclaimed") + reclaimed)
+        stats.set_stat("gc_pause_total_us", stats.getstat("gc_pause_total_us") + pause)
+        if pause > stats.getstat("gc_pause_max_us"):
+            stats.set_stat("gc_pause_max_us", pause)
+
+        return reclaimed
+
+    ## \brief Returns the references of the given tuplespaces, and of every tuplespace that references them
+    ##
+    ## Processes, servers and the universal tuplespace are not followed, as anything they reference is live.
+    ## \return A dictionary mapping each tuplespace id to a list of the ids that reference it
+    def getGraph(self, ts_ids):
+        from . import server
+
+        graph = {}
+        level = ts_ids
+        while len(level) > 0:
+            # ask each server for the references of all its tuplespaces at this level at once
+            nodes = {}
+            for ts in level:
+                if ts not in graph:
+                    graph[ts] = [] # so we don't ask twice if it's reached twice in one level
+                    nodes.setdefault(utils.getNodeFromTupleSpaceId(ts), []).append(ts)
+
+            level = []
+            for node, tss in nodes.items():
+                if node == server.node_id:
+                    refs = server.getReferenceGraph(tss)
+                else:
+                    refs = utils.decode(kernel.message(get_reference_graph, node, tss))
+                for ts, ts_refs in refs.items():
+                    graph[ts] = ts_refs
+                    level.extend([ref for ref in ts_refs if utils.isTupleSpaceId(ref) and ref != "0:0"
+                                  and ref not in graph])
+        return graph
+
+## The collector for the tuplespaces on this server
+collector = GarbageCollector()
@@ -25,8 +25,10 @@
 ## \author Andrew Wilkinson <aw@cs.york.ac.uk>
 ##
 
+import concurrent.futures
 import gc
 import socket
+import sys
 import time
 import _thread
 import threading
@@ -41,14 +43,30 @@ class NotConnected(Exception):
     """
     pass
 
+class TupleSpaceFull(Exception):
+    """\brief This exception is raised when a tuple is output to a full tuplespace that was created with the
+    fail_when_full policy.
+    """
+    pass
+
+class NotDurable(Exception):
+    """\brief This exception is raised when a durable server has made a change, but couldn't write it to disk so it
+    won't survive the server being restarted.
+    """
+    pass
+
 class TupleSpace:
     """\brief This class represents a tuplespace.
     """
-    def __init__(self, tsid=None, gc=True):
+    def __init__(self, tsid=None, gc=True, max_tuples=None, max_bytes=None, when_full=block_when_full):
         """\brief Constructor for the tuplespace.
 
         This function contacts the local server and creates a new tuplespace there.
         \param universe Never set this parameter - it is only used internally
+        \param max_tuples If given, the most tuples the tuplespace may hold
+        \param max_bytes If given, the most memory, in bytes, that the tuples in the tuplespace may take up
+        \param when_full What an out does when the tuplespace is full - block_when_full waits for a tuple to be
+        removed, fail_when_full raises TupleSpaceFull and evict_when_full removes the oldest tuples
         """
         if tsid:
             self._id = tsid
@@ -59,7 +77,7 @@ class TupleSpace:
                 raise NotConnected
 
             self.owner = process_id
-            self._id = message(create_tuplespace)
+            self._id = message(create_tuplespace, max_tuples, max_bytes, when_full)
             self._addreference(self.owner)
             self._gc = True
 
@@ -95,17 +113,19 @@ class TupleSpace:
         """
         message(decrement_ref, self._id, ref)
 
-    def _out(self, tup):
+    def _out(self, tup, ttl=None):
         """\brief Outputs the given tuple to the tuplespace
 
         \param tup Sends the given tuple to the tuplespace
+        \param ttl If given, the tuple is removed after this many seconds if no process has taken it
         """
         if type(tup) is not tuple:
             raise TypeError("out only takes a tuple, not %s" % (type(tup)))
 
         utils.containsTS(tup, lambda t: t._addreference(utils.getNodeFromTupleSpaceId(self._id)))
 
-        message(out_tuple, self._id, utils.encode(tup))
+        if message(out_tuple, self._id, pack(tup), ttl) == tuplespace_full:
+            raise TupleSpaceFull("tuplespace %s is full" % (self._id, ))
 
     def _rd(self, template):
         """\brief Reads a tuple matching the given template
@@ -118,7 +138,7 @@ class TupleSpace:
 
         r = message(read_tuple, self._id, template, getThreadId(), False)
         if r != unblock:
-            return utils.decode(r)
+            return unpack(r)
         else:
             raise SystemError("Non-blocking primitive received an unblock command")
 
@@ -133,10 +153,77 @@ class TupleSpace:
 
         r = message(in_tuple, self._id, template, getThreadId(), False)
         if r != unblock:
-            return utils.decode(r)
+            return unpack(r)
         else:
             raise SystemError("Non-blocking primitive received an unblock command")
 
+    def _out_async(self, tup, ttl=None):
+        """\brief Outputs the given tuple to the tuplespace without waiting for the server to reply
+
+        \param tup Sends the given tuple to the tuplespace
+        \param ttl If given, the tuple is removed after this many seconds if no process has taken it
+        \return A future that is done once the tuple has been output, and raises TupleSpaceFull if it couldn't be
+        """
+        if type(tup) is not tuple:
+            raise TypeError("out only takes a tuple, not %s" % (type(tup)))
+
+        s = getSocket()
+        if not isinstance(s, Pipeline):
+            return inThread(self._out, tup, ttl)
+
+        utils.containsTS(tup, lambda t: t._addreference(utils.getNodeFromTupleSpaceId(self._id)))
+
+        def replied(r):
+            if r == tuplespace_full:
+                raise TupleSpaceFull("tuplespace %s is full" % (self._id, ))
+        return then(s.request(out_tuple, self._id, pack(tup, s), ttl), replied)
+
+    def _rd_async(self, template):
+        """\brief Reads a tuple matching the given template without waiting for one to be found
+
+        \param template The template used to match.
+        \return A future whose result is the matching tuple
+        """
+        if type(template) is not tuple:
+            raise TypeError("rd only takes a tuple, not %s" % (type(template)))
+
+        s = getSocket()
+        if not isinstance(s, Pipeline):
+            return inThread(self._rd, template)
+        return self._wait(s, read_tuple, template)
+
+    def _in_async(self, template):
+        """\brief Destructivly reads a tuple matching the given template without waiting for one to be found
+
+        \param template The template used to match.
+        \return A future whose result is the matching tuple
+        """
+        if type(template) is not tuple:
+            raise TypeError("in only takes a tuple, not %s" % (type(template)))
+
+        s = getSocket()
+        if not isinstance(s, Pipeline):
+            return inThread(self._in, template)
+        return self._wait(s, in_tuple, template)
+
+    def _wait(self, s, msg, template):
+        """\internal
+        \brief Sends a rd or in on the given Pipeline without waiting for the reply
+
+        The request waits under an id of its own, so the thread can have several blocked at once and still make
+        blocking calls of its own.
+        """
+        def replied(r):
+            if r != unblock:
+                return unpack(r)
+            else:
+                raise SystemError("Non-blocking primitive received an unblock command")
+
+        tid = s.waiter()
+        f = s.request(msg, self._id, template, tid, False)
+        f.add_done_callback(lambda f: s.release(tid))
+        return then(f, replied)
+
     def _rdp(self, template):
         """\brief Reads a tuple matching the given template.
 
@@ -149,7 +236,7 @@ class TupleSpace:
 
         r = message(read_tuple, self._id, template, getThreadId(), True)
         if r != unblock:
-            return utils.decode(r)
+            return unpack(r)
         else:
             return None
 
@@ -165,7 +252,7 @@ class TupleSpace:
 
         r = message(in_tuple, self._id, template, getThreadId(), True)
         if r != unblock:
-            return utils.decode(r)
+            return unpack(r)
         else:
             return None
 
@@ -205,6 +292,72 @@ class TupleSpace:
         except ValueError:
             raise SystemError("Unexpected reply to collect message - %s" % r)
 
+    def out_many(self, tuples, ttl=None):
+        """\brief Outputs several tuples to the tuplespace in a single message
+
+        \param tuples A list of tuples
+        \param ttl If given, each tuple is removed after this many seconds if no process has taken it
+        \return The number of tuples output. If the tuplespace was created with fail_when_full this is less than the
+        number given when it fills up, and the rest weren't output.
+        """
+        tuples = list(tuples)
+        for tup in tuples:
+            if type(tup) is not tuple:
+                raise TypeError("out_many only takes tuples, not %s" % (type(tup)))
+
+        for tup in tuples:
+            utils.containsTS(tup, lambda t: t._addreference(utils.getNodeFromTupleSpaceId(self._id)))
+
+        r = message(out_many, self._id, pack(tuples), ttl)
+        try:
+            return int(r)
+        except ValueError:
+            raise SystemError("Unexpected reply to out_many message - %s" % r)
+
+    def rd_many(self, template, max_n):
+        """\brief Reads up to max_n tuples matching the given template in a single message
+
+        If no tuples match this waits for one, like _rd.
+        \param template The template used to match.
+        \param max_n The most tuples to return, at least 1
+        \return A list of the matching tuples
+        """
+        if type(template) is not tuple:
+            raise TypeError("rd_many only takes a tuple, not %s" % (type(template)))
+
+        return self._many(rd_many, template, max_n)
+
+    def in_many(self, template, max_n):
+        """\brief Destructivly reads up to max_n tuples matching the given template in a single message
+
+        If no tuples match this waits for one, like _in.
+        \param template The template used to match.
+        \param max_n The most tuples to return, at least 1
+        \return A list of the matching tuples
+        """
+        if type(template) is not tuple:
+            raise TypeError("in_many only takes a tuple, not %s" % (type(template)))
+
+        return self._many(in_many, template, max_n)
+
+    def _many(self, msg, template, max_n):
+        """\internal
+        \brief Sends a rd_many or in_many to the server
+        """
+        if type(max_n) is not int or max_n < 1:
+            # a process asking for no tuples would wait for one, and be sent it anyway
+            raise ValueError("%s must be asked for at least 1 tuple, not %r" % (msg, max_n))
+        r = message(msg, self._id, template, getThreadId(), max_n)
+        if r == not_permitted:
+            raise ValueError("%s must be asked for at least 1 tuple, not %r" % (msg, max_n))
+        if r == unblock:
+            raise SystemError("Non-blocking primitive received an unblock command")
+        r = unpack(r)
+        if type(r) is list:
+            return r
+        else: # we waited and were sent the one tuple that was output
+            return [r]
+
     def __str__(self):
         """\brief Get a string representation of the tuplespace
         """
@@ -228,10 +381,167 @@ def getStatsTS():
 # delay importing the utils module until after we've defined TupleSpace as the utils class indirectly requires it
 from linda import utils
 utils.TupleSpace = TupleSpace
+from linda import codec
 
 msg_semaphore = threading.Semaphore()
 counter = utils.Counter()
 
+class Pipeline:
+    """\internal
+    \brief A connection to the local server that can have many requests outstanding at once.
+
+    Each request is tagged with an id, which the server tags its reply with, so the replies can arrive in any order. A
+    thread reads the replies and completes the future for each request.
+    """
+    def __init__(self, s):
+        self.socket = s
+        self.msgids = utils.Counter()
+        self.futures = {}
+        self.semaphore = threading.Semaphore()
+        self.waiters = [] # ids, other than the thread's own, that aren't being waited under by a rd or in
+
+        t = threading.Thread(target=self.read, name="pylinda-pipeline")
+        t.daemon = True
+        t.start()
+
+    def request(self, *msg):
+        """\internal
+        \brief Send the given message to the server without waiting for the reply
+        \return A future whose result is the reply
+        """
+        f = concurrent.futures.Future()
+        self.semaphore.acquire()
+        try:
+            msgid = next(self.msgids)
+            self.futures[msgid] = f
+            utils.send(self.socket, None, msgid, pack(msg, self.socket))
+        finally:
+            self.semaphore.release()
+        return f
+
+    def read(self):
+        """\internal
+        \brief Complete the future for each reply that arrives, until the connection is closed
+        """
+        while True:
+            try:
+                r = utils.recv(self.socket)[1]
+            except (socket.error, ValueError): # ValueError if the socket has been closed under us
+                break
+            if r == "":
+                break
+            msgid, r = r
+            f = self.futures.pop(msgid)
+            if r == not_durable:
+                f.set_exception(NotDurable("The server couldn't write the change to disk"))
+            else:
+                f.set_result(r)
+
+        self.semaphore.acquire()
+        try:
+            futures, self.futures = self.futures, {}
+        finally:
+            self.semaphore.release()
+        for f in futures.values():
+            f.set_exception(socket.error("Connection to the server was lost"))
+
+    def waiter(self):
+        """\internal
+        \brief Returns an id for a rd or in to wait under that no other outstanding rd or in is using
+        """
+        try:
+            return self.waiters.pop()
+        except IndexError:
+            return self.request(register_waiter, process_id).result()
+
+    def release(self, tid):
+        """\internal
+        \brief Returns an id from Pipeline.waiter once its rd or in has been replied to
+        """
+        self.waiters.append(tid)
+
+    def close(self):
+        self.socket.close()
+
+def beginSession(s):
+    """\internal
+    \brief Begins the session on a new connection to the local server, pipelining it if the server is able to
+    \return The socket framed by codec.Framed, or a Pipeline using it
+    """
+    # a pipeline needs a thread to read the replies, which can't be started as the interpreter exits
+    pipelining = use_pipelining and not run_as_server and not sys.is_finalizing()
+    s = codec.Framed(s)
+    if use_codec:
+        # the server must be told in the encoding, as a server started with --no-pickle won't unpickle anything
+        s.use(codec.version)
+        utils.send(s, None, None, (begin_session, pipelining, codec.version))
+    else:
+        utils.send(s, None, None, utils.encode((begin_session, pipelining)))
+    if utils.recv(s)[1] == pipelined:
+        return Pipeline(s)
+    return s
+
+def pack(value, s=None):
+    """\internal
+    \brief Returns a message, or a tuple within one, as it is sent to the server on s
+
+    Pickled messages, and the tuples in them, are pickled on their own before the message is framed. The codec module
+    encodes a message and everything in it at once, so on a connection that encodes its messages they're sent as they
+    are.
+    \param s A connection returned by beginSession. If not given this thread's connection is used.
+    """
+    if s is None:
+        if not _connected:
+            raise NotConnected
+        s = getSocket()
+    if isinstance(s, Pipeline):
+        s = s.socket
+    if s.version is not None:
+        return value
+    return utils.encode(value)
+
+def unpack(r):
+    """\internal
+    \brief Returns the tuple, or list of tuples, in a reply from the server
+
+    A server pickles them in its replies on a connection that pickles its messages, and sends them as they are on one
+    that encodes its messages.
+    """
+    if type(r) is bytes:
+        return utils.decode(r)
+    return r
+
+def then(f, func):
+    """\internal
+    \brief Returns a future whose result is func applied to the result of f
+    """
+    r = concurrent.futures.Future()
+    def done(f):
+        try:
+            r.set_result(func(f.result()))
+        except Exception as e:
+            r.set_exception(e)
+    f.add_done_callback(done)
+    return r
+
+def inThread(func, *args):
+    """\internal
+    \brief Returns a future whose result is that of calling func in a new thread
+
+    Without pipelining a connection can only have one request outstanding, so this is used to send one without
+    waiting for the reply. The thread gets a connection of its own.
+    """
+    f = concurrent.futures.Future()
+    def run():
+        try:
+            f.set_result(func(*args))
+        except Exception as e:
+            f.set_exception(e)
+    t = threading.Thread(target=run)
+    t.daemon = True
+    t.start()
+    return f
+
 def message(*msg):
     """\internal
     \brief Send the given message to the local server
@@ -240,24 +550,38 @@ def message(*msg):
     if not _connected:
         raise NotConnected
 
+    if sys.is_finalizing() and not run_as_server and not hasattr(threading.current_thread(), "pylinda_con"):
+        # no new connection can be made as the interpreter exits, so a reference dropped by a thread that has
+        # disconnected isn't reported
+        return None
+
     if run_as_server:
         msg_semaphore.acquire()
     try:
         s = getSocket()
+        if isinstance(s, Pipeline):
+            f = s.request(*msg)
+            if sys.is_finalizing():
+                # the thread reading the replies has been stopped, so a reference dropped as the interpreter exits is
+                # sent without waiting for the reply
+                return None
+            return f.result()
         try:
-            utils.send(s, None, None, utils.encode(msg))
+            utils.send(s, None, None, pack(msg, s))
         except socket.error as xxx_todo_changeme:
             (n, msg) = xxx_todo_changeme.args
             if msg == "Broken Pipe":
                 print("Broken Pipe")
             else:
                 raise
-        return utils.recv(s)[1]
+        r = utils.recv(s)[1]
+        if r == not_durable:
+            raise NotDurable("The server couldn't write the change to disk")
+        return r
     finally:
         if run_as_server:
              msg_semaphore.release()
 
-import sys
 class _Process:
     """\internal
     \brief Connect to local server
@@ -279,13 +603,12 @@ class _Process:
                 s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 s.connect(("127.0.0.1", port))
 
-        obj = threading.currentThread()
+        s = beginSession(s)
+        obj = threading.current_thread()
         obj.pylinda_con = None, s
 
         _connected = True
 
-        message(begin_session)
-
         if not run_as_server:
             process_id = message(register_process)
             thread_id = message(register_thread, process_id)
@@ -296,7 +619,7 @@ class _Process:
 def getThreadId():
     if run_as_server:
         return "0!0!0"
-    obj = threading.currentThread()
+    obj = threading.current_thread()
     if hasattr(obj, "pylinda_con"):
         return obj.pylinda_con[0]
     else:
@@ -306,14 +629,14 @@ def getThreadId():
 def getSocket():
     if run_as_server:
         return s
-    obj = threading.currentThread()
+    obj = threading.current_thread()
     if hasattr(obj, "pylinda_con"):
         return obj.pylinda_con[1]
     else:
         soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         soc.connect(("127.0.0.1", port))
+        soc = beginSession(soc)
         obj.pylinda_con = None, soc
-        message(begin_session)
         thread_id = message(register_thread, process_id)
         obj.pylinda_con = thread_id, obj.pylinda_con[1] #thread_connection[thread.get_ident()][1]
         return soc
@@ -332,7 +655,7 @@ def connect(cport=2102):
 
 def disconnect():
     message(unregister_thread)
-    obj = threading.currentThread()
+    obj = threading.current_thread()
     if hasattr(obj, "pylinda_con"):
         obj.pylinda_con[1].close()
         delattr(obj, "pylinda_con")
@@ -355,4 +678,9 @@ uts = universe
 # These options control whether we want to use Unix Domain sockets or Shared Memory
 use_domain = True
 use_shm = True
+# Whether to ask the server to let each connection have several requests outstanding at once
+use_pipelining = True
+# Whether to encode messages to the server with the codec module rather than pickling them. A server started with
+# --no-pickle only accepts connections that do.
+use_codec = False
 
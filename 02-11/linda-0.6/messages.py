@@ -26,6 +26,7 @@ dont_know = "dont_know" # Don't know the answer
 
 register_process = "register_process" # Sent by a client process to get an id
 register_thread = "register_thread" # Sent by a client thread to get an id
+register_waiter = "register_waiter" # Sent by a client thread to get an id to wait on, so it can block on several rd/ins
 unregister_thread = "unregister_thread" # Sent by a client thread to get an id
 unregister_process = "unregister_process" # Sent by a client just before it disconnects
 
@@ -41,9 +42,14 @@ get_node_id = "get_node_id" # Asks the destination server what it's id is
 read_tuple = "read_tuple" # Sent by a client process to read a tuple
 in_tuple = "in_tuple" # Sent by a client process to in a tuple
 out_tuple = "out_tuple" # Sent by a client process to out a tuple
+out_many = "out_many" # Sent by a client process to out several tuples at once
+rd_many = "rd_many" # Sent by a client process to read several tuples at once
+in_many = "in_many" # Sent by a client process to in several tuples at once
+tuplespace_full = "tuplespace_full" # Return message when a tuple can't be output because the tuplespace is full
 unblock = "unblock" # Return message to unblock a client process
 
 return_tuple = "return_tuple" # Return message when a tuple is being returned
+return_tuples = "return_tuples" # Return message carrying tuples for several processes on one server
 
 collect = "collect" # Sent by a client process to collect tuples
 copy_collect = "copy_collect" # Sent by a client process to copy tuples
@@ -54,20 +60,29 @@ increment_ref = "increment_ref" # Sent to increment the reference count of a tup
 decrement_ref = "decrement_ref" # Sent to decrement the reference count of a tuple space
 
 get_references = "get_references" # Get all references to a tuplespace
+get_reference_graph = "get_reference_graph" # Get all references to several tuplespaces on one server
 get_neighbours = "get_neighbours" # Get all neighbours to a server
 know_server = "know_server" # Asks whether the server knows the details for a server
 get_blocked_list = "get_blocked_list" # Get all processes blocked on a tuplespace
+get_graph = "get_graph" # Get the references and blocked processes of a tuplespace, if they have changed
 get_threads = "get_threads" # Get all threads in a process
 
 get_stats = "get_stats" # Get the stats for a server
 
+# What to do when a tuple is output to a tuplespace that is full
+block_when_full = "block_when_full" # Wait until a tuple is removed
+fail_when_full = "fail_when_full" # Raise TupleSpaceFull
+evict_when_full = "evict_when_full" # Remove the oldest tuple
+
 not_permitted = "not_permitted" # Action not permitted (not currently used - reserved for capablity linda)
+not_durable = "not_durable" # Return message when a change couldn't be written to a durable server's operation log
 
 kill_server = "kill_server"
 
 support_domain = "support_domain"
 support_shm = "support_shm"
 begin_session = "begin_session"
+pipelined = "pipelined" # Reply to a begin_session that asked for requests to be tagged with ids
 
 yes = "yes"
 no = "no"
@@ -105,7 +105,13 @@ class Thread(threading.Thread):
             except KeyError:
                 print "No such tuplespace"
                 return
-            ts.lock.acquire()
+            usage = ts.memoryUsage()
+            print "Memory: %i tuples, %i bytes (%i in memory)" % (usage["tuples"], usage["bytes"], usage["resident_bytes"])
+            names = usage["signatures"].keys()
+            names.sort()
+            for name in names:
+                print "    %s: %i tuples, %i bytes" % ((name, ) + usage["signatures"][name])
+            locks = ts.acquireAll()
             try:
                 print "References:", ts.refs
                 print "Blocked:", ts.blocked_list
@@ -113,7 +119,7 @@ class Thread(threading.Thread):
                 for t in ts.ts.matchAllTuples():
                      print str(t)+" ",
             finally:
-                ts.lock.release()
+                ts.releaseAll(locks)
             print ""
         elif command[0] == "route":
             ns = connections.neighbours.keys()
@@ -23,6 +23,7 @@
 
 from optparse import OptionParser
 import sys
+import tempfile
 
 def getOptions():
     """\internal
@@ -56,6 +57,38 @@ def getOptions():
     parser.add_option("-d", "--disable-domain", default=True, action="store_false", dest="use_domain",
                       help="Disable the use of Unix Domain Sockets")
 
+    parser.add_option("--asyncio", default=False, action="store_true", dest="use_asyncio",
+                      help="Handle every connection on a single event loop, rather than with a thread each")
+
+    parser.add_option("--socket-buffer", type="int", dest="socket_buffer", default=None,
+                      help="Set the kernel's send and receive buffers for each connection to SOCKET_BUFFER kilobytes. "\
+                           "Default: the system's default")
+
+    parser.add_option("--no-pickle", default=False, action="store_true", dest="no_pickle",
+                      help="Refuse pickled messages, so nothing a client sends can run code on the server. Only "\
+                           "clients that encode their messages (linda.kernel.use_codec) can connect, and no other "\
+                           "server can join this one")
+
+    parser.add_option("--deadlock-interval", type="float", dest="deadlock_interval", default=1.0,
+                      help="How often, in seconds, to check tuplespaces that have changed for deadlocks. (default: 1)")
+
+    parser.add_option("--gc-interval", type="float", dest="gc_interval", default=1.0,
+                      help="How often, in seconds, to look for tuplespaces that are no longer needed. (default: 1)")
+
+    parser.add_option("--durable", type="string", dest="durable", default=None,
+                      help="Keep the tuplespaces in the directory DURABLE, so they survive the server being restarted")
+
+    parser.add_option("--snapshot-interval", type="float", dest="snapshot_interval", default=300.0,
+                      help="How often, in seconds, to write a snapshot of a durable server's tuplespaces. (default: 300)")
+
+    parser.add_option("--memory-budget", type="int", dest="memory_budget", default=None,
+                      help="Move tuples that haven't been used recently to disk when the tuples in memory take up more "\
+                           "than MEMORY_BUDGET megabytes")
+
+    parser.add_option("--spill-dir", type="string", dest="spill_dir", default=tempfile.gettempdir(),
+                      help="The directory to move tuples to when over the memory budget. (default: %s)" % \
+                           (tempfile.gettempdir(), ))
+
     parser.add_option("-D", "--daemon", default=False, action="store_true", dest="daemon",
                       help="Disable the interactive shell for the server. Default: Enabled.")
 
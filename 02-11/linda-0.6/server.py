@@ -33,6 +33,12 @@ from .options import getOptions
 from .tscontainer import TupleSpaceContainer
 from .tuplespace import TupleSpace
 from .connections import neighbours, connections, sendMessageToNode, connectTo, broadcast_message, broadcast_firstreplyonly, Connection, getMsgId
+from . import codec
+from . import deadlock
+from . import durability
+from . import framing
+from . import garbage
+from . import spill
 from . import stats
 
 from . import kernel
@@ -51,13 +57,52 @@ pthread_count = {}
 local_ts = TupleSpaceContainer()
 blocked_processes = {}
 
-class LindaConnection(socketserver.BaseRequestHandler):
-    def handle(self):
-        self.request.setblocking(1)
+## \brief Send a tuple to a process blocked on a connection to this server
+## \return True if the process was blocked here and has been sent the tuple, False otherwise
+## \param tid The thread id of the blocked process
+## \param tup The pickled tuple
+## \brief Stop waiting for the reply to a blocked process's rd or in, as it is about to be sent
+## \return The connection, its semaphore and the msgid of the request, or None if the process isn't blocked on this
+## server
+def takeBlocked(tid):
+    return blocked_processes.pop(tid, None)
+
+def deliverTuple(tid, tup):
+    waiter = takeBlocked(tid)
+    if waiter is None:
+        return False
+    s, semaphore, msgid = waiter
+    semaphore.acquire()
+    try:
+        utils.send(s, None, msgid, utils.repack(s, tup))
+    finally:
+        semaphore.release()
+    return True
+
+## \brief Returns the references to the given tuplespaces on this server
+## \return A dictionary mapping each tuplespace id to a list of the ids that reference it
+## \param tss A list of tuplespace ids
+def getReferenceGraph(tss):
+    refs = {}
+    for ts in tss:
+        try:
+            ts_obj = local_ts[ts]
+        except KeyError: # the tuplespace has been deleted, so nothing references it
+            refs[ts] = []
+            continue
+        ts_obj.ref_semaphore.acquire()
+        try:
+            refs[ts] = list(ts_obj.refs)
+        finally:
+            ts_obj.ref_semaphore.release()
+    return refs
 
+class LindaConnection(socketserver.BaseRequestHandler):
+    def setup(self):
         self.messages = {
             register_process: self.register_process,
             register_thread: self.register_thread,
+            register_waiter: self.register_waiter,
             unregister_thread: self.unregister_thread,
             unregister_process: self.unregister_process,
             my_name_is: self.my_name_is,
@@ -68,52 +113,54 @@ class LindaConnection(socketserver.BaseRequestHandler):
             read_tuple: self.read_tuple,
             in_tuple: self.in_tuple,
             out_tuple: self.out_tuple,
+            out_many: self.out_many,
+            rd_many: self.rd_many,
+            in_many: self.in_many,
             unblock: self.unblock,
             return_tuple: self.return_tuple,
+            return_tuples: self.return_tuples,
             collect: self.collect,
             copy_collect: self.copy_collect,
             multiple_in: self.multiple_in,
             increment_ref: self.increment_ref,
             decrement_ref: self.decrement_ref,
             get_references: self.get_references,
+            get_reference_graph: self.get_reference_graph,
             get_neighbours: self.get_neighbours,
             get_blocked_list: self.get_blocked_list,
+            get_graph: self.get_graph,
             get_threads: self.get_threads,
             kill_server: self.kill_server,
             }
 
-        # check that the connection comes from an allowed source
-        if not isinstance(self.request, Connection) and self.server.allowed_peers:
-            ok = False
-            for addr in self.server.allowed_peers:
-                if self.verify_address(addr):
-                    ok = True
-                    break
-            if not ok:
-                print("DENIED ACCESS FROM", self.client_address)
-                self.request.shutdown(1)
-                self.request.close()
-                return
-
         self.other_pid = None
         self.other_tid = None
         self.other_nid = None
         self.semaphore = threading.Semaphore()
+        self.pipelined = False # true if every request and reply is tagged with the request's id
+        self.key = None # our key in the connections dictionary, once the session has begun
 
-        if not isinstance(self.request, Connection):
-            # Here we decide if we can use a better form of communication
-            while True:
-                msgid, message = utils.recv(self.request)
-                m = utils.decode(message)
-                if m[0] == begin_session:
-                    utils.send(self.request, None, msgid, done)
-                    break
+    def handle(self):
+        self.request.setblocking(1)
 
-                else:
-                    print("Unknown Session Setup Message: %s" % (m[0], ))
-                    utils.send(self.request, None, msgid, dont_know)
+        # check that the connection comes from an allowed source
+        if not isinstance(self.request, Connection) and not self.allowed():
+            print("DENIED ACCESS FROM", self.client_address)
+            self.request.shutdown(1)
+            self.request.close()
+            return
+
+        if not isinstance(self.request, Connection):
+            self.request = codec.Framed(self.request, codec.accept_pickle)
+            try:
+                self.beginSession()
+            except codec.CodecError as e:
+                print("REFUSED MESSAGE FROM", self.client_address, e)
+                self.request.close()
+                return
 
-        connections[_thread.get_ident()] = self.request
+        self.key = _thread.get_ident()
+        connections[self.key] = self.request
 
         while True:
             self.semaphore.release()
@@ -125,20 +172,30 @@ class LindaConnection(socketserver.BaseRequestHandler):
             except socket.error as msg:
                 # should we do something other than silently pass this error?
                 message = ""
+            except codec.CodecError as e:
+                print("REFUSED MESSAGE FROM", self.client_address, e)
+                break
             self.semaphore.acquire()
 
             # when a connection is broken a zero length string is returned from self.request.recv
             if not message:
                 break
 
+            if self.pipelined:
+                msgid, message = message
+
             try:
-                m = utils.decode(message)
+                # encoded messages hold the message itself, pickled ones pickle it a second time
+                m = message if type(message) is tuple else self.decode(message)
+            except codec.CodecError as e:
+                print("REFUSED MESSAGE FROM", self.client_address, e)
+                break
             except:
                 print(repr(message))
                 raise
 
             if m[0] == close_connection:
-                 utils.send(self.request, None, msgid, ok)
+                 utils.send(self.request, None, msgid, done)
                  self.request.close()
                  break
 
@@ -149,12 +206,15 @@ class LindaConnection(socketserver.BaseRequestHandler):
 
             del m
 
-        print("closing connection", self.other_tid or self.other_nid)
-        del connections[_thread.get_ident()]
-
         self.request.close()
 
+    def finish(self):
         # Once a connection is broken we end up here
+        if self.key is None: # the session never began
+            return
+        print("closing connection", self.other_tid or self.other_nid)
+        del connections[self.key]
+
         #if self.other_pid is not None:
         #    # When a process disconnects ensure that all their references are removed
         #    removeProcess(self.other_pid)
@@ -171,6 +231,50 @@ class LindaConnection(socketserver.BaseRequestHandler):
         if self.other_nid is not None:
             stats.dec_stat("server_con_current")
 
+    ## \brief Returns true if the connection comes from an allowed source
+    def allowed(self):
+        if not self.server.allowed_peers:
+            return True
+        for addr in self.server.allowed_peers:
+            if self.verify_address(addr):
+                return True
+        return False
+
+    ## \brief Wait for the other end to begin the session
+    def beginSession(self):
+        # Here we decide if we can use a better form of communication
+        while True:
+            msgid, message = utils.recv(self.request)
+            m = message if type(message) is tuple else self.decode(message)
+            if m[0] == begin_session:
+                if len(m) > 2 and codec.negotiate(m[2]) is not None:
+                    # the other end encodes its messages, and wants the replies encoded too
+                    self.request.use(codec.negotiate(m[2]))
+                if len(m) > 1 and m[1]:
+                    # the other end wants to have several requests outstanding at once
+                    self.pipelined = True
+                    utils.send(self.request, None, msgid, pipelined)
+                else:
+                    utils.send(self.request, None, msgid, done)
+                break
+
+            else:
+                print("Unknown Session Setup Message: %s" % (m[0], ))
+                utils.send(self.request, None, msgid, dont_know)
+
+    ## \brief Returns the value in data sent by the other end, refusing pickles if the server was started with --no-pickle
+    def decode(self, data):
+        if isinstance(self.request, codec.Framed):
+            return self.request.decode(data)
+        return utils.decode(data)
+
+    ## \brief Returns the tuple, or list of tuples, in an out_tuple or out_many message. Pickled messages hold them
+    ## pickled, encoded ones hold them as they are.
+    def decodeTuples(self, data):
+        if type(data) is bytes:
+            return self.decode(data)
+        return data
+
     def verify_address(self, addr):
         flds = addr.split("/")
         addr = flds[0]
@@ -186,9 +290,15 @@ class LindaConnection(socketserver.BaseRequestHandler):
     def handle_msg(self, msgid, message, data):
         try:
             self.messages[message](msgid, message, data)
+        except codec.CodecError as e:
+            print("Refused Message: %s (%s)" % (message, e))
+            utils.send(self.request, None, msgid, not_permitted)
+        except durability.LogError as e:
+            print("Failed Message: %s (%s)" % (message, e))
+            utils.send(self.request, None, msgid, not_durable)
         except KeyError:
             print("Unknown Message: %s (%s)" % (message, str(data)))
-            if msgid is None: # if this has a msgid it may have been forwarded by the other node
+            if not isinstance(msgid, tuple): # if this has a msgid it may have been forwarded by the other node
                 node = self.other_nid
             else:
                 node = msgid[0]
@@ -270,6 +380,12 @@ class LindaConnection(socketserver.BaseRequestHandler):
         stats.inc_stat("process_con_current")
         stats.inc_stat("process_con_total")
 
+    def register_waiter(self, msgid, message, data):
+        # A pipelined thread blocks on several rd/ins at once under ids of their own. They aren't threads of the
+        # process, so they don't stop a deadlock being found while the thread that made them is blocked too.
+        p_id = data[0]
+        utils.send(self.request, None, msgid, "%s!%i" % (p_id, next(pthread_count[p_id])))
+
     def unregister_thread(self, msgid, message, data):
         # if a process is about to disconnect they can let us know first
         # removeProcess removes any references held by the process
@@ -311,32 +427,93 @@ class LindaConnection(socketserver.BaseRequestHandler):
         # return a new tuplespace id
         ts = "%i:%i" % (node_id, next(ts_ids))
 
-        local_ts.newTupleSpace(ts)
+        local_ts.newTupleSpace(ts, *data) # data holds the capacity of the tuplespace, if one was given
         utils.send(self.request, None, msgid, ts)
 
     def out_tuple(self, msgid, message, data):
-        # output a tuple into a tuplespace
-        ts, tup = data
+        # output a tuple into a tuplespace, with the number of seconds it may live for if it has a lease
+        ts, tup, ttl = data
 
         assert utils.isTupleSpaceId(ts)
 
         if ts in local_ts:
             # we own the given tuplespace - drop the tuple into it
-            tup = utils.decode(tup)
+            tup = self.decodeTuples(tup)
             utils.containsTS(tup, lambda t: utils.changeOwner(t, ts))
 
-            local_ts[ts]._out(tup)
+            try:
+                local_ts[ts]._out(tup, ttl)
+            except kernel.TupleSpaceFull:
+                utils.send(self.request, None, msgid, tuplespace_full)
+                return
             stats.inc_stat("message_out_total")
 
             utils.send(self.request, None, msgid, done)
         else:
-            utils.send(self.request, None, msgid, sendMessageToNode(utils.getNodeFromTupleSpaceId(ts), None, out_tuple, ts, tup))
+            utils.send(self.request, None, msgid, sendMessageToNode(utils.getNodeFromTupleSpaceId(ts), None, out_tuple, ts, tup, ttl))
+
+    def out_many(self, msgid, message, data):
+        # output several tuples into a tuplespace, replying with the number that were accepted
+        ts, tups, ttl = data
+
+        assert utils.isTupleSpaceId(ts)
+
+        if ts in local_ts:
+            tups = self.decodeTuples(tups)
+            for tup in tups:
+                utils.containsTS(tup, lambda t: utils.changeOwner(t, ts))
+
+            accepted = local_ts[ts]._out_many(tups, ttl)
+            stats.add_stat("message_out_total", accepted)
+
+            utils.send(self.request, None, msgid, str(accepted))
+        else:
+            utils.send(self.request, None, msgid, sendMessageToNode(utils.getNodeFromTupleSpaceId(ts), None, out_many, ts, tups, ttl))
+
+    def rd_many(self, msgid, message, data):
+        self.take_many(msgid, message, data, "_rd_many", "message_rd_total")
+
+    def in_many(self, msgid, message, data):
+        self.take_many(msgid, message, data, "_in_many", "message_in_total")
+
+    def take_many(self, msgid, message, data, method, stat):
+        # handles rd_many and in_many, which block like read_tuple and in_tuple if nothing matches
+        ts, template, tid, max_n = data
+
+        if type(max_n) is not int or max_n < 1:
+            # nothing would be returned, so the process would block and then be sent a tuple it didn't ask for
+            utils.send(self.request, None, msgid, not_permitted)
+            return
+
+        if self.other_tid is not None:
+            blocked_processes[tid] = (self.request, self.semaphore, msgid)
+
+        assert utils.isTupleSpaceId(ts)
+
+        if ts in local_ts:
+            r = getattr(local_ts[ts], method)(tid, template, max_n)
+            stats.inc_stat(stat)
+
+            if r is not None and self.other_tid is not None:
+                del blocked_processes[tid]
+                utils.send(self.request, None, msgid, utils.pack(self.request, r))
+            elif r is None and self.other_tid is None:
+                # if we're talking to another server tell them we're done
+                utils.send(self.request, None, msgid, done)
+            elif r is not None and self.other_tid is None:
+                utils.send(self.request, None, msgid, utils.pack(self.request, r))
+        else:
+            def forward_message():
+                r = sendMessageToNode(utils.getNodeFromTupleSpaceId(ts), None, message, ts, template, tid, max_n)
+                if r != done:
+                    utils.send(self.request, None, msgid, utils.repack(self.request, r))
+            threading.Thread(target=forward_message,args=()).start()
 
     def read_tuple(self, msgid, message, data):
         ts, template, tid, unblockable = data
 
         if self.other_tid is not None:
-            blocked_processes[self.other_tid] = (self.request, self.semaphore)
+            blocked_processes[tid] = (self.request, self.semaphore, msgid)
 
         assert utils.isTupleSpaceId(ts)
 
@@ -345,19 +522,19 @@ class LindaConnection(socketserver.BaseRequestHandler):
             stats.inc_stat("message_rd_total")
 
             if r is not None and self.other_tid is not None:
-                del blocked_processes[self.other_tid]
-                utils.send(self.request, None, msgid, r)
+                del blocked_processes[tid]
+                utils.send(self.request, None, msgid, utils.pack(self.request, r))
             elif r is None and self.other_tid is None:
                 # if we're talking to another server tell them we're done
                 utils.send(self.request, None, msgid, done)
             elif r is not None and self.other_tid is None:
                 # if we're talking to another server tell the tuple we've found
-                utils.send(self.request, None, msgid, r)
+                utils.send(self.request, None, msgid, utils.pack(self.request, r))
         else:
             def forward_message():
                 r = sendMessageToNode(utils.getNodeFromTupleSpaceId(ts), None, read_tuple, ts, template, tid, unblockable)
                 if r != done:
-                    utils.send(self.request, None, msgid, r)
+                    utils.send(self.request, None, msgid, utils.repack(self.request, r))
             threading.Thread(target=forward_message,args=()).start()
 
     def in_tuple(self, msgid, message, data):
@@ -366,11 +543,11 @@ class LindaConnection(socketserver.BaseRequestHandler):
         if ts[-1] == "s":
             if int(ts.split(":")[0]) == 0 or int(ts.split(":")[0]) == node_id:
                 r = stats._in(template)
-                utils.send(self.request, None, msgid, r)
+                utils.send(self.request, None, msgid, utils.repack(self.request, r))
             return
 
         if self.other_tid is not None:
-            blocked_processes[self.other_tid] = (self.request, self.semaphore)
+            blocked_processes[tid] = (self.request, self.semaphore, msgid)
 
         assert utils.isTupleSpaceId(ts)
 
@@ -379,14 +556,14 @@ class LindaConnection(socketserver.BaseRequestHandler):
             stats.inc_stat("message_in_total")
 
             if r is not None and self.other_tid is not None:
-                del blocked_processes[self.other_tid]
-                utils.send(self.request, None, msgid, r)
+                del blocked_processes[tid]
+                utils.send(self.request, None, msgid, utils.pack(self.request, r))
             elif r is None and self.other_tid is None:
                 # if we're talking to another server tell them we're done
                 utils.send(self.request, None, msgid, done)
             elif r is not None and self.other_tid is None:
                 # if we're talking to another server tell them we're done
-                utils.send(self.request, None, msgid, r)
+                utils.send(self.request, None, msgid, utils.pack(self.request, r))
             elif r is None and self.other_tid is not None:
                 # we don't have an answer for the process so we finish here and wait for another thread
                 # to send the process a return_tuple message
@@ -397,30 +574,32 @@ class LindaConnection(socketserver.BaseRequestHandler):
             def forward_message():
                 r = sendMessageToNode(utils.getNodeFromTupleSpaceId(ts), None, in_tuple, ts, template, tid, unblockable)
                 if r != done:
-                    utils.send(self.request, None, msgid, r)
+                    utils.send(self.request, None, msgid, utils.repack(self.request, r))
             threading.Thread(target=forward_message,args=()).start()
 
     def return_tuple(self, msgid, message, data):
         tid, tup = data
 
-        if tid in list(blocked_processes.keys()):
-            s, semaphore = blocked_processes[tid]
-            del blocked_processes[tid]
-            semaphore.acquire()
-            utils.send(s, None, None, tup)
-            semaphore.release()
+        if deliverTuple(tid, tup):
             utils.send(self.request, None, msgid, done)
         else:
             utils.send(self.request, None, msgid, sendMessageToNode(utils.getNodeFromThreadId(tid), None, return_tuple, tid, tup))
 
+    def return_tuples(self, msgid, message, data):
+        # return a batch of tuples to processes, sent by another server's delivery pipeline
+        for tid, tup in data[0]:
+            if not deliverTuple(tid, tup):
+                sendMessageToNode(utils.getNodeFromThreadId(tid), None, return_tuple, tid, tup)
+        utils.send(self.request, None, msgid, done)
+
     def unblock(self, msgid, message, data):
         tid = data[0]
 
         if tid in list(blocked_processes.keys()):
-            s, semaphore = blocked_processes[tid]
+            s, semaphore, waiting_msgid = blocked_processes[tid]
             del blocked_processes[tid]
             semaphore.acquire()
-            utils.send(s, None, None, unblock)
+            utils.send(s, None, waiting_msgid, unblock)
             semaphore.release()
             utils.send(self.request, None, msgid, done)
         else:
@@ -434,7 +613,7 @@ class LindaConnection(socketserver.BaseRequestHandler):
                 if dest_ts in local_ts:
                     for t in tups:
                         utils.containsTS(t, lambda x: utils.changeOwner(x, dest_ts))
-                        local_ts[dest_ts]._out(t)
+                        local_ts[dest_ts]._out(t, can_fail=False)
                 else:
                     dest_node = utils.getNodeFromTupleSpaceId(dest_ts)
                     for t in tups:
@@ -452,7 +631,7 @@ class LindaConnection(socketserver.BaseRequestHandler):
                 if dest_ts in local_ts:
                     for t in tups:
                         utils.containsTS(t, utils.changeOwner)
-                        local_ts[dest_ts]._out(t)
+                        local_ts[dest_ts]._out(t, can_fail=False)
 
                 else:
                     dest_node = utils.getNodeFromTupleSpaceId(dest_ts)
@@ -470,7 +649,7 @@ class LindaConnection(socketserver.BaseRequestHandler):
             tups = utils.decode(tups)
             for t in tups:
                 utils.containsTS(t, lambda x: utils.changeOwner(x, ts))
-                local_ts[ts]._out(t)
+                local_ts[ts]._out(t, can_fail=False)
 
                 utils.send(self.request, None, msgid, done)
         else:
@@ -508,7 +687,7 @@ class LindaConnection(socketserver.BaseRequestHandler):
                 ts_obj = local_ts[ts]
                 ts_obj.ref_semaphore.acquire()
                 try:
-                    utils.send(self.request, None, msgid, utils.encode(ts_obj.refs))
+                    utils.send(self.request, None, msgid, utils.encode(list(ts_obj.refs)))
                 finally:
                     ts_obj.ref_semaphore.release()
             else:
@@ -516,6 +695,13 @@ class LindaConnection(socketserver.BaseRequestHandler):
         else:
             utils.send(self.request, None, msgid, sendMessageToNode(utils.getNodeFromTupleSpaceId(ts), None, get_references, ts))
 
+    def get_reference_graph(self, msgid, message, data):
+        node, tss = data
+        if node == node_id:
+            utils.send(self.request, None, msgid, utils.encode(getReferenceGraph(tss)))
+        else:
+            utils.send(self.request, None, msgid, sendMessageToNode(node, None, get_reference_graph, node, tss))
+
     def get_blocked_list(self, msgid, message, data):
                 ts = data[0]
                 if utils.getNodeFromTupleSpaceId(ts) == node_id:
@@ -531,6 +717,21 @@ class LindaConnection(socketserver.BaseRequestHandler):
                 else:
                     utils.send(self.request, None, msgid, sendMessageToNode(utils.getNodeFromTupleSpaceId(ts), None, get_blocked_list, ts))
 
+    def get_graph(self, msgid, message, data):
+        # send the deadlock detector of another server the references and blocked processes of a tuplespace, unless it
+        # already has them from the given epoch
+        ts, epoch = data
+        if utils.getNodeFromTupleSpaceId(ts) == node_id:
+            if ts in local_ts:
+                graph = local_ts[ts].getGraph()
+                if graph[0] == epoch:
+                    graph = (epoch, None, None)
+                utils.send(self.request, None, msgid, utils.encode(graph))
+            else:
+                utils.send(self.request, None, msgid, utils.encode((None, [], [])))
+        else:
+            utils.send(self.request, None, msgid, sendMessageToNode(utils.getNodeFromTupleSpaceId(ts), None, get_graph, ts, epoch))
+
     def get_threads(self, msgid, message, data):
         pid = data[0]
         if utils.getNodeFromProcessId(pid) == node_id:
@@ -603,8 +804,9 @@ def removeProcess(pid, local=True):
         if utils.getProcessIdFromThreadId(tid) == pid:
             del blocked_processes[tid]
 
-    # remove any references the process may have had to our processes
-    for ts in local_ts:
+    # remove any references the process may have had to our tuplespaces, using the index so we only visit those
+    # it actually references
+    for ts in local_ts.referencedBy(pid):
         local_ts.deleteAllReferences(ts, pid)
 
     # if the process was connected to us then broadcast the fact that it has left the system
@@ -633,6 +835,10 @@ def main(connection_class = LindaConnection):
     kernel.run_as_server = True
 
     options = getOptions()
+    deadlock.detector.interval = options.deadlock_interval
+    garbage.collector.interval = options.gc_interval
+    if options.memory_budget is not None:
+        spill.manager.start(options.memory_budget * 1024 * 1024, options.spill_dir)
 
     if options.peer:
         options.peer.append("127.0.0.1") # always allow local connections.
@@ -649,20 +855,48 @@ def main(connection_class = LindaConnection):
             sys.exit(0)
         return addr+"/"+r
 
-    server = LindaServer((options.bindaddress, options.port),
-                          connection_class,
-                          list(map(lookupname, options.peer)))
-
-    try:
-        from . import domain_socket
-    except ImportError:
-        pass
+    if options.socket_buffer is not None:
+        framing.socket_buffer_size = options.socket_buffer * 1024
+
+    if options.no_pickle:
+        codec.accept_pickle = False
+        kernel.use_codec = True # the server's own connection to itself mustn't be refused
+
+    if options.connect == "":
+        # the tuplespaces are recovered before we start listening, so no process can use one that is half loaded
+        if options.durable:
+            ts_ids.counter = durability.enable(options.durable, local_ts, node_id, options.snapshot_interval)
+        if "0:0" not in local_ts:
+            local_ts.newTupleSpace("0:0")
+
+    if options.use_asyncio:
+        # the Unix domain socket is served by the same event loop
+        from . import aioserver
+        server = aioserver.AsyncLindaServer((options.bindaddress, options.port),
+                                            aioserver.AsyncLindaConnection,
+                                            list(map(lookupname, options.peer)),
+                                            options.use_domain and hasattr(socket, "AF_UNIX") and "/tmp/pylinda" or None)
     else:
-        if options.use_domain:
-            domain_server = domain_socket.LindaDomainServer("/tmp/pylinda", connection_class, [])
-            threading.Thread(target=domain_server.serve_forever, args=()).start()
+        server = LindaServer((options.bindaddress, options.port),
+                              connection_class,
+                              list(map(lookupname, options.peer)))
+
+        try:
+            from . import domain_socket
+        except ImportError:
+            pass
+        else:
+            if options.use_domain:
+                domain_server = domain_socket.LindaDomainServer("/tmp/pylinda", connection_class, [])
+                threading.Thread(target=domain_server.serve_forever, args=()).start()
 
     if options.connect != "":
+        if options.durable:
+            print("Only a server that doesn't connect to another can be durable, so --durable is ignored")
+        if options.no_pickle:
+            print("Servers talk to each other with pickled messages, so a server started with --no-pickle can't connect to another")
+            sys.exit(-1)
+
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
             s.connect((options.connect, options.connectport))
@@ -687,8 +921,6 @@ def main(connection_class = LindaConnection):
         server.process_request(s, (options.connect, options.connectport))
 
         neighbours[node] = s
-    else:
-        local_ts.newTupleSpace("0:0")
 
     # import the kernel
     KernelImport().start()
@@ -0,0 +1,229 @@
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+## \namespace spill
+## \brief This module moves tuples that haven't been used recently to disk when the server is short of memory
+## \internal
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+
+import copyreg
+import io
+import itertools
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import traceback
+
+from . import kernel
+from . import stats
+from .tuplespace import ImmutableList
+
+## \class SpillStore
+## \internal
+## \brief Holds the tuples of spilled stripes in an sqlite database.
+##
+## The database only lives as long as the server, so it is written without a journal or syncing. Tuples are pickled
+## as they are stored in the tuplespace, with ImmutableLists kept as they are rather than turned back into lists.
+## Tuplespace references aren't written to disk at all, as dropping them would drop the references they hold. Instead
+## they are kept in memory, and the pickled tuples just hold a number identifying them.
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+class SpillStore:
+    def __init__(self, filename):
+        if os.path.exists(filename):
+            os.remove(filename)
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE tuples (key INTEGER, data BLOB)")
+        self.db.execute("CREATE INDEX tuples_key ON tuples (key)")
+
+        self.semaphore = threading.Semaphore()
+        self.keys = itertools.count(1)
+        self.references = {} # key -> {number: tuplespace reference}, for the references in the key's tuples
+        self.forgotten = [] # keys whose stripes have been deleted, see forget
+
+        self.dispatch = copyreg.dispatch_table.copy()
+        self.dispatch[ImmutableList] = lambda l: (ImmutableList, (l.t, ))
+
+    def encode(self, key, tup):
+        f = io.BytesIO()
+        p = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+        p.dispatch_table = self.dispatch
+        references = self.references.setdefault(key, {})
+        def persistent_id(obj):
+            if isinstance(obj, kernel.TupleSpace):
+                references[id(obj)] = obj
+                return id(obj)
+            return None
+        p.persistent_id = persistent_id
+        p.dump(tup)
+        return f.getvalue()
+
+    def decode(self, key, data):
+        u = pickle.Unpickler(io.BytesIO(data))
+        references = self.references.get(key, {})
+        u.persistent_load = references.__getitem__
+        return u.load()
+
+    ## \brief Store a list of tuples
+    ## \return The key they are stored under
+    def write(self, tuples):
+        self.semaphore.acquire()
+        try:
+            key = next(self.keys)
+            self.db.executemany("INSERT INTO tuples VALUES (?, ?)", [(key, self.encode(key, tup)) for tup in tuples])
+            self.db.commit()
+            return key
+        finally:
+            self.semaphore.release()
+
+    ## \brief Add a tuple to those stored under a key
+    def append(self, key, tup):
+        self.semaphore.acquire()
+        try:
+            self.db.execute("INSERT INTO tuples VALUES (?, ?)", (key, self.encode(key, tup)))
+            self.db.commit()
+        finally:
+            self.semaphore.release()
+
+    ## \brief Returns the tuples stored under a key
+    def read(self, key):
+        self.semaphore.acquire()
+        try:
+            rows = self.db.execute("SELECT data FROM tuples WHERE key = ?", (key, )).fetchall()
+            return [self.decode(key, row[0]) for row in rows]
+        finally:
+            self.semaphore.release()
+
+    ## \brief Returns the tuples stored under a key, and deletes them from disk
+    def take(self, key):
+        tuples = self.read(key)
+        self.drop(key)
+        stats.inc_stat("spill_faults")
+        return tuples
+
+    ## \brief Delete the tuples stored under a key
+    def drop(self, key):
+        self.semaphore.acquire()
+        try:
+            self.db.execute("DELETE FROM tuples WHERE key = ?", (key, ))
+            self.db.commit()
+            self.references.pop(key, None)
+        finally:
+            self.semaphore.release()
+
+    ## \brief Mark the tuples stored under a key to be deleted later by purge
+    ##
+    ## This is called when a spilled stripe is garbage collected, which can happen at any time, even while this thread
+    ## is using the store, so it mustn't wait for the semaphore.
+    def forget(self, key):
+        self.forgotten.append(key)
+
+    ## \brief Delete the tuples of the stripes passed to forget
+    def purge(self):
+        while len(self.forgotten) > 0:
+            self.drop(self.forgotten.pop())
+
+## \class MemoryManager
+## \internal
+## \brief Keeps the estimated size of the tuples held in memory below a budget by spilling stripes to disk.
+##
+## Every interval seconds the manager adds up the estimated size of the stripes of every tuplespace on this server.
+## If the total is over the budget then the stripes that have gone longest without being used are written to disk,
+## oldest first, until the total is below low_water times the budget. Stripes are chosen by when they were last used
+## so the coordination tuples that are in constant use stay in memory, while the tuples nobody has looked at for a
+## while go to disk. Each stripe is read back in the first time it is needed.
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+class MemoryManager:
+    def __init__(self, interval=1.0, low_water=0.8):
+        self.interval = interval
+        self.low_water = low_water
+
+        self.budget = None
+        self.store = None
+
+    ## \brief Start keeping the size of the tuples below a budget
+    ## \param budget The budget in bytes
+    ## \param directory The directory to put the spilled tuples in
+    def start(self, budget, directory):
+        self.budget = budget
+        self.store = SpillStore(os.path.join(directory, "pylinda-spill-%i.db" % (os.getpid(), )))
+
+        t = threading.Thread(target=self.run, name="memory-manager")
+        t.daemon = True
+        t.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.store.purge()
+                self.check()
+            except:
+                # an error in one check must not stop us checking in future
+                traceback.print_exc()
+
+    ## \brief Spill stripes to disk if we're over budget
+    ## \return The estimated number of bytes freed
+    def check(self):
+        from . import server
+
+        stripes = []
+        total = 0
+        for ts_id in server.local_ts:
+            try:
+                ts = server.local_ts.ts[ts_id] # not local_ts[ts_id], which would read back a spilled tuplespace
+            except KeyError: # the tuplespace was deleted while we were looking
+                continue
+            container = ts.ts
+            if container is None: # garbage collected
+                continue
+            for accessed, size, stripe in container.residentStripes():
+                stripes.append((accessed, size, ts, stripe))
+                total += size
+
+        stats.set_stat("memory_resident_bytes", total)
+        if total <= self.budget:
+            return 0
+
+        stripes.sort(key=lambda s: s[0])
+        freed = 0
+        for accessed, size, ts, stripe in stripes:
+            if total - freed <= self.budget * self.low_water:
+                break
+            locks = ts.acquire([stripe])
+            try:
+                if ts.ts is not None:
+                    freed += ts.ts.spill(stripe, self.store)
+                    stats.inc_stat("spill_stripes")
+            finally:
+                ts.release(locks)
+
+        stats.set_stat("memory_resident_bytes", total - freed)
+        return freed
+
+## The memory manager for this server, which does nothing unless it is started
+manager = MemoryManager()
@@ -25,6 +25,16 @@ from . import utils
 def _in(tup):
     if tup[0] == "mem":
         return utils.encode((tup[0], ) + getMemSize())
+    elif tup[0] == "signatures":
+        return utils.encode((tup[0], getSignatureCounts()))
+    elif tup[0] == "locks":
+        return utils.encode((tup[0], getLockStats()))
+    elif tup[0] == "expired":
+        return utils.encode((tup[0], getExpiredCounts()))
+    elif tup[0] == "memory":
+        return utils.encode((tup[0], getMemoryUsage()))
+    elif tup[0] == "connections":
+        return utils.encode((tup[0], getConnectionStats()))
     else:
         return utils.encode((tup[0], getstat(tup[0])))
 
@@ -42,12 +52,89 @@ def inc_stat(stat):
     except KeyError:
         stats[stat] = 1
 
+def add_stat(stat, value):
+    try:
+        stats[stat] += value
+    except KeyError:
+        stats[stat] = value
+
 def dec_stat(stat):
     try:
         stats[stat] -= 1
     except KeyError:
         stats[stat] = 0
 
+def set_stat(stat, value):
+    stats[stat] = value
+
+def getSignatureCounts():
+    """\internal
+    \brief Returns the number of tuples held with each type signature, for each local tuplespace
+    """
+    from . import server
+
+    counts = {}
+    for ts in server.local_ts:
+        try:
+            counts[ts] = server.local_ts[ts].signatureCounts()
+        except KeyError: # the tuplespace was deleted while we were looking
+            pass
+    return counts
+
+def getLockStats():
+    """\internal
+    \brief Returns how often operations have waited for locks, and for how long, for each local tuplespace
+    """
+    from . import server
+
+    waits = {}
+    for ts in server.local_ts:
+        try:
+            waits[ts] = server.local_ts[ts].lockStats()
+        except KeyError: # the tuplespace was deleted while we were looking
+            pass
+    return waits
+
+def getMemoryUsage():
+    """\internal
+    \brief Returns the number of tuples held and their estimated size, in total and for each signature, for each local
+    tuplespace
+    """
+    from . import server
+
+    usage = {}
+    for ts in server.local_ts:
+        try:
+            usage[ts] = server.local_ts[ts].memoryUsage()
+        except KeyError: # the tuplespace was deleted while we were looking
+            pass
+    return usage
+
+def getExpiredCounts():
+    """\internal
+    \brief Returns the number of tuples that have been removed because their lease expired, for each local tuplespace
+    """
+    from . import server
+
+    counts = {}
+    for ts in server.local_ts:
+        try:
+            counts[ts] = server.local_ts[ts].expired
+        except KeyError: # the tuplespace was deleted while we were looking
+            pass
+    return counts
+
+def getConnectionStats():
+    """\internal
+    \brief Returns the length of the queue of requests, and how long requests and replies have waited, for each
+    connection to another server
+    """
+    waits = {}
+    for node, s in list(connections.neighbours.items()):
+        if isinstance(s, connections.Connection):
+            waits[node] = s.queueStats()
+    return waits
+
 def getMemSize():
     print("get mem")
     data = open("/proc/%i/stat" % (os.getpid(), ), "r").readline()
@@ -0,0 +1,327 @@
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+## \namespace template
+## \brief This module compiles templates into plans that can be matched against tuples without re-examining the
+## template each time
+## \internal
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+
+import sys
+import threading
+from collections import OrderedDict
+
+# The different kinds of element that can appear in a template
+ACTUAL = 0 # a value, which matches an equal element
+FORMAL = 1 # a class, which matches any element of that class
+SUBTUPLE = 2 # a tuple, which is itself a template for a tuple element
+CONSTRAINT = 3 # a Constraint, which matches any element it accepts
+
+# Elements of these classes can be equal to each other (1 == 1.0 == True), and equal elements are stored under a
+# single key, so the signature recorded for a stored tuple may name any one of them
+_numeric = frozenset((bool, int, float, complex))
+
+class Constraint:
+    """\brief Base class for template elements that match a set of values, rather than one value or a class.
+
+    Constraints are evaluated by the server, so a template using them only returns the tuples that are wanted.
+    """
+    ## If not None the classes that a matching element must be an instance of
+    classes = None
+    ## If not None the only values that can match, so they can be looked up directly
+    values = None
+    ## If not None the ordering ("num" or "str") that can be searched to find matching elements...
+    order = None
+    ## ... and the (low, high) bounds of the search, either of which can be None
+    bounds = (None, None)
+
+    def test(self, value):
+        """\brief Returns True if the given element matches this constraint
+        """
+        raise NotImplementedError
+
+    def _key(self):
+        return ()
+
+    def __eq__(self, other):
+        return self.__class__ is other.__class__ and self._key() == other._key()
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    def __hash__(self):
+        return hash((self.__class__.__name__, self._key()))
+
+    def __repr__(self):
+        return "%s%s" % (self.__class__.__name__, str(self._key()))
+
+class Range(Constraint):
+    """\brief Matches numbers, or strings, x where low <= x < high.
+
+    Either bound may be None, in which case that side of the range is unbounded. The bounds must both be numbers or
+    both be strings, otherwise ValueError is raised.
+    """
+    def __init__(self, low=None, high=None):
+        self.low = low
+        self.high = high
+        if isinstance(low, str) or isinstance(high, str):
+            self.classes = (str, )
+            self.order = "str"
+        else:
+            self.classes = (int, float)
+            self.order = "num"
+        for bound in (low, high):
+            # the server compares the bounds with the elements it holds, so they must be of a class it can order
+            if bound is not None and (not isinstance(bound, self.classes) or bound != bound):
+                raise ValueError("the bounds of a Range must both be numbers or both be strings, not %r and %r"
+                                 % (low, high))
+        self.bounds = (low, high)
+
+    def test(self, value):
+        try:
+            return value.__class__ in self.classes and (self.low is None or value >= self.low) \
+                   and (self.high is None or value < self.high)
+        except TypeError: # an unpickled Range wasn't checked by __init__, and may have bounds that can't be compared
+            return False
+
+    def _key(self):
+        return (self.low, self.high)
+
+class OneOf(Constraint):
+    """\brief Matches an element equal to any one of the given values.
+    """
+    def __init__(self, *values):
+        self.values = values
+        self.valueset = frozenset(values)
+
+    def test(self, value):
+        try:
+            return value in self.valueset
+        except TypeError: # unhashable values can't be in the set
+            return False
+
+    def _key(self):
+        return self.values
+
+class Prefix(Constraint):
+    """\brief Matches strings that start with the given prefix, which must be a string or ValueError is raised.
+    """
+    classes = (str, )
+    order = "str"
+
+    def __init__(self, prefix):
+        if not isinstance(prefix, str):
+            raise ValueError("the prefix of a Prefix must be a string, not %r" % (prefix, ))
+        self.prefix = prefix
+        # the strings starting with the prefix sort before the prefix with its last character incremented
+        stem = prefix.rstrip(chr(sys.maxunicode))
+        if stem == "":
+            self.bounds = (prefix, None)
+        else:
+            self.bounds = (prefix, stem[:-1] + chr(ord(stem[-1]) + 1))
+
+    def test(self, value):
+        try:
+            return value.__class__ is str and value.startswith(self.prefix)
+        except TypeError: # an unpickled Prefix may not have a string prefix
+            return False
+
+    def _key(self):
+        return (self.prefix, )
+
+## The predicates that can be used in a Predicate template element, indexed by name
+predicates = {}
+
+## \brief Register a function that can be used by name in a Predicate template element.
+##
+## The function is called with the element being matched followed by any arguments given to the Predicate, and
+## should return True if the element matches.
+def registerPredicate(name, func):
+    predicates[name] = func
+
+class Predicate(Constraint):
+    """\brief Matches elements accepted by a named predicate, which must be registered on the server with
+    registerPredicate.
+
+    Any extra arguments are passed to the predicate after the element being tested. An unknown predicate, or one that
+    raises an exception, matches nothing.
+    """
+    def __init__(self, name, *args):
+        self.name = name
+        self.args = args
+
+    def test(self, value):
+        try:
+            func = predicates[self.name]
+        except KeyError:
+            return False
+        try:
+            return bool(func(value, *self.args))
+        except Exception: # the element wasn't something the predicate could handle
+            return False
+
+    def _key(self):
+        return (self.name, ) + self.args
+
+## \class Template
+## \internal
+## \brief A compiled template.
+##
+## The template is examined once when the plan is built, recording what kind of element is at each position, so
+## matching a tuple against it is a simple loop with no type checks on the template.
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+class Template:
+    def __init__(self, template):
+        self.template = template
+        self.arity = len(template)
+
+        kinds = []
+        subtemplates = []
+        for ele in template:
+            if type(ele) == tuple:
+                kinds.append(SUBTUPLE)
+                subtemplates.append(Template(ele))
+            elif isinstance(ele, type):
+                kinds.append(FORMAL)
+                subtemplates.append(None)
+            elif isinstance(ele, Constraint):
+                kinds.append(CONSTRAINT)
+                subtemplates.append(None)
+            else:
+                kinds.append(ACTUAL)
+                subtemplates.append(None)
+        self.kinds = tuple(kinds)
+        self.subtemplates = tuple(subtemplates)
+
+        # the formal elements and sub-tuples are the only parts of the template that constrain the classes of a
+        # matching tuple's elements, so these are all that need checking against a type signature
+        self.formals = tuple([(i, template[i]) for i in range(self.arity) if kinds[i] == FORMAL])
+        self.subtuples = tuple([i for i in range(self.arity) if kinds[i] == SUBTUPLE])
+        self.constraints = tuple([(i, template[i].classes) for i in range(self.arity)
+                                  if kinds[i] == CONSTRAINT and template[i].classes is not None])
+
+        # the position of the first actual element is the best place to look a template up in an index, as it
+        # narrows the candidates to those with an equal value
+        self.probe = None
+        for i in range(self.arity):
+            if kinds[i] == ACTUAL:
+                self.probe = i
+                break
+
+        # True if the template contains no formal elements, at any depth, so it can only match a tuple equal to it
+        self.actual = CONSTRAINT not in kinds and len(self.formals) == 0 \
+                      and not [s for s in self.subtemplates if s is not None and not s.actual]
+
+    def __repr__(self):
+        return "<Template %s>" % (str(self.template), )
+
+    ## \brief Returns True if the given tuple matches this template
+    def matches(self, tup):
+        # Check that the tuple is actually a tuple and that the template and tuple are of the same
+        # length (otherwise they obviously can't match.
+        if type(tup) != tuple or len(tup) != self.arity:
+            return False
+        return self.matchesFrom(tup, 0)
+
+    ## \brief Returns True if the given values match the elements of this template from position start onwards
+    def matchesFrom(self, values, start):
+        i = start
+        for value in values:
+            kind = self.kinds[i]
+            ele = self.template[i]
+            if kind == ACTUAL:
+                if ele != value:
+                    return False
+            elif kind == FORMAL:
+                # a formal matches elements of that class, or the class itself
+                if ele is not value.__class__ and ele != value:
+                    return False
+            elif kind == CONSTRAINT:
+                if not ele.test(value):
+                    return False
+            elif not self.subtemplates[i].matches(value):
+                return False
+            i += 1
+        return True
+
+    ## \brief Returns True if a tuple with the given type signature could match this template
+    ##
+    ## Actual values are left to the full match as they compare by equality, which can hold between elements of
+    ## different classes (1 == 1.0). For the same reason numeric classes are treated as interchangeable.
+    def matchesSignature(self, signature):
+        for i, ele in self.formals:
+            cls = signature[i]
+            if not (cls is ele or isinstance(ele, cls) or (cls in _numeric and ele in _numeric)):
+                return False
+        for i in self.subtuples:
+            if signature[i] is not tuple:
+                return False
+        for i, classes in self.constraints:
+            cls = signature[i]
+            if cls not in classes and not (cls in _numeric and not _numeric.isdisjoint(classes)):
+                return False
+        return True
+
+# The compiled templates are kept in a bounded cache, with the least recently used plan thrown away when it is full.
+# Clients tend to reuse the same few templates over and over, so most operations never have to compile a template.
+# Templates that are equal but hold elements of different classes, such as (1, ) and (True, ), must each get a plan of
+# their own, so the classes of the elements are part of the key.
+cache_size = 1024
+_cache = OrderedDict()
+_cache_lock = threading.Semaphore()
+
+def _classes(template):
+    # returns the class of each element of the template, and of the elements of its sub-tuples
+    return tuple([_classes(ele) if type(ele) == tuple else ele.__class__ for ele in template])
+
+## \brief Returns the compiled plan for the given template
+##
+## \param template A template tuple, or a Template which is returned unchanged
+def compileTemplate(template):
+    if isinstance(template, Template):
+        return template
+
+    key = (template, _classes(template))
+    _cache_lock.acquire()
+    try:
+        try:
+            plan = _cache[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # the template contains an unhashable element so we can't cache it
+            return Template(template)
+        else:
+            _cache.move_to_end(key)
+            return plan
+    finally:
+        _cache_lock.release()
+
+    plan = Template(template)
+
+    _cache_lock.acquire()
+    try:
+        _cache[key] = plan
+        while len(_cache) > cache_size:
+            _cache.popitem(last=False)
+    finally:
+        _cache_lock.release()
+
+    return plan
@@ -0,0 +1,108 @@
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+
+## \file
+## \brief Tests for the binary encoding of messages
+
+import pickle
+import unittest
+
+from linda import codec, kernel, template
+from linda.messages import in_tuple, not_durable
+
+class RoundTripTest(unittest.TestCase):
+    def roundTrip(self, value):
+        r = codec.decode(codec.encode(value), allow_pickle=False)
+        self.assertEqual(r, value)
+        self.assertIs(type(r), type(value))
+        return r
+
+    def test_builtin_values(self):
+        for value in [0, -1, 2**63 - 1, -2**63, 2**63, -2**63 - 1, 2**200, 1.5, -0.0, "", "s", "é中", b"",
+                      b"\x00\xff", None, True, False]:
+            self.roundTrip(value)
+
+    def test_containers(self):
+        self.roundTrip(())
+        self.roundTrip([])
+        self.roundTrip({})
+        r = self.roundTrip((1, "a", (2, [3, {"k": (4, )}]), [b"x", None]))
+        self.assertIs(type(r[2][1]), list)
+        self.assertIs(type(r[2][1][1]["k"]), tuple)
+
+    def test_messages_and_classes(self):
+        self.roundTrip((in_tuple, not_durable, "not a message"))
+        self.assertEqual(codec.decode(codec.encode((int, str, bool, type(None), kernel.TupleSpace))),
+                         (int, str, bool, type(None), kernel.TupleSpace))
+
+    def test_constraints(self):
+        for c in [template.Range(1, 5), template.Range(None, 2.5), template.OneOf("a", "b"), template.Prefix("ab")]:
+            r = codec.decode(codec.encode(c), allow_pickle=False)
+            self.assertIs(type(r), type(c))
+            self.assertEqual(r._key(), c._key())
+
+    def test_tuplespaces(self):
+        ts = kernel.TupleSpace("1:2", gc=False)
+        r = codec.decode(codec.encode((ts, )), allow_pickle=False)[0]
+        r._gc = False # it holds no reference to drop
+        self.assertIsInstance(r, kernel.TupleSpace)
+        self.assertEqual(r._id, "1:2")
+
+    def test_other_values_are_pickled(self):
+        data = codec.encode(("a", 1j))
+        self.assertEqual(codec.decode(data), ("a", 1j))
+        self.assertRaises(codec.CodecError, codec.decode, data, False)
+
+    def test_pickles(self):
+        data = pickle.dumps(("a", 1))
+        self.assertEqual(codec.decode(data), ("a", 1))
+        self.assertRaises(codec.CodecError, codec.decode, data, False)
+
+class MalformedTest(unittest.TestCase):
+    def test_nesting_up_to_max_depth(self):
+        value = () # which is the first level
+        for i in range(codec.max_depth - 1):
+            value = (value, )
+        self.assertEqual(codec.decode(codec.encode(value)), value)
+        self.assertRaises(codec.CodecError, codec.decode, codec.encode((value, )))
+
+    def test_deep_nesting_is_refused_without_exhausting_the_stack(self):
+        # a list holding a list holding a list... as written by hand, each level takes 5 bytes
+        depth = 100000
+        data = bytes((codec.marker, codec.version)) + bytes((codec.LIST, 0, 0, 0, 1)) * depth + bytes((codec.NONE, ))
+        self.assertRaises(codec.CodecError, codec.decode, data)
+
+    def test_truncated_messages(self):
+        data = codec.encode(("abc", 2**70, b"xyz", 1.5, {"k": [1]}))
+        for n in range(2, len(data)):
+            self.assertRaises(codec.CodecError, codec.decode, data[:n])
+
+    def test_bytes_left_over(self):
+        self.assertRaises(codec.CodecError, codec.decode, codec.encode((1, )) + b"\x00")
+
+    def test_unknown_version(self):
+        data = codec.encode((1, ))
+        self.assertRaises(codec.CodecError, codec.decode, data[:1] + bytes((codec.version + 1, )) + data[2:])
+
+    def test_unknown_tag(self):
+        self.assertRaises(codec.CodecError, codec.decode, bytes((codec.marker, codec.version, 0xff)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+## \file
+## \brief Tests for returning tuples to blocked processes through the delivery pipeline
+
+import socket
+import unittest
+
+from linda import codec, delivery, framing, server, utils
+
+class DeliverTest(unittest.TestCase):
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair()
+        self.client = codec.Framed(self.theirs)
+        self.connection = codec.Framed(self.ours)
+        self.pipeline = delivery.DeliveryPipeline()
+
+    def tearDown(self):
+        self.ours.close()
+        self.theirs.close()
+        server.blocked_processes.clear()
+
+    def block(self, tid, msgid):
+        server.blocked_processes[tid] = (self.connection, utils._thread.allocate_lock(), msgid)
+
+    def replies(self, n):
+        return [utils.recv(self.client)[1] for i in range(n)]
+
+    def test_a_pipelined_connection_gets_all_its_tuples(self):
+        for i in range(3):
+            self.block("1!1!%i" % (i, ), i)
+        self.pipeline.deliver([("1!1!%i" % (i, ), ("t", i), 0.0) for i in range(3)])
+        replies = self.replies(3)
+        self.assertEqual([(msgid, utils.decode(tup)) for msgid, tup in replies], [(i, ("t", i)) for i in range(3)])
+        self.assertEqual(server.blocked_processes, {})
+
+    def test_a_tuple_that_cant_be_sent_doesnt_stop_the_others(self):
+        for i in range(3):
+            self.block("1!1!%i" % (i, ), i)
+        unpicklable = ("t", lambda: None)
+        self.pipeline.deliver([("1!1!0", ("t", 0), 0.0), ("1!1!1", unpicklable, 0.0), ("1!1!2", ("t", 2), 0.0)])
+        replies = self.replies(2)
+        self.assertEqual([(msgid, utils.decode(tup)) for msgid, tup in replies], [(0, ("t", 0)), (2, ("t", 2))])
+
+    def test_a_connection_that_encodes_its_messages_isnt_sent_pickles(self):
+        self.connection.use(codec.version)
+        self.block("1!1!0", 0)
+        self.pipeline.deliver([("1!1!0", ("t", 0), 0.0)])
+        msg = self.client.read()
+        self.assertEqual(codec.decode(msg, allow_pickle=False), (0, ("t", 0)))
+
+if __name__ == "__main__":
+    unittest.main()
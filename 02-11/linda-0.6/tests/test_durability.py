@@ -0,0 +1,141 @@
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+
+## \file
+## \brief Tests for recovering the tuplespaces from the operation log and snapshots after a restart
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from linda import durability, tscontainer
+
+class RecoverTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.start(0, 0)
+
+    def tearDown(self):
+        durability.log.file.close()
+        durability.log = durability.store = None
+        shutil.rmtree(self.directory)
+
+    ## \brief Start the server again, as durability.enable does, with a new container recovered from the directory
+    def start(self, seq=None, number=None):
+        durability.log = None
+        durability.store = durability.Store(self.directory)
+        self.container = tscontainer.TupleSpaceContainer()
+        if seq is None:
+            seq, number = durability.store.recover(self.container)
+        durability.log = durability.OperationLog(self.directory, number + 1, seq)
+
+    def restart(self):
+        durability.log.file.close()
+        self.start()
+
+    def tuples(self, ts):
+        return sorted(self.container[ts].ts.matchAllTuples())
+
+    def test_the_log_is_replayed(self):
+        self.container.newTupleSpace("1:1")
+        self.container.newTupleSpace("1:2", 10, None)
+        ts = self.container["1:1"]
+        ts._out_many([("t", i) for i in range(3)])
+        ts._out(("t", 1))
+        self.assertEqual(ts._in("1!1!0", ("t", 1), False), ("t", 1))
+        self.restart()
+        self.assertEqual(sorted(self.container.keys()), ["1:1", "1:2"])
+        self.assertEqual(self.tuples("1:1"), [("t", 0), ("t", 1), ("t", 2)])
+        self.assertEqual(self.container["1:2"].max_tuples, 10)
+
+    def test_a_snapshot_and_the_log_written_after_it(self):
+        self.container.newTupleSpace("1:1")
+        self.container["1:1"]._out_many([("t", i) for i in range(3)])
+        durability.store.snapshot(self.container)
+        self.container["1:1"]._in("1!1!0", ("t", 0), False)
+        self.container["1:1"]._out(("u", ))
+        self.assertEqual(durability.logNumbers(self.directory), [2])
+        self.restart()
+        self.assertEqual(self.tuples("1:1"), [("t", 1), ("t", 2), ("u", )])
+        # and again, now the log holds nothing since the snapshot
+        self.restart()
+        self.assertEqual(self.tuples("1:1"), [("t", 1), ("t", 2), ("u", )])
+
+    def test_a_tuplespace_is_loaded_from_the_snapshot_when_it_is_used(self):
+        self.container.newTupleSpace("1:1")
+        self.container["1:1"]._out(("t", ))
+        durability.store.snapshot(self.container)
+        self.restart()
+        self.assertIsNotNone(self.container.ts["1:1"].pending)
+        self.assertEqual(self.tuples("1:1"), [("t", )])
+        self.assertIsNone(self.container.ts["1:1"].pending)
+
+    def test_leases_are_kept(self):
+        deadline = time.time() + 1000
+        self.container.newTupleSpace("1:1")
+        self.container["1:1"]._out(("t", ), ttl=1000)
+        self.restart()
+        leases = self.container["1:1"].leases[("t", )]
+        self.assertEqual(len(leases), 1)
+        self.assertAlmostEqual(leases[0].deadline, deadline, delta=5)
+
+    def test_a_dropped_tuplespace_isnt_recovered(self):
+        self.container.newTupleSpace("1:1")
+        self.container.newTupleSpace("1:2")
+        self.container.addReference("1:2", "1!1")
+        self.container.deleteReference("1:2", "1!1")
+        self.container["1:1"]._out(("t", )) # the drop is on disk once this is
+        self.restart()
+        self.assertEqual(self.container.keys(), ["1:1"])
+
+    def test_a_partly_written_record_is_ignored(self):
+        self.container.newTupleSpace("1:1")
+        self.container["1:1"]._out(("t", ))
+        durability.log.file.write(durability.length.pack(100) + b"\x80")
+        durability.log.file.flush()
+        self.restart()
+        self.assertEqual(self.tuples("1:1"), [("t", )])
+
+class LogErrorTest(unittest.TestCase):
+    class Broken:
+        def write(self, data):
+            raise IOError("disk full")
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = durability.OperationLog(self.directory, 1, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_once_a_write_fails_nothing_more_is_written(self):
+        self.log.wait(self.log.append(("create", "1:1", ())))
+        good, self.log.file = self.log.file, self.Broken()
+        self.assertRaises(durability.LogError, self.log.wait, self.log.append(("out", "1:1", ("t", ), None)))
+        # even with a working file, as we can't tell what reached the disk
+        self.log.file = good
+        self.assertRaises(durability.LogError, self.log.wait, self.log.append(("out", "1:1", ("u", ), None)))
+        good.close()
+        self.assertEqual(len(durability.readLog(durability.logName(self.directory, 1))), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+
+## \file
+## \brief Tests for the leases that remove tuples from a tuplespace once they expire
+
+import time
+import unittest
+
+from linda import expiry, tuplespace
+
+class LeaseTest(unittest.TestCase):
+    def setUp(self):
+        # the wheel is moved on by the tests rather than a thread of its own, so they don't depend on the clock. It is
+        # small so leases are moved between its wheels, and past the end of the largest, within a few seconds.
+        self.saved = expiry.wheel
+        self.wheel = expiry.wheel = expiry.TimerWheel(resolution=0.1, slots=4, levels=2)
+        self.wheel.started = True
+        self.now = time.time()
+        self.ts = tuplespace.TupleSpace("0:1")
+
+    def tearDown(self):
+        expiry.wheel = self.saved
+
+    def advance(self, seconds):
+        self.wheel.expire(self.wheel.advance(self.now + seconds))
+
+    def test_a_tuple_is_removed_when_its_lease_expires(self):
+        self.ts._out(("a", ), ttl=1)
+        self.ts._out(("b", ))
+        self.advance(0.5)
+        self.assertEqual(self.ts.ts.count(("a", )), 1)
+        self.advance(2)
+        self.assertEqual(self.ts.ts.count(("a", )), 0)
+        self.assertEqual(self.ts.ts.count(("b", )), 1)
+        self.assertEqual(self.ts.expired, 1)
+        self.assertEqual(self.ts.leases, {})
+
+    def test_each_copy_has_its_own_lease(self):
+        self.ts._out(("a", ), ttl=1)
+        self.ts._out(("a", ), ttl=5)
+        self.advance(2)
+        self.assertEqual(self.ts.ts.count(("a", )), 1)
+        self.advance(6)
+        self.assertEqual(self.ts.ts.count(("a", )), 0)
+        self.assertEqual(self.ts.expired, 2)
+
+    def test_taking_a_tuple_cancels_its_lease(self):
+        self.ts._out(("a", ), ttl=1)
+        self.ts._out(("a", ), ttl=5)
+        self.assertEqual(self.ts._in("1!1!0", ("a", ), False), ("a", ))
+        self.assertEqual(len(self.ts.leases[("a", )]), 1)
+        self.ts._out(("a", ))
+        self.advance(2)
+        # the lease that was cancelled was the one expiring first, so both copies are still here
+        self.assertEqual(self.ts.ts.count(("a", )), 2)
+        self.advance(6)
+        self.assertEqual(self.ts.ts.count(("a", )), 1)
+        self.assertEqual(self.ts.expired, 1)
+
+    def test_a_lease_beyond_the_largest_wheel_expires(self):
+        ttl = self.wheel.resolution * self.wheel.slots ** self.wheel.levels * 2
+        self.ts._out(("a", ), ttl=ttl)
+        self.advance(ttl / 2)
+        self.assertEqual(self.ts.ts.count(("a", )), 1)
+        self.advance(ttl + 1)
+        self.assertEqual(self.ts.ts.count(("a", )), 0)
+        self.assertEqual(self.wheel.count, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+
+## \file
+## \brief Tests for reading and writing framed messages when the socket only takes or gives part of them at once
+
+import socket
+import unittest
+
+from linda import framing
+
+## \brief A socket that gives what was sent to it at most chunk bytes at a time, and takes at most accept bytes in
+## each sendmsg
+class Trickle:
+    family = socket.AF_UNIX # so Framer doesn't set TCP options on it
+
+    def __init__(self, data=b"", chunk=1, accept=None):
+        self.data = bytearray(data)
+        self.chunk = chunk
+        self.accept = accept
+        self.calls = 0
+
+    def recv_into(self, view):
+        self.calls += 1
+        n = min(len(view), self.chunk, len(self.data))
+        view[:n] = self.data[:n]
+        del self.data[:n]
+        return n
+
+    def sendmsg(self, buffers, ancdata, flags=0):
+        data = b"".join(buffers)
+        if self.accept is not None:
+            data = data[:self.accept]
+        self.data += data
+        return len(data)
+
+    def sendall(self, data, flags=0):
+        self.data += data
+
+def frames(*messages):
+    return b"".join([framing.header.pack(len(m)) + m for m in messages])
+
+class ReadTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = framing.buffer_size
+        framing.buffer_size = 64
+
+    def tearDown(self):
+        framing.buffer_size = self.saved
+
+    def readAll(self, f):
+        messages = []
+        while True:
+            msg = f.read()
+            if msg is None:
+                return messages
+            messages.append(bytes(msg))
+
+    def test_a_byte_at_a_time(self):
+        messages = [b"a", b"", b"bc" * 10]
+        self.assertEqual(self.readAll(framing.Framer(Trickle(frames(*messages), 1))), messages)
+
+    def test_frames_split_across_reads_and_the_end_of_the_buffer(self):
+        messages = [bytes([i]) * (i % 13) for i in range(50)]
+        for chunk in [3, 7, 31, 64]:
+            self.assertEqual(self.readAll(framing.Framer(Trickle(frames(*messages), chunk))), messages)
+
+    def test_a_message_bigger_than_the_buffer(self):
+        messages = [b"s", b"x" * 1000, b"t"]
+        for chunk in [5, 64, 2000]:
+            self.assertEqual(self.readAll(framing.Framer(Trickle(frames(*messages), chunk))), messages)
+
+    def test_messages_already_received_are_read_without_a_recv(self):
+        s = Trickle(frames(b"a", b"b", b"c"), 64)
+        f = framing.Framer(s)
+        self.assertEqual([f.read(), f.read(), f.read()], [b"a", b"b", b"c"])
+        self.assertEqual(s.calls, 1)
+
+    def test_the_connection_closing_part_way_through_a_frame(self):
+        data = frames(b"abc", b"x" * 100)
+        for n in [2, 5, 6, 10, 50]:
+            f = framing.Framer(Trickle(data[:-n], 3))
+            self.assertEqual(f.read(), b"abc")
+            self.assertIsNone(f.read())
+
+    def test_read_without_a_framer_leaves_the_next_frame(self):
+        s = Trickle(frames(b"abc", b"de"), 2)
+        self.assertEqual(framing.read(s), b"abc")
+        self.assertEqual(bytes(s.data), frames(b"de"))
+        self.assertEqual(framing.read(s), b"de")
+        self.assertIsNone(framing.read(s))
+
+class WriteTest(unittest.TestCase):
+    def test_a_partial_send_is_completed(self):
+        for accept in [0, 2, 4, 6]:
+            s = Trickle(accept=accept)
+            framing.send(s, framing.header.pack(5), b"hello")
+            self.assertEqual(bytes(s.data), frames(b"hello"))
+
+    def test_send_frames(self):
+        messages = [str(i).encode() for i in range(framing.max_buffers)]
+        for accept in [None, 0, 3, 100]:
+            s = Trickle(accept=accept)
+            framing.sendFrames(s, messages)
+            self.assertEqual(bytes(s.data), frames(*messages))
+
+    def test_written_frames_are_read_back(self):
+        s = Trickle(chunk=5)
+        f = framing.Framer(s)
+        f.write(b"one")
+        f.writeMany([b"two", b"x" * 50000, b""])
+        self.assertEqual([bytes(f.read()) for i in range(4)], [b"one", b"two", b"x" * 50000, b""])
+
+if __name__ == "__main__":
+    unittest.main()
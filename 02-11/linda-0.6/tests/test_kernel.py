@@ -0,0 +1,44 @@
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+## \file
+## \brief Tests for the checks the kernel makes before sending a request to the server
+
+import unittest
+
+from linda import kernel
+
+class ManyTest(unittest.TestCase):
+    def setUp(self):
+        # these checks are made before anything is sent, so the tuplespace needn't exist on a server
+        self.ts = kernel.TupleSpace.__new__(kernel.TupleSpace)
+        self.ts._id = "0:0"
+        self.ts._gc = False # it holds no reference to drop
+
+    def test_max_n_must_be_at_least_one(self):
+        for n in [0, -1, 2.0, None, True]:
+            self.assertRaises(ValueError, self.ts.rd_many, ("a", int), n)
+            self.assertRaises(ValueError, self.ts.in_many, ("a", int), n)
+
+    def test_template_must_be_a_tuple(self):
+        self.assertRaises(TypeError, self.ts.rd_many, ["a", int], 1)
+        self.assertRaises(TypeError, self.ts.in_many, ["a", int], 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+## \file
+## \brief Tests for the compiled templates and the template constraints in the template module
+
+import pickle
+import sys
+import unittest
+
+from linda import template
+from linda.template import compileTemplate, Template, Range, OneOf, Prefix, Predicate
+from linda.tuplecontainer import TupleContainer
+
+class CompileTemplateTest(unittest.TestCase):
+    def test_equal_templates_of_different_classes_have_their_own_plans(self):
+        for t in [(True, ), (1, ), (1.0, )]:
+            plan = compileTemplate(t)
+            self.assertEqual(plan.template, t)
+            self.assertIs(plan.template[0].__class__, t[0].__class__)
+
+    def test_sub_tuples_are_part_of_the_key(self):
+        self.assertIs(compileTemplate(("a", (True, ))).template[1][0], True)
+        self.assertIs(compileTemplate(("a", (1, ))).template[1][0].__class__, int)
+
+    def test_plans_are_reused(self):
+        self.assertIs(compileTemplate(("x", int)), compileTemplate(("x", int)))
+
+    def test_unhashable_templates_are_compiled(self):
+        plan = compileTemplate(("x", [1, 2]))
+        self.assertTrue(isinstance(plan, Template))
+        self.assertTrue(plan.matches(("x", [1, 2])))
+
+    def test_formals_match_their_class(self):
+        plan = compileTemplate((str, int))
+        self.assertTrue(plan.matches(("a", 1)))
+        self.assertFalse(plan.matches(("a", "b")))
+        self.assertFalse(plan.matches(("a", 1, 2)))
+
+class ConstraintTest(unittest.TestCase):
+    def test_range(self):
+        r = Range(1, 5)
+        self.assertEqual([v for v in [0, 1, 2.5, 4.999, 5, 6] if r.test(v)], [1, 2.5, 4.999])
+        self.assertFalse(r.test("3"))
+        self.assertFalse(r.test(None))
+        r = Range("b", "d")
+        self.assertEqual([v for v in ["a", "b", "c", "czz", "d", 2] if r.test(v)], ["b", "c", "czz"])
+        self.assertTrue(Range(None, 0).test(-10))
+        self.assertTrue(Range(0, None).test(10 ** 30))
+
+    def test_range_bounds_must_be_of_one_ordered_class(self):
+        for low, high in [(1, "z"), ("a", 2.0), ([1], [2]), (1.0, 1j), (float("nan"), None), (None, b"x")]:
+            self.assertRaises(ValueError, Range, low, high)
+        Range(1, 2.5)
+        Range(None, "x")
+        Range()
+
+    def test_unchecked_range_matches_nothing(self):
+        # a pickled Range isn't checked by __init__ when it is unpickled
+        r = pickle.loads(pickle.dumps(Range(1, 2)))
+        r.low, r.high, r.bounds = 1, "z", (1, "z")
+        self.assertFalse(r.test(1))
+        c = TupleContainer()
+        for i in range(20):
+            c.add((i, ))
+        self.assertRaises(StopIteration, next, c._constrainedKeys(r))
+
+    def test_prefix(self):
+        p = Prefix("ab")
+        self.assertEqual(p.bounds, ("ab", "ac"))
+        self.assertEqual([v for v in ["a", "ab", "abc", "ac", b"abc", 1] if p.test(v)], ["ab", "abc"])
+        top = chr(sys.maxunicode)
+        self.assertEqual(Prefix("a" + top).bounds, ("a" + top, "b"))
+        self.assertEqual(Prefix(top).bounds, (top, None))
+        self.assertEqual(Prefix("").bounds, ("", None))
+        self.assertRaises(ValueError, Prefix, b"ab")
+        self.assertRaises(ValueError, Prefix, 1)
+
+    def test_one_of(self):
+        o = OneOf(1, "a", (2, 3))
+        self.assertEqual([v for v in [1, 1.0, "a", "b", (2, 3), [1]] if o.test(v)], [1, 1.0, "a", (2, 3)])
+
+    def test_predicate(self):
+        template.registerPredicate("test_even", lambda x: x % 2 == 0)
+        p = Predicate("test_even")
+        self.assertTrue(p.test(4))
+        self.assertFalse(p.test(3))
+        self.assertFalse(p.test("x")) # the predicate raises
+        self.assertFalse(Predicate("test_unknown").test(4))
+
+    def test_constraints_are_equal_by_value(self):
+        self.assertEqual(Range(1, 2), Range(1, 2))
+        self.assertNotEqual(Range(1, 2), Range(1, 3))
+        self.assertEqual(hash(Prefix("a")), hash(Prefix("a")))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+## \file
+## \brief Tests for storing, matching and deleting tuples in the tuplecontainer module
+
+import unittest
+
+from linda.template import compileTemplate, Range, Prefix, OneOf
+from linda.tuplecontainer import TupleContainer, PartitionedContainer, StripedContainer, NoTuple
+
+def matchAll(container, template):
+    # returns every tuple the template matches, as matchTuples raises NoTuple once it has run out
+    found = []
+    try:
+        for tup in container.matchTuples(template):
+            found.append(tup)
+    except NoTuple:
+        pass
+    return found
+
+class ContainerTests:
+    def setUp(self):
+        self.c = self.container()
+
+    def test_match_and_delete(self):
+        self.c.add(("a", 1))
+        self.c.add(("a", 1))
+        self.c.add(("b", 2.5))
+        self.assertEqual(self.c.matchOneTuple(("a", int)), ("a", 1))
+        self.assertEqual(sorted(matchAll(self.c, (str, int))), [("a", 1), ("a", 1)])
+        self.assertTrue(self.c.delete(("a", 1)))
+        self.assertEqual(matchAll(self.c, ("a", 1)), [("a", 1)])
+        self.assertTrue(self.c.delete(("a", 1)))
+        self.assertRaises(NoTuple, self.c.matchOneTuple, ("a", 1))
+        self.assertEqual(self.c.matchOneTuple((str, float)), ("b", 2.5))
+
+    def test_actual_template_returns_the_stored_tuple(self):
+        # a plan for (True, ) is cached first, but (1, ) is what was stored
+        compileTemplate((True, ))
+        self.c.add((1, ))
+        tup = self.c.matchOneTuple((1, ))
+        self.assertIs(tup[0].__class__, int)
+        tup = self.c.matchOneTuple((True, ))
+        self.assertIs(tup[0].__class__, int)
+        self.assertEqual([t[0].__class__ for t in matchAll(self.c, (1.0, ))], [int])
+
+    def test_numeric_equal_tuples_share_a_key(self):
+        self.c.add((1.0, "x"))
+        self.c.add((1, "x"))
+        found = matchAll(self.c, (1, "x"))
+        self.assertEqual(len(found), 2)
+        self.assertEqual(set([t[0].__class__ for t in found]), set([float]))
+        # either equal tuple removes a copy
+        self.assertTrue(self.c.delete((True, "x")))
+        self.assertTrue(self.c.delete((1, "x")))
+        self.assertRaises(NoTuple, self.c.matchOneTuple, (1.0, "x"))
+        self.assertTrue(self.c.isEmpty())
+
+    def test_formal_doesnt_match_an_equal_value_of_another_class(self):
+        self.c.add((1, ))
+        self.assertRaises(NoTuple, self.c.matchOneTuple, (str, ))
+        self.assertEqual(self.c.matchOneTuple((int, )), (1, ))
+
+    def test_nested_tuples(self):
+        self.c.add(("p", (1, "a")))
+        self.assertEqual(self.c.matchOneTuple(("p", (int, str))), ("p", (1, "a")))
+        self.assertRaises(NoTuple, self.c.matchOneTuple, ("p", (int, int)))
+
+    def test_constraints(self):
+        for i in range(50):
+            self.c.add(("n", i))
+            self.c.add(("s", "key%02i" % (i, )))
+        self.assertEqual(sorted([t[1] for t in matchAll(self.c, ("n", Range(10, 13)))]), [10, 11, 12])
+        self.assertEqual(sorted([t[1] for t in matchAll(self.c, ("n", Range(None, 2)))]), [0, 1])
+        self.assertEqual(sorted([t[1] for t in matchAll(self.c, ("n", Range(48, None)))]), [48, 49])
+        self.assertEqual(sorted([t[1] for t in matchAll(self.c, ("s", Prefix("key1")))]),
+                         ["key%02i" % (i, ) for i in range(10, 20)])
+        self.assertEqual(matchAll(self.c, ("s", Prefix("nope"))), [])
+        self.assertEqual(sorted([t[1] for t in matchAll(self.c, ("n", OneOf(3, 7, 99)))]), [3, 7])
+
+class TupleContainerTest(ContainerTests, unittest.TestCase):
+    container = TupleContainer
+
+class PartitionedContainerTest(ContainerTests, unittest.TestCase):
+    container = PartitionedContainer
+
+    def test_count(self):
+        self.c.add(("a", ))
+        self.c.add(("a", ))
+        self.assertEqual(self.c.count(("a", )), 2)
+        self.c.delete(("a", ))
+        self.assertEqual(self.c.count(("a", )), 1)
+        self.assertEqual(self.c.count(("b", )), 0)
+
+class StripedContainerTest(ContainerTests, unittest.TestCase):
+    container = StripedContainer
+
+    def test_usage_of_numeric_equal_tuples(self):
+        c = StripedContainer(sizeOf=lambda tup: len(repr(tup)))
+        c.add((1.0, "x"))
+        c.add((1, "x"))
+        self.assertEqual(c.usage, {(float, str): [2, 2 * len(repr((1.0, "x")))]})
+        self.assertTrue(c.delete((1, "x")))
+        self.assertTrue(c.delete((True, "x")))
+        self.assertEqual(c.usage, {})
+        self.assertEqual(sum(c.bytes.values()), 0)
+
+if __name__ == "__main__":
+    unittest.main()
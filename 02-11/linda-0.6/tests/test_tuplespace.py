@@ -0,0 +1,67 @@
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+
+## \file
+## \brief Tests for outputting several tuples at once to a tuplespace with a capacity
+
+import unittest
+
+from linda import kernel, tuplespace
+
+class OutManyTest(unittest.TestCase):
+    def tuples(self, ts):
+        return sorted(ts.ts.matchAllTuples())
+
+    def test_the_oldest_tuples_are_evicted(self):
+        ts = tuplespace.TupleSpace("0:1", max_tuples=3, when_full=kernel.evict_when_full)
+        self.assertEqual(ts._out_many([("t", i) for i in range(5)]), 5)
+        self.assertEqual(self.tuples(ts), [("t", 2), ("t", 3), ("t", 4)])
+        self.assertEqual(ts.evicted, 2)
+        self.assertEqual(ts.tuple_count, 3)
+
+    def test_a_taken_tuple_frees_its_space(self):
+        ts = tuplespace.TupleSpace("0:1", max_tuples=3, when_full=kernel.evict_when_full)
+        ts._out_many([("t", i) for i in range(3)])
+        self.assertEqual(ts._in("1!1!0", ("t", 1), False), ("t", 1))
+        self.assertEqual(ts._out_many([("t", 3), ("t", 3)]), 2)
+        # only one tuple had to go for the second copy, and it was the oldest left
+        self.assertEqual(self.tuples(ts), [("t", 2), ("t", 3), ("t", 3)])
+        self.assertEqual(ts.evicted, 1)
+
+    def test_tuples_are_evicted_to_fit_in_max_bytes(self):
+        size = tuplespace.tupleSize(("t", 0))
+        ts = tuplespace.TupleSpace("0:1", max_bytes=size * 2, when_full=kernel.evict_when_full)
+        self.assertEqual(ts._out_many([("t", i) for i in range(4)]), 4)
+        self.assertEqual(self.tuples(ts), [("t", 2), ("t", 3)])
+        self.assertEqual(ts.byte_count, size * 2)
+
+    def test_a_batch_bigger_than_the_tuplespace_keeps_its_newest_tuples(self):
+        ts = tuplespace.TupleSpace("0:1", max_tuples=2, when_full=kernel.evict_when_full)
+        self.assertEqual(ts._out_many([("t", i) for i in range(10)]), 10)
+        self.assertEqual(self.tuples(ts), [("t", 8), ("t", 9)])
+
+    def test_fail_when_full_stops_at_the_first_tuple_that_doesnt_fit(self):
+        ts = tuplespace.TupleSpace("0:1", max_tuples=3, when_full=kernel.fail_when_full)
+        self.assertEqual(ts._out_many([("t", i) for i in range(5)]), 3)
+        self.assertEqual(self.tuples(ts), [("t", 0), ("t", 1), ("t", 2)])
+        self.assertEqual(ts._out_many([("u", )]), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -25,8 +25,9 @@
 
 import threading
 from .tuplespace import TupleSpace
+from . import deadlock
+from . import durability
 import sys
-import gc
 
 ## \class TupleSpaceContainer
 ## \internal
@@ -35,6 +36,9 @@ import gc
 ## It exposes the most useful methods from a dictionary in addition to a couple of convient functions for dealing with
 ## tuplespaces.
 ##
+## It also keeps an index from each owner of references (a process, server or tuplespace id) to the tuplespaces it
+## holds references to, so when a process leaves we only visit the tuplespaces it referenced.
+##
 ## \author Andrew Wilkinson <aw@cs.york.ac.uk>
 ##
 class TupleSpaceContainer:
@@ -43,6 +47,9 @@ class TupleSpaceContainer:
 
         self.semaphore = threading.Semaphore()
 
+        self.owners = {} # owner -> set of the ids of the tuplespaces it holds references to
+        self.owner_semaphore = threading.Semaphore()
+
     ## \brief Returns the number of tuplespaces contained within this container object
     ## \internal
     def __len__(self):
@@ -66,7 +73,10 @@ class TupleSpaceContainer:
     ## \brief Returns a tuplespace with the given id
     ## \internal
     def __getitem__(self, item):
-        return self.ts[item]
+        ts = self.ts[item]
+        if ts.pending is not None: # the tuples are still in the snapshot the server started from
+            durability.store.load(ts)
+        return ts
 
     ## \brief Returns true if this container object has a tuplespace with the given id
     ## \internal
@@ -80,19 +90,28 @@ class TupleSpaceContainer:
 
     ## \brief Create a new Tuplespace with the given id
     ## \internal
-    def newTupleSpace(self, id):
+    ## \param id The id of the new tuplespace
+    ## \param capacity The maximum number of tuples and bytes, and what to do when full, as taken by the TupleSpace
+    def newTupleSpace(self, id, *capacity):
+        ticket = None
         self.semaphore.acquire()
         try:
-            self.ts[id] = TupleSpace(id)
+            self.ts[id] = TupleSpace(id, *capacity)
+            if durability.log is not None:
+                ticket = durability.log.append(("create", id, capacity))
         finally:
             self.semaphore.release()
 
+        if ticket is not None: # the tuplespace mustn't be used until it will survive a restart
+            durability.log.wait(ticket)
+
     ## \brief Add a new reference to the given tuplespace
     ## \internal
     ## \param ts The tuplespace id
     ## \param ref The object creating the new reference
     def addReference(self, ts, ref):
         self.ts[ts].addreference(ref)
+        self.indexReferences(ts, ref)
 
     ## \brief Remove a reference from the given object to the tuplespace
     ## \internal
@@ -101,7 +120,9 @@ class TupleSpaceContainer:
     ## \param ts The tuplespace id
     ## \param ref The object deleting the reference
     def deleteReference(self, ts, ref):
-        if self.ts[ts].removereference(ref) == 0:
+        remaining = self.ts[ts].removereference(ref)
+        self.indexReferences(ts, ref)
+        if remaining == 0:
             # The function returns the number of reference remaining, if it returns 0 then there are no references
             # and we can delete the tuplespace
             self.semaphore.acquire()
@@ -113,11 +134,13 @@ class TupleSpaceContainer:
                     # another thread deleted this tuplespace while we were blocked on the semaphore
                     return
                 del self.ts[ts]
+                if durability.log is not None:
+                    durability.log.append(("drop", ts))
             finally:
                 self.semaphore.release()
+            deadlock.detector.forget(ts)
 
             del obj
-            gc.collect() # Garbage collection isn't always run, so force a collection now to remove the tuplespace fully
 
     ## \brief Remove all references from the given object to the tuplespace
     ## \internal
@@ -125,7 +148,13 @@ class TupleSpaceContainer:
     ## \param ts The tuplespace id
     ## \param ref The object deleting their references
     def deleteAllReferences(self, ts, ref):
-        if self.ts[ts].removeanyreferences(ref) == 0:
+        try:
+            ts_obj = self.ts[ts]
+        except KeyError: # the tuplespace has already been deleted
+            return
+        remaining = ts_obj.removeanyreferences(ref)
+        self.indexReferences(ts, ref)
+        if remaining == 0:
             # The function returns the number of reference remaining, if it returns 0 then there are no references
             # and we can delete the tuplespace
             self.semaphore.acquire()
@@ -137,8 +166,49 @@ class TupleSpaceContainer:
                     # another thread deleted this tuplespace while we were blocked on the semaphore
                     return
                 del self.ts[ts]
+                if durability.log is not None:
+                    durability.log.append(("drop", ts))
             finally:
                 self.semaphore.release()
+            deadlock.detector.forget(ts)
 
             del obj
-            gc.collect() # Garbage collection isn't always run, so force a collection now to remove the tuplespace fully
+
+    ## \brief Returns the ids of the tuplespaces that the given owner holds references to
+    ## \internal
+    ## \param ref The process, server or tuplespace id
+    def referencedBy(self, ref):
+        self.owner_semaphore.acquire()
+        try:
+            return list(self.owners.get(ref, ()))
+        finally:
+            self.owner_semaphore.release()
+
+    ## \brief Update the index of references held by each owner, after the owner's references to a tuplespace have
+    ## changed
+    ## \internal
+    ##
+    ## The index is set from the number of references the tuplespace currently holds, rather than adjusted by the
+    ## change, so if two threads change the references at once whichever updates the index last leaves it correct.
+    ## \param ts The tuplespace id
+    ## \param ref The owner of the references
+    def indexReferences(self, ts, ref):
+        if ts == "0:0": # references to the universal tuplespace aren't counted
+            return
+        self.owner_semaphore.acquire()
+        try:
+            try:
+                held = self.ts[ts].refs.get(ref, 0) > 0
+            except KeyError: # the tuplespace has been deleted
+                held = False
+            tss = self.owners.get(ref)
+            if held:
+                if tss is None:
+                    tss = self.owners[ref] = set()
+                tss.add(ts)
+            elif tss is not None:
+                tss.discard(ts)
+                if len(tss) == 0:
+                    del self.owners[ref]
+        finally:
+            self.owner_semaphore.release()
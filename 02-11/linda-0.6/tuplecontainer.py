@@ -23,164 +23,790 @@
 ## \author Andrew Wilkinson <aw@cs.york.ac.uk>
 ##
 
+from bisect import bisect_left, insort
+import time
+import weakref
+
+from .template import compileTemplate, ACTUAL, FORMAL, SUBTUPLE, CONSTRAINT, _numeric
+
 class NoTuple(Exception):
     pass
 
+# marks the end of an iterator when walking the trie
+_end = object()
+
 ## \brief Takes a template and a tuple and return True if the template matches the tuple
 def doesMatch(template, tup):
-    # Check that the tuple is actually a tuple and that the template and tuple are of the same
-    # length (otherwise they obviously can't match.
-    if type(tup) != type(()) or type(template) != type(()) or len(template) != len(tup):
+    if type(template) != tuple:
         return False
+    return compileTemplate(template).matches(tup)
 
-    def doesMatchLoop(xxx_todo_changeme):
-        (temp, tup) = xxx_todo_changeme
-        if type(temp) == tuple:
-            # ... if we have a sub-tuple then match that.
-            if not doesMatch(temp, tup):
-                raise StopIteration
-        elif (temp != tup.__class__) and (temp != tup):
-            # if the template object is the class of the element of the tuple, or they are the same
-            # then we have a match (but here we're looking for a non-match).
-            raise StopIteration
-
-    # For each element of the tuple...
-    try:
-        list(map(doesMatchLoop, list(zip(template, tup))))
-    except StopIteration:
-        return False
-    else:
-        return True
+# Nodes with more keys than this keep an index of their keys by class, smaller nodes just scan their keys
+index_threshold = 8
 
 #
 # Tuplecontainer uses a trie structure to provide an efficiant method of storing tuples
 # see http://en.wikipedia.org/wiki/Trie
 #
+# To keep the memory used by each node down the nodes use __slots__, and a chain of nodes that would only lead to a
+# single distinct tuple is compressed into the entry at the top of the chain (see
+# http://en.wikipedia.org/wiki/Radix_tree), so a long unique suffix takes one entry rather than a node per element.
+#
 class TupleContainer:
+    __slots__ = ("contain", "types", "sorted", "numeric")
+
     def __init__(self):
         #
         # self.contain is a dictionary, the keys of which are the elements of the tuples
-        # The values are a pair, a nubmer representing the number of tuples than end there, and another
-        # TupleContainer which contains tuples with more elements
+        # The values are a pair (count, child). Usually count is the number of tuples than end there, and child is
+        # either None or another TupleContainer which contains tuples with more elements. If child is a tuple then
+        # it is a compressed chain: the remaining elements of the only tuple stored below this key, and count is the
+        # number of copies of that tuple.
         #
         self.contain = {}
+        #
+        # self.types indexes the keys of self.contain by their class, so a formal (type) element in a template only
+        # has to look at the keys that can match it rather than every key at this level. Each value is a dictionary
+        # used as an ordered set, so candidates come out in the same order as a scan of self.contain would give.
+        # Small nodes don't have an index (self.types is None) as scanning them is as quick.
+        #
+        self.types = None
+        #
+        # self.sorted holds sorted lists of our numeric and string keys, indexed by their ordering (see _orderOf),
+        # so range and prefix elements of a template can find their keys with a binary search. The lists are only
+        # built when a large node is first searched, and are None until then.
+        #
+        self.sorted = None
+        #
+        # self.numeric maps each of our keys that is a bool, float or complex to itself. A template element can be
+        # equal to a key of another class (1 == 1.0 == True), and the key is what must be returned, not the element.
+        # Ints are left out as they're the common case, so an equal key that isn't in here is an int. It is None until
+        # we have such a key.
+        #
+        self.numeric = None
+
+    def _addKey(self, key, entry):
+        self.contain[key] = entry
+        cls = key.__class__
+        if cls in _numeric and cls is not int:
+            if self.numeric is None:
+                self.numeric = {}
+            self.numeric[key] = key
+        if self.types is not None:
+            try:
+                self.types[key.__class__][key] = None
+            except KeyError:
+                self.types[key.__class__] = {key: None}
+        elif len(self.contain) > index_threshold:
+            self.types = {}
+            for k in self.contain:
+                try:
+                    self.types[k.__class__][k] = None
+                except KeyError:
+                    self.types[k.__class__] = {k: None}
+        if self.sorted is not None:
+            order = _orderOf(key)
+            if order in self.sorted:
+                insort(self.sorted[order], key)
+
+    def _delKey(self, key):
+        key = self._storedKey(key)
+        del self.contain[key]
+        if self.numeric is not None and key in self.numeric:
+            del self.numeric[key]
+            if len(self.numeric) == 0:
+                self.numeric = None
+        if self.types is not None:
+            keys = self.types[key.__class__]
+            del keys[key]
+            if len(keys) == 0:
+                del self.types[key.__class__]
+        if self.sorted is not None:
+            order = _orderOf(key)
+            if order in self.sorted:
+                keys = self.sorted[order]
+                del keys[bisect_left(keys, key)]
+
+    def _storedKey(self, key):
+        # returns our key that is equal to the given one, which we must contain
+        cls = key.__class__
+        if cls in _numeric:
+            if self.numeric is not None and key in self.numeric:
+                return self.numeric[key]
+            elif cls is not int:
+                return int(key.real)
+        return key
+
+    def _sortedKeys(self, order):
+        # return the sorted list of our keys with the given ordering, building it if we need to
+        if self.sorted is None:
+            self.sorted = {}
+        try:
+            return self.sorted[order]
+        except KeyError:
+            keys = self.sorted[order] = sorted([k for k in self.contain if _orderOf(k) == order])
+            return keys
+
+    def _keysOfClass(self, cls):
+        # return an iterator over our keys which are instances of the class cls
+        if self.types is None:
+            return (k for k in self.contain if k.__class__ is cls)
+        return iter(self.types.get(cls, ()))
 
     def add(self, tup):
-        if len(tup) == 1:
-            # If we're entering the last element of a tuple either increment the count if we've seen
-            # this tuple before, otherwise create a new entry in the dictionary
-            if tup[0] in self.contain:
-                self.contain[tup[0]][0] += 1
-            else:
-                self.contain[tup[0]] = [1, None]
-        else:
-            # If we have a key for this element of the tuple then add the rest of the tuple to 
-            # appropriate sub-trie. If not create it, then add it.
-            if tup[0] in self.contain:
-                if self.contain[tup[0]][1] is None:
-                    self.contain[tup[0]][1] = TupleContainer()
-                self.contain[tup[0]][1].add(tup[1:])
-            else:
-                self.contain[tup[0]] = [0, TupleContainer()]
-                self.contain[tup[0]][1].add(tup[1:])
+        # walk down the trie an element at a time, creating any sub-tries we need on the way
+        node = self
+        last = len(tup) - 1
+        i = 0
+        while True:
+            key = tup[i]
+            entry = node.contain.get(key)
+            if entry is None:
+                # a new element, so the rest of the tuple can go into a single compressed entry
+                if i == last:
+                    node._addKey(key, (1, None))
+                else:
+                    node._addKey(key, (1, tup[i+1:]))
+                return
+
+            count, child = entry
+            if type(child) is tuple:
+                if _sameSuffix(child, tup, i + 1):
+                    # this is another copy of the tuple in the compressed chain
+                    node.contain[key] = (count + 1, child)
+                    return
+                # the new tuple differs from the chain, so expand the top of the chain into a real node
+                child = _expand(child, count)
+                count = 0
+                node.contain[key] = (count, child)
+
+            if i == last:
+                # If we're entering the last element of a tuple increment the count
+                node.contain[key] = (count + 1, child)
+                return
+            if child is None:
+                child = TupleContainer()
+                node.contain[key] = (count, child)
+            node = child
+            i += 1
 
     def matchOneTuple(self, template):
         # Just return the first tuple
         return next(self.matchTuples(template))
 
     def matchTuples(self, template):
-        # take the first element in, and then the rest of, the tuple
-        ele, template = template[0], template[1:]
-        # take a list of all the tuple elements we contain
-        tups_list = list(self.contain.keys())
+        plan = compileTemplate(template)
+        last = plan.arity - 1
+
+        # This walks the trie depth first with an explicit stack, indexed by the position in the template. At each
+        # position we keep the trie node we're in and an iterator over its keys that match the template element.
+        # The matched keys are kept in result, so a tuple is only built when we reach the end of the template.
+        nodes = [None] * plan.arity
+        keys = [None] * plan.arity
+        result = [None] * plan.arity
 
-        if template == ():
-            # if the rest of the template is empty then this is the last element to match
+        i = 0
+        nodes[0] = self
+        keys[0] = self._matchingKeys(plan, 0)
+        while i >= 0:
+            key = next(keys[i], _end)
+            if key is _end:
+                # we've tried every key at this position, so go back up a level
+                i -= 1
+                continue
+
+            count, child = nodes[i].contain[key]
+            result[i] = key
+            if type(child) is tuple:
+                # a compressed chain holds a single tuple, so check the rest of it against the template directly
+                if len(child) == last - i and plan.matchesFrom(child, i + 1):
+                    result[i+1:] = child
+                    tup = tuple(result)
+                    for j in range(count):
+                        yield tup
+            elif i == last:
+                # this is the last element to match, so yield the tuple the same number of times as it is stored
+                if count > 0:
+                    tup = tuple(result)
+                    for j in range(count):
+                        yield tup
+            elif child is not None:
+                # we're not looking for the last element in this tuple, so keep looking in the sub-trie
+                i += 1
+                nodes[i] = child
+                keys[i] = child._matchingKeys(plan, i)
+        raise NoTuple
+
+    def _matchingKeys(self, plan, i):
+        # return an iterator over our keys that match the element at position i of the compiled template
+        ele = plan.template[i]
+        if plan.kinds[i] == CONSTRAINT:
+            return self._constrainedKeys(ele)
+        elif ele in self.contain:
+            # we contain the element itself, or one equal to it
+            return iter((self._storedKey(ele), ))
+        elif plan.kinds[i] == FORMAL:
+            # we don't contain the element - but the keys of that class match it
+            return self._keysOfClass(ele)
+        elif plan.kinds[i] == SUBTUPLE:
+            # if the sub element is a tuple then match that against the keys which are tuples
+            return filter(plan.subtemplates[i].matches, self._keysOfClass(tuple))
+        else:
+            # an actual value we don't contain can't match
+            return iter(())
+
+    def _constrainedKeys(self, constraint):
+        # return an iterator over our keys that are accepted by the constraint
+        if constraint.values is not None:
+            # the constraint can only match a few values, so just look them up
+            return (v for v in constraint.values if v in self.contain)
+        elif constraint.order is not None and len(self.contain) > index_threshold:
+            # search the sorted keys for those within the bounds of the constraint
+            keys = self._sortedKeys(constraint.order)
+            low, high = constraint.bounds
             try:
-                self.contain[ele]
-            except KeyError:
-                # we don't contain the element - but maybe we can still match it
-                if type(ele) == tuple:
-                    for t in tups_list:
-                        # if the sub element is a tuple then match that...
-                        if doesMatch(ele, t):
-                            for i in range(self.contain[t][0]):
-                                yield(t, )
+                start = 0 if low is None else bisect_left(keys, low)
+                end = len(keys) if high is None else bisect_left(keys, high) # the high bound is never matched
+            except TypeError:
+                # an unpickled constraint wasn't checked when it was created, and its bounds can't be compared with
+                # our keys, so test every key instead
+                return filter(constraint.test, self.contain)
+            return (keys[j] for j in range(start, end) if constraint.test(keys[j]))
+        else:
+            return filter(constraint.test, self.contain)
+
+    def matchAllTuples(self):
+        # As for matchTuples, but the tuples can be any length so the stack grows as we go down the trie
+        nodes = [self]
+        keys = [iter(self.contain)]
+        result = []
+        while len(keys) > 0:
+            key = next(keys[-1], _end)
+            if key is _end:
+                nodes.pop()
+                keys.pop()
+                if len(result) > 0:
+                    result.pop()
+                continue
+
+            count, child = nodes[-1].contain[key]
+            result.append(key)
+            if type(child) is tuple:
+                tup = tuple(result) + child
+                for j in range(count):
+                    yield tup
+                result.pop()
+                continue
+
+            if count > 0:
+                tup = tuple(result)
+                for j in range(count):
+                    yield tup
+            if child is not None:
+                nodes.append(child)
+                keys.append(iter(child.contain))
+            else:
+                result.pop()
+
+    def delete(self, tup):
+        # returns True if the tuple was deleted, or False if we didn't contain it
+        #
+        # On the way down we remember the highest entry below which the trie is a single chain leading only to this
+        # tuple. If the tuple turns out to be the last copy then that entry, and the whole chain, can be deleted.
+        node = self
+        last = len(tup) - 1
+        cut_node = cut_key = None
+        i = 0
+        while True:
+            key = tup[i]
+            entry = node.contain.get(key)
+            if entry is None:
+                break
+            count, child = entry
+
+            if type(child) is tuple:
+                # the tuple can only be the one in this compressed chain
+                if not _sameSuffix(child, tup, i + 1):
+                    break
+                last_copy = count == 1
+            elif i == last:
+                # this is the last element in the tuple to delete, so just decrement the count
+                if count == 0:
+                    break
+                last_copy = count == 1 and (child is None or child.isEmpty())
+            else:
+                # there is more, so just continue deleting.
+                if child is None:
+                    break
+                if count == 0 and len(child.contain) == 1:
+                    if cut_node is None:
+                        cut_node, cut_key = node, key
                 else:
-                    for t in tups_list:
-                        if (ele == t.__class__) or (ele == t):
-                            # is the element we're looking for the base class of t, or is t then we've 
-                            # found it
-                            for i in range(self.contain[t][0]):
-                                yield (t, )
+                    cut_node = None
+                node = child
+                i += 1
+                continue
+
+            if not last_copy:
+                node.contain[key] = (count - 1, child)
+            elif cut_node is not None:
+                # delete the sub-tries we no longer need to save space
+                cut_node._delKey(cut_key)
             else:
-                # we contain this tuple, so yield the same number of times as it is stored
-                for i in range(self.contain[ele][0]):
-                    yield (ele, )
-        else:
-            # we're not looking for the last element in this tuple...
+                node._delKey(key)
+            return True
+
+        print("Error, deleting tuple %s, tuple does not exist" % (str(tup)))
+        return False
+
+    def isEmpty(self):
+        # if we don't contain any elements then we're empty.
+        return len(self.contain) == 0
+
+def _orderOf(key):
+    # returns the name of the sorted list of keys this key belongs in, or None if it isn't kept in one
+    cls = key.__class__
+    if cls is int or cls is float:
+        if key != key: # NaN can't be sorted
+            return None
+        return "num"
+    elif cls is str:
+        return "str"
+    return None
+
+def _sameSuffix(suffix, tup, start):
+    # returns True if the elements of tup from start onwards are the same as suffix
+    if len(suffix) != len(tup) - start:
+        return False
+    for ele in suffix:
+        if ele != tup[start]:
+            return False
+        start += 1
+    return True
+
+def _expand(suffix, count):
+    # turn the top of a compressed chain into a node, with the rest of the chain compressed below it
+    node = TupleContainer()
+    if len(suffix) == 1:
+        node._addKey(suffix[0], (count, None))
+    else:
+        node._addKey(suffix[0], (count, suffix[1:]))
+    return node
+
+## \brief Returns the type signature of a tuple, that is the class of each of its elements
+def getSignature(tup):
+    return tuple([t.__class__ for t in tup])
+
+## \brief Formats a signature for reporting, e.g. "(str, int, float)"
+def signatureName(signature):
+    return "(%s)" % (", ".join([cls.__name__ for cls in signature]), )
+
+#
+# PartitionedContainer keeps a separate TupleContainer for each arity, so a template never walks into tuples that
+# are the wrong length to match it. For each arity it also keeps a directory of the type signatures stored there,
+# and how many tuples have each, so a template whose formals can't match any stored signature is rejected without
+# touching the trie at all.
+#
+# Every tuple is also kept in a hash index, mapping the tuple to the tuple as it was stored and the number of copies.
+# A template with no formal elements can only match a tuple equal to it, so it's matched with a single lookup in the
+# index rather than a walk of the trie. These are the token and lock tuples that make up most coordination traffic.
+# Equal tuples, such as (1, ) and (1.0, ), share an entry, and as in the trie the first one stored is returned.
+#
+class PartitionedContainer:
+    def __init__(self):
+        self.partitions = {} # arity -> TupleContainer
+        self.signatures = {} # arity -> {signature: count}
+        self.exact = {} # tuple -> [tuple as stored, count]
+
+    def add(self, tup):
+        arity = len(tup)
+        try:
+            trie = self.partitions[arity]
+        except KeyError:
+            trie = self.partitions[arity] = TupleContainer()
+            self.signatures[arity] = {}
+        trie.add(tup)
+
+        try:
+            entry = self.exact[tup]
+            entry[1] += 1
+        except KeyError:
+            entry = self.exact[tup] = [tup, 1]
+
+        # the signature is that of the tuple as it is stored in the trie
+        sigs = self.signatures[arity]
+        sig = getSignature(entry[0])
+        sigs[sig] = sigs.get(sig, 0) + 1
+
+    def canMatch(self, plan):
+        # check the signature directory to see if any tuple of the right arity could match the template
+        try:
+            sigs = self.signatures[plan.arity]
+        except KeyError:
+            return False
+        for sig in sigs:
+            if plan.matchesSignature(sig):
+                return True
+        return False
+
+    def matchOneTuple(self, template):
+        plan = compileTemplate(template)
+        if plan.actual:
+            # we don't need to start a search just to look up one tuple
             try:
-                # do we have an entry for the element in the template
-                self.contain[ele]
+                return self.exact[plan.template][0]
             except KeyError:
-                # no we don't... look through each element and see if it matches the template
-                if type(ele) == tuple:
-                    for t in tups_list:
-                        if doesMatch(ele, t) and self.contain[t][1] is not None:
-                            m = self.contain[t][1].matchTuples(template)
-                            while True:
-                                try:
-                                    yield (t,) + next(m)
-                                except NoTuple:
-                                    break
-                else:
-                    for t in tups_list:
-                        if (ele == t.__class__) or (ele == t):
-                            if self.contain[t][1] is not None:
-                                m = self.contain[t][1].matchTuples(template)
-                                while True:
-                                    try:
-                                        yield (t,) + next(m)
-                                    except NoTuple:
-                                        break
-            else:
-                # we've got a match - as we have more elements to match keep looking...
-                if self.contain[ele][1] is not None:
-                    m = self.contain[ele][1].matchTuples(template)
-                    while True:
-                        try:
-                            yield (ele, ) + next(m)
-                        except NoTuple:
-                            break
+                raise NoTuple
+        # Just return the first tuple
+        return next(self.matchTuples(plan))
+
+    def matchTuples(self, template):
+        plan = compileTemplate(template)
+        if plan.actual:
+            stored, count = self.exact.get(plan.template, (None, 0))
+            for i in range(count):
+                yield stored
+            raise NoTuple
+        if not self.canMatch(plan):
+            raise NoTuple
+        m = self.partitions[plan.arity].matchTuples(plan)
+        while True:
+            try:
+                yield next(m)
+            except NoTuple:
+                break
         raise NoTuple
 
     def matchAllTuples(self):
-        # take a list of all the tuple elements we contain
-        tups_list = list(self.contain.keys())
-        
-        for tup in tups_list:
-            for i in range(self.contain[tup][0]):
-                yield (tup, )
-            if self.contain[tup][1] is not None:
-                for tuple in self.contain[tup][1].matchAllTuples():
-                    yield (tup, ) + tuple
-        
+        for arity in sorted(self.partitions.keys()):
+            for tup in self.partitions[arity].matchAllTuples():
+                yield tup
+
     def delete(self, tup):
+        arity = len(tup)
         try:
-            if len(tup) == 1:
-                # this is the last element in the tuple to delete, so just decrement the count
-                assert self.contain[tup[0]][0] > 0
-                self.contain[tup[0]][0] -= 1
+            trie = self.partitions[arity]
+        except KeyError:
+            print("Error, deleting tuple %s, tuple does not exist" % (str(tup)))
+            return False
+        if not trie.delete(tup):
+            return False
+
+        entry = self.exact[tup]
+        sigs = self.signatures[arity]
+        sig = getSignature(entry[0])
+        if sigs[sig] == 1:
+            del sigs[sig]
+        else:
+            sigs[sig] -= 1
+
+        if entry[1] == 1:
+            del self.exact[tup]
+        else:
+            entry[1] -= 1
+        if trie.isEmpty():
+            # drop empty partitions so the directory only lists arities we actually hold
+            del self.partitions[arity]
+            del self.signatures[arity]
+        return True
+
+    def isEmpty(self):
+        return len(self.partitions) == 0
+
+    ## \brief Returns the number of copies of the given tuple that are stored
+    def count(self, tup):
+        return self.exact.get(tup, (None, 0))[1]
+
+    ## \brief Returns the tuple as it is stored, which may hold elements of other classes equal to those of the given
+    ## tuple, or None if we don't contain it
+    def stored(self, tup):
+        return self.exact.get(tup, (None, 0))[0]
+
+    ## \brief Returns the number of tuples stored with each signature, indexed by the signature's name
+    def signatureCounts(self):
+        counts = {}
+        for arity in self.signatures:
+            for sig, count in self.signatures[arity].items():
+                name = signatureName(sig)
+                counts[name] = counts.get(name, 0) + count
+        return counts
+
+# The number of stripes the tuples of each arity are divided between
+stripe_count = 8
+
+#
+# A SpilledStripe takes the place of a stripe whose tuples have been written to disk by spill::MemoryManager to save
+# memory. It keeps the stripe's signature directory, so templates that can't match anything in the stripe are still
+# rejected without reading it back, along with the number of tuples and their estimated size.
+#
+class SpilledStripe:
+    __slots__ = ("store", "key", "count", "bytes", "signatures", "__weakref__")
+
+    def __init__(self, store, key, count, bytes, signatures):
+        self.store = store # the spill::SpillStore holding the tuples
+        self.key = key # the key the tuples are stored under
+        self.count = count
+        self.bytes = bytes
+        self.signatures = signatures # signature -> count
+
+    def canMatch(self, plan):
+        for sig in self.signatures:
+            if plan.matchesSignature(sig):
+                return True
+        return False
+
+#
+# StripedContainer divides tuples between a number of PartitionedContainers, so that operations on different parts
+# of a tuplespace can be locked separately. A tuple's stripe is chosen by its arity and a hash of its first element,
+# so the tuples ("task", ...) and ("result", ...) will usually be in different stripes.
+#
+# A template with an actual first element can only match tuples in the stripe that element hashes to. Any other
+# template could match tuples in every stripe of its arity, and has to search them all.
+#
+# The stripes are identified by an (arity, number) pair, and callers that lock more than one stripe must always lock
+# them in the order they are returned by stripesFor or allStripes, so two operations can never wait on each other.
+#
+# The number of tuples with each signature, and their estimated size, are kept up to date as tuples are added and
+# deleted so they can be reported without walking the tuples.
+#
+# If a function to estimate the size of a tuple is given then the estimated size of each stripe is kept up to date,
+# along with when each stripe was last used, so the least recently used stripes can be spilled to disk when the server
+# is short of memory. A spilled stripe is read back the first time a template that could match it is used, or a tuple
+# in it is deleted. Tuples added to a spilled stripe are written straight to disk.
+#
+class StripedContainer:
+    def __init__(self, sizeOf=None):
+        self.stripes = {} # (arity, number) -> PartitionedContainer or SpilledStripe
+        self.sizeOf = sizeOf
+        self.bytes = {} # stripe -> estimated size in bytes of the tuples in memory, if we have sizeOf
+        self.accessed = {} # stripe -> the time it was last used
+        self.usage = {} # signature -> [number of tuples, estimated size in bytes]
+
+    ## \brief Returns the stripe that a tuple belongs in
+    def stripeOf(self, tup):
+        if len(tup) == 0:
+            return (0, 0)
+        try:
+            return (len(tup), hash(tup[0]) % stripe_count)
+        except TypeError:
+            return (len(tup), 0)
+
+    ## \brief Returns the stripes that might hold a tuple matching the given template, in locking order
+    def stripesFor(self, template):
+        plan = compileTemplate(template)
+        if plan.arity == 0:
+            return [(0, 0)]
+        elif plan.kinds[0] == ACTUAL:
+            return [self.stripeOf(plan.template)]
+        return [(plan.arity, i) for i in range(stripe_count)]
+
+    ## \brief Returns every stripe that holds tuples, in locking order
+    def allStripes(self):
+        return sorted(self.stripes.keys())
+
+    ## \brief Returns the container for a stripe, reading it back from disk if it has been spilled
+    ## \param plan If given, a spilled stripe is only read back if it could hold a tuple matching this template
+    ## \return The container, or None if the stripe has been spilled and can't match the template
+    def container(self, stripe, plan=None):
+        container = self.stripes[stripe]
+        self.accessed[stripe] = time.time()
+        if isinstance(container, SpilledStripe):
+            if plan is not None and not container.canMatch(plan):
+                return None
+            container = self.unspill(stripe)
+        return container
+
+    def add(self, tup):
+        stripe = self.stripeOf(tup)
+        self.accessed[stripe] = time.time()
+        try:
+            container = self.stripes[stripe]
+        except KeyError:
+            container = self.stripes[stripe] = PartitionedContainer()
+            self.bytes[stripe] = 0
+
+        if isinstance(container, SpilledStripe):
+            # adding a tuple doesn't mean anyone wants the others, so just add it to those on disk
+            container.store.append(container.key, tup)
+        else:
+            container.add(tup)
+            # a tuple equal to one we already hold is counted as that one, so it is taken off again when deleted
+            tup = container.stored(tup)
+
+        size = 0
+        if self.sizeOf is not None:
+            size = self.sizeOf(tup)
+        sig = getSignature(tup)
+        try:
+            usage = self.usage[sig]
+        except KeyError:
+            usage = self.usage[sig] = [0, 0]
+        usage[0] += 1
+        usage[1] += size
+
+        if isinstance(container, SpilledStripe):
+            container.signatures[sig] = container.signatures.get(sig, 0) + 1
+            container.count += 1
+            container.bytes += size
+        else:
+            self.bytes[stripe] += size
+
+    def matchOneTuple(self, template):
+        plan = compileTemplate(template)
+        for stripe in self.stripesFor(plan):
+            try:
+                container = self.container(stripe, plan)
+                if container is not None:
+                    return container.matchOneTuple(plan)
+            except (KeyError, NoTuple, StopIteration):
+                pass
+        raise NoTuple
+
+    def matchTuples(self, template):
+        plan = compileTemplate(template)
+        for stripe in self.stripesFor(plan):
+            try:
+                container = self.container(stripe, plan)
+            except KeyError:
+                continue
+            if container is None:
+                continue
+            m = container.matchTuples(plan)
+            while True:
+                try:
+                    yield next(m)
+                except (NoTuple, StopIteration):
+                    break
+        raise NoTuple
+
+    ## \brief Returns every tuple, without reading back any that have been spilled to disk
+    def matchAllTuples(self):
+        for stripe in self.allStripes():
+            container = self.stripes[stripe]
+            if isinstance(container, SpilledStripe):
+                for tup in container.store.read(container.key):
+                    yield tup
             else:
-                # there is more, so just continue deleting.
-                self.contain[tup[0]][1].delete(tup[1:])
-            if self.contain[tup[0]][0] == 0 and (self.contain[tup[0]][1] is None
-                                             or self.contain[tup[0]][1].isEmpty()):
-                # check to see if we can delete the sub-trie to save space
-                del self.contain[tup[0]]
+                for tup in container.matchAllTuples():
+                    yield tup
+
+    def delete(self, tup):
+        stripe = self.stripeOf(tup)
+        try:
+            container = self.container(stripe)
         except KeyError:
             print("Error, deleting tuple %s, tuple does not exist" % (str(tup)))
+            return False
+        # the empty container is kept, as other threads may be waiting to lock its stripe
+        stored = container.stored(tup)
+        if not container.delete(tup):
+            return False
+        tup = stored
+
+        size = 0
+        if self.sizeOf is not None:
+            size = self.sizeOf(tup)
+            self.bytes[stripe] -= size
+        sig = getSignature(tup)
+        usage = self.usage.get(sig)
+        if usage is None:
+            # a tuple added while its stripe was on disk is counted under its own signature, but when read back it is
+            # stored as any equal tuple that was read back before it
+            pass
+        elif usage[0] == 1:
+            del self.usage[sig]
+        else:
+            usage[0] -= 1
+            usage[1] -= size
+        return True
 
     def isEmpty(self):
-        # if we don't contain any elements then we're empty.
-        return len(self.contain) == 0
+        for container in self.stripes.values():
+            if isinstance(container, SpilledStripe):
+                if container.count > 0:
+                    return False
+            elif not container.isEmpty():
+                return False
+        return True
+
+    ## \brief Returns the number of copies of the given tuple that are stored
+    def count(self, tup):
+        try:
+            return self.container(self.stripeOf(tup)).count(tup)
+        except KeyError:
+            return 0
+
+    ## \brief Returns the number of tuples stored with each signature, indexed by the signature's name
+    def signatureCounts(self):
+        counts = {}
+        for stripe in self.allStripes():
+            container = self.stripes[stripe]
+            if isinstance(container, SpilledStripe):
+                stripe_counts = {}
+                for sig, count in container.signatures.items():
+                    name = signatureName(sig)
+                    stripe_counts[name] = stripe_counts.get(name, 0) + count
+            else:
+                stripe_counts = container.signatureCounts()
+            for name, count in stripe_counts.items():
+                counts[name] = counts.get(name, 0) + count
+        return counts
+
+    ## \brief Returns the number of tuples stored with each signature and their estimated size, indexed by the
+    ## signature's name
+    ## \return A dictionary mapping signature names to (number of tuples, bytes) pairs
+    def signatureUsage(self):
+        usage = {}
+        for sig, (count, size) in self.usage.items():
+            name = signatureName(sig)
+            total = usage.get(name, (0, 0))
+            usage[name] = (total[0] + count, total[1] + size)
+        return usage
+
+    ## \brief Returns the estimated size in bytes of the tuples held in memory, rather than spilled to disk
+    def residentBytes(self):
+        return sum(self.bytes.values())
+
+    ## \brief Returns the stripes held in memory that hold tuples
+    ## \return A list of (time last used, estimated size in bytes, stripe) tuples
+    def residentStripes(self):
+        stripes = []
+        for stripe, container in list(self.stripes.items()):
+            if not isinstance(container, SpilledStripe) and not container.isEmpty():
+                stripes.append((self.accessed.get(stripe, 0), self.bytes.get(stripe, 0), stripe))
+        return stripes
+
+    ## \brief Write the tuples of a stripe to disk, keeping just its signature directory in memory
+    ## \return The estimated number of bytes freed
+    ## \param stripe The stripe to spill, which must be locked
+    ## \param store The spill::SpillStore to write the tuples to
+    def spill(self, stripe, store):
+        container = self.stripes.get(stripe)
+        if container is None or isinstance(container, SpilledStripe) or container.isEmpty():
+            return 0
+
+        tuples = list(container.matchAllTuples())
+        signatures = {}
+        for sigs in container.signatures.values():
+            for sig, count in sigs.items():
+                signatures[sig] = signatures.get(sig, 0) + count
+        key = store.write(tuples)
+
+        freed = self.bytes.get(stripe, 0)
+        spilled = self.stripes[stripe] = SpilledStripe(store, key, len(tuples), freed, signatures)
+        # if the tuplespace is deleted while the stripe is on disk then the tuples on disk must be deleted too
+        weakref.finalize(spilled, store.forget, key)
+        self.bytes[stripe] = 0
+        return freed
+
+    ## \brief Read a spilled stripe back from disk
+    ## \return The stripe's new container
+    def unspill(self, stripe):
+        spilled = self.stripes[stripe]
+        container = PartitionedContainer()
+        for tup in spilled.store.take(spilled.key):
+            container.add(tup)
+
+        self.stripes[stripe] = container
+        self.bytes[stripe] = spilled.bytes
+        return container
@@ -24,26 +24,73 @@
 ## \author Andrew Wilkinson <aw@cs.york.ac.uk>
 ##
 
+import bisect
+import itertools
+from collections import Counter, OrderedDict, deque
+import sys
 import threading
+import time
 
-from .tuplecontainer import TupleContainer, doesMatch, NoTuple
-from .messages import get_references, decrement_ref, unblock, return_tuple, get_blocked_list, get_threads
+from .tuplecontainer import StripedContainer, NoTuple
+from .template import compileTemplate
+from .messages import unblock, block_when_full, fail_when_full, evict_when_full
 
+from .waiters import WaiterRegistry
+
+from . import deadlock
+from . import delivery
+from . import durability
+from . import expiry
+from . import garbage
 from . import kernel
+from . import stats
 
 # Nasty hack to make lists work inside our tuplespace
+#
+# The list is frozen into a tuple, which is smaller than a list and can be hashed without being copied again, and
+# the hash is only worked out if it's needed. When the tuple is sent back to a client an ImmutableList is pickled as
+# a list, so the tuples we store can be sent back without being converted first.
 class ImmutableList:
+    __slots__ = ("t", "hash")
+
     def __init__(self, l):
-        self.l = l
-        self.hash = hash(tuple(l))
+        self.t = tuple(l)
+        self.hash = None
     def __eq__(self, other):
-        return isinstance(other, ImmutableList) and (self.l == other.l)
+        return isinstance(other, ImmutableList) and (self.t == other.t)
+    def __ne__(self, other):
+        return not self.__eq__(other)
     def __hash__(self):
+        if self.hash is None:
+            self.hash = hash(self.t)
         return self.hash
+    def __reduce__(self):
+        return (list, (self.t, ))
+
+    @property
+    def l(self):
+        return list(self.t)
+
+# Whether tuples with a given type signature contain anything that convertLists or decodeLists would change. Most
+# tuples contain no lists, and the same signatures are used over and over, so caching this lets us return those
+# tuples untouched without looking at each element.
+_convert = {}
+_decode = {}
+
+def _needsConversion(signature, cache, classes):
+    try:
+        return cache[signature]
+    except KeyError:
+        if len(cache) > 4096: # don't let unusual tuples fill up the cache
+            cache.clear()
+        needed = cache[signature] = type in signature or [c for c in signature if issubclass(c, classes)] != []
+        return needed
 
 def convertLists(tup):
+    if not _needsConversion(tuple(map(type, tup)), _convert, (list, tuple)):
+        return tup
     def convert(t):
-        if t == list:
+        if t is list:
             return ImmutableList
         elif isinstance(t, list):
             return ImmutableList(t)
@@ -53,18 +100,52 @@ def convertLists(tup):
             return t
     return tuple(map(convert, tup))
 
+## \brief Convert a tuple from the tuplespace back into the form it was given to us in
+##
+## ImmutableLists are pickled as lists so they're left alone, only the ImmutableList class itself (which took the
+## place of the list class) has to be changed back.
 def decodeLists(tup):
+    if not _needsConversion(tuple(map(type, tup)), _decode, (tuple, )):
+        return tup
     def decode(t):
-        if t == ImmutableList:
+        if t is ImmutableList:
             return list
-        elif isinstance(t, ImmutableList):
-            return t.l
         elif isinstance(t, tuple):
             return decodeLists(t)
         else:
             return t
     return tuple(map(decode, tup))
 
+## \brief Returns an estimate of the memory, in bytes, taken up by a tuple stored in a tuplespace
+##
+## This counts the tuple and everything in it, including the contents of any lists and tuples it contains, but an
+## object that appears more than once is counted each time.
+def tupleSize(tup):
+    size = sys.getsizeof(tup)
+    for e in tup:
+        if isinstance(e, tuple):
+            size += tupleSize(e)
+        elif isinstance(e, ImmutableList):
+            size += sys.getsizeof(e) + tupleSize(e.t)
+        else:
+            size += sys.getsizeof(e)
+    return size
+
+## \brief Returns a copy of a tuple with the tuplespace references replaced by their ids, so tuples read from disk can
+## be compared with those we hold
+def referenceKey(tup):
+    def key(e):
+        if isinstance(e, tuple):
+            return referenceKey(e)
+        elif isinstance(e, kernel.TupleSpace):
+            return ("ts", e._id)
+        return e
+    return tuple(map(key, tup))
+
+# Every change to the references or blocked processes of a tuplespace gives it a new epoch number from this counter,
+# so the deadlock detector can tell if it has changed since it last looked
+epochs = itertools.count(1)
+
 ## \class TupleSpace
 ## \internal
 ## \brief This class is the actual tuplespace stored on the server. The class kernel::TupleSpace is a reference to one instance of this class.
@@ -72,113 +153,545 @@ def decodeLists(tup):
 ## \author Andrew Wilkinson <aw@cs.york.ac.uk>
 ##
 class TupleSpace:
-    def __init__(self, _id):
+    def __init__(self, _id, max_tuples=None, max_bytes=None, when_full=block_when_full):
         self._id = _id
-        self.lock = threading.Semaphore()
+        self.lock = threading.Semaphore() # guards the dictionary of stripe locks
 
-        self.ts = TupleContainer()
+        self.ts = StripedContainer(tupleSize)
+        self.locks = {} # stripe -> Semaphore
+
+        self.wait_semaphore = threading.Semaphore()
+        self.lock_waits = 0 # the number of times we've had to wait for a stripe lock...
+        self.lock_wait_time = 0.0 # ... and the total time spent waiting, in seconds
 
         self.killlock = threading.Semaphore()
         self.ref_semaphore = threading.Semaphore()
         self.blocked_semaphore = threading.Semaphore()
-        self.refs = []
-        self.blocked_list = {}
+        self.refs = Counter() # owner -> number of references it holds
+        self.ref_count = 0 # the total number of references
+        # true once a tuple holding a tuplespace reference has been added. Taking such a tuple counts the reference
+        # with a message to the server.
+        self.holds_references = False
+        self.blocked_list = WaiterRegistry()
+        self.epoch = next(epochs)
+
+        self.pending = None # set when our tuples are still to be loaded from a snapshot, see durability::Store
+
+        self.leases = {} # tuple -> leases on copies of the tuple, the first to expire first. Guarded by the stripe lock.
+        self.expired = 0 # the number of tuples removed because their lease expired
+
+        # The capacity of the tuplespace. space guards the number of tuples and bytes we hold, and is waited on by
+        # processes outputting to a full tuplespace. Space is reserved before a tuple is added, so we never go over.
+        self.max_tuples = max_tuples
+        self.max_bytes = max_bytes
+        self.when_full = when_full
+        self.bounded = max_tuples is not None or max_bytes is not None
+        self.space = threading.Condition()
+        self.tuple_count = 0
+        self.byte_count = 0
+        self.evicted = 0 # the number of tuples removed to make space for new ones
+        # With evict_when_full we keep the tuples in the order they were added, so we know which is the oldest
+        self.order = OrderedDict() # sequence number -> tuple
+        self.sequences = {} # tuple -> sequence numbers of its copies, oldest first
+        self.sequence = itertools.count()
 
     def __del__(self):
         print("TupleSpace %s being deleted..." % (self._id, ))
 
     ## \brief This function is called to put a tuple into the tuplespace
-    def _out(self, tup):
+    ## \param tup The tuple to output
+    ## \param ttl If not None, the number of seconds after which the tuple is removed if no process has taken it
+    ## \param can_fail If False and the tuplespace is full we wait for space even if it was created with
+    ## fail_when_full, for tuples that are being moved from another tuplespace and have nowhere else to go
+    def _out(self, tup, ttl=None, can_fail=True):
         tup = convertLists(tup)
 
-        self.lock.acquire()
+        if self.bounded:
+            # wait for space before we lock anything, so processes removing tuples aren't held up
+            self.reserve(tup, can_fail)
+
+        ticket = None
+        deliveries = [] # the processes woken by the tuple, which are sent it once the locks are released
+        locks = self.acquire([self.ts.stripeOf(tup)])
         try:
             # Before we add the tuple to the tuplespace we need to check if any processes are waiting on a template
-            # that this tuple matches - first we get a list of the blocked processes
+            # that this tuple matches - the registry only checks the templates that could match it
             self.blocked_semaphore.acquire()
             try:
-                blist = list(self.blocked_list.keys())
+                readers, taker = self.blocked_list.wake(tup)
+                if readers or taker is not None:
+                    self.epoch = next(epochs)
             finally:
                 self.blocked_semaphore.release()
 
-            def check_blocked(tid):
-                # for each blocked process...
-                if doesMatch(self.blocked_list[tid][0], tup):
-                    # ... if the tuple matches their template wake them up.
-                    destructive = self.blocked_list[tid][2]
-                    del self.blocked_list[tid]
+            # wake up every process doing a rd...
+            deliveries.extend(readers)
 
-                    def do_return_tuple():
-                        utils.containsTS(tup, lambda x: x._addreference(utils.getProcessIdFromThreadId(tid))) # update references for the tuple
-                        kernel.message(return_tuple, tid, utils.encode(tup)) # return the tuple to the process
+            # ... and if a process was doing an in then it takes the tuple, so we stop here
+            if taker is not None:
+                deliveries.append(taker)
+                if self.bounded:
+                    self.free(tup, False) # the tuple was never stored
+                return
 
-                    threading.Thread(target=do_return_tuple).start()
+            deadline = None
+            if ttl is not None:
+                deadline = time.time() + ttl
+            self.insert(tup, deadline)
 
-                    if destructive == True: # if they were doing an in then stop here, otherwise we continue
-                        raise EOFError
+            if durability.log is not None:
+                ticket = durability.log.append(("out", self._id, tup, deadline))
+        finally:
+            self.release(locks)
+            # the delivery queue may be full, so we mustn't wait for space in it while holding the locks
+            for tid in deliveries:
+                delivery.pipeline.put(tid, decodeLists(tup))
 
+        if ticket is not None: # wait until the tuple is safely on disk
+            durability.log.wait(ticket)
+
+    ## \brief This function is called to put several tuples into the tuplespace at once
+    ##
+    ## The tuples are added under one acquisition of the stripe locks they need, with one pass over the blocked
+    ## processes. In a bounded tuplespace they are added as space is reserved for them, so a batch bigger than the
+    ## tuplespace doesn't wait for space its own tuples are taking up.
+    ## \return The number of tuples added. With fail_when_full this stops at the first tuple there isn't space for.
+    ## \param tups A list of tuples to output
+    ## \param ttl If not None, the number of seconds after which each tuple is removed if no process has taken it
+    def _out_many(self, tups, ttl=None):
+        tups = list(map(convertLists, tups))
+
+        deadline = None
+        if ttl is not None:
+            deadline = time.time() + ttl
+
+        accepted = 0
+        while accepted < len(tups):
+            batch = tups[accepted:]
+            if self.bounded:
+                try:
+                    self.reserve(batch[0], True)
+                except kernel.TupleSpaceFull:
+                    break
+                n = 1
+                while n < len(batch) and self.reserve(batch[n], True, False):
+                    n += 1
+                batch = batch[:n]
+            self.outBatch(batch, deadline)
+            accepted += len(batch)
+        return accepted
+
+    ## \brief Add a batch of tuples, for which space has been reserved, giving them to blocked processes first
+    def outBatch(self, tups, deadline):
+        ticket = None
+        deliveries = [] # (thread id, tuple) for each process woken, which are sent once the locks are released
+        locks = self.acquire(sorted(set([self.ts.stripeOf(tup) for tup in tups])))
+        try:
+            woken = [([], None)] * len(tups)
+            self.blocked_semaphore.acquire()
             try:
-                list(map(check_blocked, blist))
-            except EOFError:
-                return
+                if len(self.blocked_list) > 0:
+                    woken = [self.blocked_list.wake(tup) for tup in tups]
+                    if [w for w in woken if w[0] or w[1] is not None]:
+                        self.epoch = next(epochs)
+            finally:
+                self.blocked_semaphore.release()
 
-            self.ts.add(tup) # add the tuple to the tuplespace
+            for tup, (readers, taker) in zip(tups, woken):
+                for tid in readers:
+                    deliveries.append((tid, tup))
+                if taker is not None:
+                    deliveries.append((taker, tup))
+                    if self.bounded:
+                        self.free(tup, False)
+                    continue
+
+                self.insert(tup, deadline)
+                if durability.log is not None:
+                    ticket = durability.log.append(("out", self._id, tup, deadline))
         finally:
-            self.lock.release()
+            self.release(locks)
+            for tid, tup in deliveries:
+                delivery.pipeline.put(tid, decodeLists(tup))
+
+        if ticket is not None: # wait until the tuples are safely on disk
+            durability.log.wait(ticket)
+
+    ## \brief Add a tuple to the tuplespace, with a lease if it has a deadline. The stripe lock must be held.
+    def insert(self, tup, deadline):
+        self.ts.add(tup)
+        if not self.holds_references:
+            utils.containsTS(tup, self.heldReference)
+        if self.bounded and self.when_full == evict_when_full:
+            self.stored(tup)
+
+        if deadline is not None:
+            lease = expiry.Lease(self, tup, deadline)
+            bisect.insort(self.leases.setdefault(tup, []), lease)
+            expiry.wheel.add(lease)
+
+    def heldReference(self, ts):
+        self.holds_references = True
 
     ## \brief This function is called when a process reads from the tuplespace
     ##
     ## If a matching tuple is immediatly found then it is returned, otherwise <b>None</b> is returned and
     ## the process is added to the list of blocked processes
     def _rd(self, tid, pattern, unblockable):
-        pattern = convertLists(pattern)
+        pattern = compileTemplate(convertLists(pattern))
 
-        self.lock.acquire()
+        locks = self.acquire(self.ts.stripesFor(pattern))
         try:
             try:
                 # try to match a tuple
                 r = self.ts.matchOneTuple(pattern)
             except NoTuple:
-                # if we didn't find a tuple then we block
-                self.blocked_list[tid] = (pattern, unblockable, False)
-                # check that we have created a deadlock
-                if self.isDeadLocked():
-                    # if we have then unblock a random process
-                    self.unblockRandom()
+                # if we didn't find a tuple then we block, keeping the compiled template to check new tuples against
+                self.block(tid, pattern, unblockable, False)
             else:
                 # we found a tuple so update the references and return it
                 utils.containsTS(r, lambda x: x._addreference(utils.getProcessIdFromThreadId(tid)))
-                return utils.encode(decodeLists(r))
+                return decodeLists(r)
         finally:
-            self.lock.release()
+            self.release(locks)
+
+    ## \brief This function is called when a process reads several tuples at once
+    ##
+    ## Like _rd, but every matching tuple is returned, up to max_n. If none match then <b>None</b> is returned and the
+    ## process is blocked until one tuple is output that does.
+    def _rd_many(self, tid, pattern, max_n):
+        pattern = compileTemplate(convertLists(pattern))
+
+        locks = self.acquire(self.ts.stripesFor(pattern))
+        try:
+            tups = self.matchUpTo(pattern, max_n)
+            if len(tups) == 0:
+                self.block(tid, pattern, False, False)
+                return None
+
+            for r in tups:
+                utils.containsTS(r, lambda x: x._addreference(utils.getProcessIdFromThreadId(tid)))
+            return list(map(decodeLists, tups))
+        finally:
+            self.release(locks)
+
+    ## \brief This function is called when a process ins several tuples at once
+    ##
+    ## Like _in, but every matching tuple is removed and returned, up to max_n. If none match then <b>None</b> is
+    ## returned and the process is blocked until one tuple is output that does.
+    def _in_many(self, tid, pattern, max_n):
+        pattern = compileTemplate(convertLists(pattern))
+
+        ticket = None
+        locks = self.acquire(self.ts.stripesFor(pattern))
+        try:
+            tups = self.matchUpTo(pattern, max_n)
+            if len(tups) == 0:
+                self.block(tid, pattern, False, True)
+                return None
+
+            for r in tups:
+                utils.containsTS(r, lambda x: x._addreference(utils.getProcessIdFromThreadId(tid)))
+                self.ts.delete(r)
+                ticket = self.removed(r)
+        finally:
+            self.release(locks)
+
+        if ticket is not None: # wait until the removals are safely on disk
+            durability.log.wait(ticket)
+        return list(map(decodeLists, tups))
+
+    ## \brief Returns up to max_n tuples matching a compiled template. The stripe locks for it must be held.
+    def matchUpTo(self, pattern, max_n):
+        tups = []
+        try:
+            m = self.ts.matchTuples(pattern)
+            while len(tups) < max_n:
+                tups.append(next(m))
+        except (NoTuple, StopIteration):
+            pass
+        return tups
+
+    ## \brief Add a process to the blocked list, keeping the compiled template to check new tuples against
+    def block(self, tid, pattern, unblockable, destructive):
+        self.blocked_semaphore.acquire()
+        try:
+            self.blocked_list.add(tid, pattern, unblockable, destructive)
+            self.epoch = next(epochs)
+        finally:
+            self.blocked_semaphore.release()
+        # blocking may have caused a deadlock, which the deadlock detector will check for in the background
+        deadlock.detector.changed(self)
 
     ## \brief This function is called when a process ins from the tuplespace
     ##
     ## If a matching tuple is immediatly found then it is returned, otherwise <b>None</b> is returned and
     ## the process is added to the list of blocked processes
     def _in(self, tid, pattern, unblockable):
-        pattern = convertLists(pattern)
+        pattern = compileTemplate(convertLists(pattern))
 
-        self.lock.acquire()
+        ticket = None
+        locks = self.acquire(self.ts.stripesFor(pattern))
         try:
             try:
                 # try to match a tuple
                 r = self.ts.matchOneTuple(pattern)
             except NoTuple:
-                # if we didn't find a tuple then we block
-                self.blocked_list[tid] = (pattern, unblockable, True)
-                # check that we have created a deadlock
-                if self.isDeadLocked():
-                    # if we have then unblock a random process
-                    self.unblockRandom()
+                # if we didn't find a tuple then we block, keeping the compiled template to check new tuples against
+                self.block(tid, pattern, unblockable, True)
+                return None
             else:
                 # we found a tuple so update the references and return it
                 utils.containsTS(r, lambda x: x._addreference(utils.getProcessIdFromThreadId(tid)))
                 self.ts.delete(r) # since this is destructive delete the tuple from the tuplespace
+                ticket = self.removed(r)
+        finally:
+            self.release(locks)
 
-                return utils.encode(decodeLists(r))
+        if ticket is not None: # wait until the removal is safely on disk
+            durability.log.wait(ticket)
+        return decodeLists(r)
+
+    ## \brief Called when a tuple has been removed by a process, to cancel its lease and free the space it took up
+    ##
+    ## The stripe lock for the tuple must be held.
+    ## \return The sequence number of the removal in the operation log, or None if the server isn't durable
+    def removed(self, tup):
+        self.cancelLease(tup)
+        if self.bounded:
+            self.free(tup)
+        if durability.log is not None:
+            return durability.log.append(("take", self._id, tup))
+
+    ## \brief Called when a process takes a tuple, to cancel a lease if there are now more leases than copies
+    ##
+    ## Copies of a tuple can't be told apart, so the lease that would expire first is cancelled. The stripe lock for
+    ## the tuple must be held.
+    def cancelLease(self, tup):
+        leases = self.leases.get(tup)
+        if leases is None or len(leases) <= self.ts.count(tup):
+            return
+        leases.pop(0).cancel()
+        if len(leases) == 0:
+            del self.leases[tup]
+
+    ## \brief Remove the tuples whose leases have expired
+    ## \return The number of tuples removed
+    ## \param leases A list of expired leases on tuples in this tuplespace
+    def expire(self, leases):
+        container = self.ts
+        if container is None: # we've been garbage collected
+            return 0
+
+        stripes = {} # stripe -> leases on tuples in the stripe
+        for lease in leases:
+            tup = lease.tup
+            if tup is not None: # not cancelled since it expired
+                stripes.setdefault(container.stripeOf(tup), []).append(lease)
+
+        # take the stripes in locking order, so we can't deadlock with an operation locking several stripes
+        locks = self.acquire(sorted(stripes.keys()))
+        try:
+            if self.ts is None: # we've been garbage collected
+                return 0
+
+            removed = 0
+            for stripe in sorted(stripes.keys()):
+                for lease in stripes[stripe]:
+                    if lease.cancelled:
+                        continue
+                    tup = lease.tup
+                    lease.cancel()
+                    leases = self.leases[tup]
+                    leases.remove(lease)
+                    if len(leases) == 0:
+                        del self.leases[tup]
+                    self.ts.delete(tup)
+                    if self.bounded:
+                        self.free(tup)
+                    if durability.log is not None:
+                        durability.log.append(("take", self._id, tup))
+                    removed += 1
+            self.expired += removed
+            return removed
         finally:
-            self.lock.release()
+            self.release(locks)
+
+    ## \brief Put back a tuple that was read from disk by durability::Store
+    def restore(self, tup, deadline):
+        tup = convertLists(tup)
+        locks = self.acquire([self.ts.stripeOf(tup)])
+        try:
+            if self.bounded:
+                # the tuple was stored before, so it must fit
+                self.space.acquire()
+                try:
+                    self.tuple_count += 1
+                    if self.max_bytes is not None:
+                        self.byte_count += tupleSize(tup)
+                finally:
+                    self.space.release()
+            self.insert(tup, deadline)
+        finally:
+            self.release(locks)
+
+    ## \brief Remove a tuple that was read from disk by durability::Store
+    ##
+    ## The tuplespace references in the tuple will be different objects to those we hold, so they are compared by id.
+    ## \return The tuple removed, or None if we don't hold it
+    def discard(self, tup):
+        tup = convertLists(tup)
+
+        refs = []
+        utils.containsTS(tup, refs.append)
+        if len(refs) == 0:
+            template = None
+            stripes = [self.ts.stripeOf(tup)]
+        else:
+            # match on everything but the elements holding references, then compare those ourselves
+            def formal(e):
+                if isinstance(e, kernel.TupleSpace):
+                    return kernel.TupleSpace
+                elif isinstance(e, tuple) and referenceKey(e) != e:
+                    return tuple
+                return e
+            template = tuple(map(formal, tup))
+            stripes = self.ts.stripesFor(template)
+
+        locks = self.acquire(stripes)
+        try:
+            if template is None:
+                if self.ts.count(tup) == 0:
+                    return None
+                found = tup
+            else:
+                found = None
+                try:
+                    for r in self.ts.matchTuples(template):
+                        if referenceKey(r) == referenceKey(tup):
+                            found = r
+                            break
+                except NoTuple:
+                    pass
+                if found is None:
+                    return None
+
+            self.ts.delete(found)
+            self.removed(found)
+            return found
+        finally:
+            self.release(locks)
+
+    ## \brief Returns a copy of the tuplespace to be written to a snapshot by durability::Store. Every lock must be
+    ## held.
+    ## \return None if we've been garbage collected, otherwise our capacity, a list of (tuple, deadline) pairs, and
+    ## the ids of the tuplespaces referred to by the tuples
+    def copy(self):
+        if self.ts is None:
+            return None
+        capacity = (self.max_tuples, self.max_bytes, self.when_full)
+        if self.pending is not None: # we haven't been loaded, so just copy what was loaded from
+            snapshot, offset, size, refs = self.pending
+            return capacity, snapshot.raw(offset, size), refs
+
+        deadlines = {} # tuple -> deadlines of its leases, in the order we hand them out to its copies
+        tuples = []
+        refs = []
+        for tup in self.ts.matchAllTuples():
+            if tup in self.leases:
+                if tup not in deadlines:
+                    deadlines[tup] = iter([lease.deadline for lease in self.leases[tup]])
+                tuples.append((tup, next(deadlines[tup], None)))
+            else:
+                tuples.append((tup, None))
+            utils.containsTS(tup, lambda t: refs.append(t._id))
+        return capacity, tuples, refs
+
+    ## \brief Reserve space for a tuple that is about to be added, handling a full tuplespace as asked when it was
+    ## created
+    ## \param wait If False and the tuplespace is full, False is returned rather than waiting or failing. With
+    ## evict_when_full the oldest tuples are still evicted, and False is only returned once there are none left.
+    ## \return True once the space has been reserved
+    def reserve(self, tup, can_fail, wait=True):
+        size = 0
+        if self.max_bytes is not None:
+            size = tupleSize(tup)
+            if size > self.max_bytes: # this would never fit, however long we waited
+                if not wait:
+                    return False
+                raise kernel.TupleSpaceFull("tuple of %i bytes is bigger than tuplespace %s" % (size, self._id))
+
+        when_full = self.when_full
+        if when_full == fail_when_full and not can_fail:
+            when_full = block_when_full
+
+        self.space.acquire()
+        try:
+            while (self.max_tuples is not None and self.tuple_count >= self.max_tuples) or \
+                  (self.max_bytes is not None and self.byte_count + size > self.max_bytes):
+                if when_full == evict_when_full and len(self.order) > 0:
+                    # we can't take the stripe lock while holding space, as removing a tuple takes them the other way
+                    # round, so let go while we evict and then check again
+                    oldest = next(iter(self.order.values()))
+                    self.space.release()
+                    try:
+                        self.evict(oldest)
+                    finally:
+                        self.space.acquire()
+                elif not wait:
+                    return False
+                elif when_full == fail_when_full:
+                    raise kernel.TupleSpaceFull("tuplespace %s is full" % (self._id, ))
+                else:
+                    # wait for a tuple to be removed, or with evict_when_full for a tuple we could evict to be stored
+                    self.space.wait()
+
+            self.tuple_count += 1
+            self.byte_count += size
+        finally:
+            self.space.release()
+        return True
+
+    ## \brief Free the space taken up by a tuple, and wake any processes waiting for space
+    ## \param stored False if the tuple was taken by a blocked process and never stored
+    def free(self, tup, stored=True):
+        self.space.acquire()
+        try:
+            self.tuple_count -= 1
+            if self.max_bytes is not None:
+                self.byte_count -= tupleSize(tup)
+            if stored and self.when_full == evict_when_full:
+                sequences = self.sequences[tup]
+                del self.order[sequences.popleft()]
+                if len(sequences) == 0:
+                    del self.sequences[tup]
+            self.space.notify_all()
+        finally:
+            self.space.release()
+
+    ## \brief Record the order in which tuples were added, so the oldest can be evicted
+    def stored(self, tup):
+        self.space.acquire()
+        try:
+            sequence = next(self.sequence)
+            self.order[sequence] = tup
+            self.sequences.setdefault(tup, deque()).append(sequence)
+            self.space.notify_all() # processes waiting to evict a tuple now have one
+        finally:
+            self.space.release()
+
+    ## \brief Remove a tuple to make space for a new one
+    def evict(self, tup):
+        locks = self.acquire([self.ts.stripeOf(tup)])
+        try:
+            # a process may have taken it since we chose it, in which case there is more space anyway
+            if self.ts.count(tup) > 0:
+                self.ts.delete(tup)
+                self.removed(tup)
+                self.evicted += 1
+                stats.inc_stat("tuples_evicted")
+        finally:
+            self.release(locks)
 
     ## \brief If we encounter a deadlock this function is called to unblock a process
     def unblockRandom(self):
@@ -197,7 +710,8 @@ class TupleSpace:
                 p, l = l[0], l[1:]
 
             # Delete the process we're unblocking from the blocked list and send it an unblock message
-            del self.blocked_list[p]
+            self.blocked_list.remove(p)
+            self.epoch = next(epochs)
             kernel.message(unblock, p)
         finally:
             self.blocked_semaphore.release()
@@ -208,9 +722,10 @@ class TupleSpace:
     ## \return A list of tuples matching the pattern
     ## \param pattern The pattern to match the tuples against
     def collect(self, pattern):
-        pattern = convertLists(pattern)
+        pattern = compileTemplate(convertLists(pattern))
 
-        self.lock.acquire()
+        ticket = None
+        locks = self.acquire(self.ts.stripesFor(pattern))
         try:
             tups = []
             try:
@@ -220,17 +735,21 @@ class TupleSpace:
             except (NoTuple, StopIteration): # Stop when we get a NoTuple or a StopIteration exception
                 for t in tups: # Delete the tuples we've found
                     self.ts.delete(t)
-                return list(map(decodeLists, tups)) # return the list of tuples
+                    ticket = self.removed(t)
         finally:
-            self.lock.release()
+            self.release(locks)
+
+        if ticket is not None: # wait until the removals are safely on disk
+            durability.log.wait(ticket)
+        return list(map(decodeLists, tups)) # return the list of tuples
 
     ## \brief This is called when a process does a copy_collect operation.
     ## \return A list of tuples matching the pattern
     ## \param pattern The pattern to match the tuples against
     def copy_collect(self, pattern):
-        pattern = convertLists(pattern)
+        pattern = compileTemplate(convertLists(pattern))
 
-        self.lock.acquire()
+        locks = self.acquire(self.ts.stripesFor(pattern))
         try:
             tups = []
             try:
@@ -239,9 +758,104 @@ class TupleSpace:
                     tups.append(next(m))
             except (NoTuple, StopIteration): # Stop when we get a NoTuple or a StopIteration exception
                 return list(map(decodeLists, tups)) # return the list of tuples
+        finally:
+            self.release(locks)
+
+    ## \brief Returns the number of tuples held with each type signature
+    ## \return A dictionary mapping signature names, such as "(str, int, float)", to tuple counts
+    def signatureCounts(self):
+        if self.ts is None: # we've been garbage collected
+            return {}
+        locks = self.acquireAll()
+        try:
+            return self.ts.signatureCounts()
+        finally:
+            self.releaseAll(locks)
+
+    ## \brief Returns the number of tuples held and their estimated size, in total and for each type signature
+    ## \return A dictionary holding the number of "tuples", their size in "bytes", the size of those held in memory
+    ## rather than spilled to disk in "resident_bytes", and a dictionary of "signatures" mapping each signature name to a
+    ## (number of tuples, bytes) pair
+    def memoryUsage(self):
+        if self.ts is None: # we've been garbage collected
+            return {"tuples": 0, "bytes": 0, "resident_bytes": 0, "signatures": {}}
+        locks = self.acquireAll()
+        try:
+            signatures = self.ts.signatureUsage()
+            resident = self.ts.residentBytes()
+        finally:
+            self.releaseAll(locks)
+        return {"tuples": sum([s[0] for s in signatures.values()]), "bytes": sum([s[1] for s in signatures.values()]),
+                "resident_bytes": resident, "signatures": signatures}
+
+    ## \brief Returns the number of times an operation has had to wait for a lock held by another operation, and
+    ## the total time, in microseconds, spent waiting
+    def lockStats(self):
+        self.wait_semaphore.acquire()
+        try:
+            return {"waits": self.lock_waits, "wait_time_us": int(self.lock_wait_time * 1e6)}
+        finally:
+            self.wait_semaphore.release()
+
+    ## \brief Lock the given stripes of the tuplespace
+    ##
+    ## Tuples are divided between stripes (see tuplecontainer::StripedContainer) which are locked separately, so
+    ## operations on tuples that can never match each other don't have to wait for each other. The stripes must be in
+    ## the order given by the tuple container.
+    ## \return The locks acquired, which should be passed to release
+    ## \param stripes A list of stripes
+    def acquire(self, stripes):
+        self.lock.acquire()
+        try:
+            locks = []
+            for stripe in stripes:
+                try:
+                    locks.append(self.locks[stripe])
+                except KeyError:
+                    lock = self.locks[stripe] = threading.Semaphore()
+                    locks.append(lock)
         finally:
             self.lock.release()
 
+        for lock in locks:
+            self.wait(lock)
+        return locks
+
+    ## \brief Release the locks returned by acquire
+    def release(self, locks):
+        for lock in reversed(locks):
+            lock.release()
+
+    ## \brief Lock the whole tuplespace, so no stripes can be used or created until releaseAll is called
+    ## \return The locks acquired, which should be passed to releaseAll
+    def acquireAll(self):
+        self.lock.acquire()
+        locks = [self.locks[stripe] for stripe in sorted(self.locks.keys())]
+        for lock in locks:
+            self.wait(lock)
+        return locks
+
+    ## \brief Release the locks returned by acquireAll
+    def releaseAll(self, locks):
+        self.release(locks)
+        self.lock.release()
+
+    ## \brief Acquire a lock, recording how long we had to wait for it if it was already held
+    def wait(self, lock):
+        if lock.acquire(False):
+            return
+
+        start = time.time()
+        lock.acquire()
+        waited = time.time() - start
+
+        self.wait_semaphore.acquire()
+        try:
+            self.lock_waits += 1
+            self.lock_wait_time += waited
+        finally:
+            self.wait_semaphore.release()
+
     ## \brief Add a new reference to the tuplespace
     ## \param ref The object that will own the reference
     def addreference(self, ref):
@@ -250,7 +864,9 @@ class TupleSpace:
         assert not utils.isThreadId(ref)
         self.ref_semaphore.acquire()
         try:
-            self.refs.append(ref)
+            self.refs[ref] += 1
+            self.ref_count += 1
+            self.epoch = next(epochs)
         finally:
             self.ref_semaphore.release()
 
@@ -264,31 +880,36 @@ class TupleSpace:
 
             self.ref_semaphore.acquire()
             try:
-                try:
-                    self.refs.remove(ref) # Remove the reference from the list
-                except ValueError: # if the reference doesn't exist then ValueError is raise - and something has gone badly wrong
-                    print("!!!%s not in %s for %s" % (ref, str(self.refs), self._id))
+                count = self.refs.get(ref, 0)
+                if count == 0: # if the reference doesn't exist then something has gone badly wrong
+                    print("!!!%s not in %s for %s" % (ref, str(dict(self.refs)), self._id))
                     raise SystemError("Internal reference counting error")
+                elif count == 1:
+                    del self.refs[ref]
+                else:
+                    self.refs[ref] = count - 1
+                self.ref_count -= 1
+                self.epoch = next(epochs)
             finally:
                 self.ref_semaphore.release()
 
             # This is just a sanity check to make sure something hasn't gone horribly wrong...
             self.blocked_semaphore.acquire()
             try:
-                if ref in list(self.blocked_list.keys()):
+                if ref in self.blocked_list:
                     raise SystemError("Deleting reference for a blocked process " + str(list(self.blocked_list.keys())))
             finally:
                 self.blocked_semaphore.release()
         finally:
             self.killlock.release()
 
-        # if a reference is removed this may mean the remaining processes are deadlocked - check if that is the case
-        if self.isDeadLocked():
-            self.unblockRandom()
-        # check to see if we're now garbage
-        self.doGarbageCollection()
+        # if a reference is removed this may mean the remaining processes are deadlocked - the deadlock detector will
+        # check if that is the case
+        deadlock.detector.changed(self)
+        # we may now be garbage, which the garbage collector will check in the background
+        garbage.collector.candidate(self)
 
-        return len(self.refs) # return the number of remaining references
+        return self.ref_count # return the number of remaining references
 
     ## \brief Remove all references from the given object to this tuplespace
     ## \param ref The object with the references
@@ -314,65 +935,48 @@ class TupleSpace:
             # This is just a sanity check to make sure something hasn't gone horribly wrong...
             self.blocked_semaphore.acquire()
             try:
-                if ref in list(self.blocked_list.keys()):
+                if ref in self.blocked_list:
                     print("ERROR : Deleting references for a blocked process %s" % (str(list(self.blocked_list.keys())), ))
             finally:
                 self.blocked_semaphore.release()
 
             self.ref_semaphore.acquire()
             try:
-                try:
-                    while True: # Remove all references...
-                        self.refs.remove(ref)
-                except ValueError: # ... until there are none left and a ValueError is raised.
-                    pass
+                self.ref_count -= self.refs.pop(ref, 0) # Remove all references
+                self.epoch = next(epochs)
             finally:
                 self.ref_semaphore.release()
         finally:
             self.killlock.release()
 
-        # if a reference is removed this may mean the remaining processes are deadlocked - check if that is the case
-        if self.isDeadLocked():
-            self.unblockRandom()
-        # check to see if we're now garbage
-        self.doGarbageCollection()
-
-        return len(self.refs) # return the number of remaining references
+        # if a reference is removed this may mean the remaining processes are deadlocked - the deadlock detector will
+        # check if that is the case
+        deadlock.detector.changed(self)
+        # we may now be garbage, which the garbage collector will check in the background
+        garbage.collector.candidate(self)
 
-    ## \brief Check to see if we are not needed by the system
-    ##
-    ## This function won't actually delete the tuplespace object, that is only done if the number of references falls
-    ## to zero - what is does do is empty the tuplespace, causing any reference this tuplespace has to others to be
-    ## deleted.
-    def doGarbageCollection(self):
-        memo = [self._id] # what tuplespaces have we already checked?
-        to_check = self.refs[:] # what tuplespaces are left to check?
-        while len(to_check) > 0:
-            i, to_check = to_check[0], to_check[1:] # get the first on our list
-            if i in memo: # if we've already checked it then skip it
-                continue
-
-            assert not utils.isThreadId(i)
-
-            if utils.isNodeId(i) or utils.isProcessId(i) or (i == "0:0"):
-                # this is either a node, a process or the universal tuplespace so we're still active
-                return
+        return self.ref_count # return the number of remaining references
 
-            # Extend the to_check list with the other tuplespaces references
-            to_check.extend(utils.decode(kernel.message(get_references, i)))
-
-            # Add the tuplespace we've just checked to the memo.
-            memo.append(i)
-
-        # If we arrive down here then this tuplespace is part of a clique containing only other tuplespaces
-
-        # Because emptying the tuplespace can cause references to be deleted we do it in another thread to allow us
-        # to continue.
-        def kill(me):
-            me.ts = None
-        threading.Thread(target=kill, args=(self, )).start()
+    ## \brief Returns the epoch, references and blocked threads of this tuplespace, for the deadlock detector
+    def getGraph(self):
+        # read the epoch first, so if we change while we're copying we'll be asked again next time
+        epoch = self.epoch
+        self.ref_semaphore.acquire()
+        try:
+            refs = list(self.refs)
+        finally:
+            self.ref_semaphore.release()
+        self.blocked_semaphore.acquire()
+        try:
+            blocked = list(self.blocked_list.keys())
+        finally:
+            self.blocked_semaphore.release()
+        return (epoch, refs, blocked)
 
     ## \brief Checks to see if there is a deadlock in the system
+    ##
+    ## This is called by the deadlock detector, which caches what it knows about other tuplespaces so only those
+    ## that have changed since the last check have to be asked for their references and blocked processes.
     def isDeadLocked(self):
         if self._id == "0:0": # The universal tuplespace can never be deadlocked...
             return False
@@ -386,7 +990,7 @@ class TupleSpace:
         notblocked_thread = [] # what processes are apparently unblocked?
         self.ref_semaphore.acquire()
         try:
-            process = self.refs[:] # what processes are left to check?
+            process = list(self.refs) # what processes are left to check?
         finally:
             self.ref_semaphore.release()
         checkedts = [self._id] # what tuplespaces have we checked?
@@ -420,7 +1024,7 @@ class TupleSpace:
                 elif utils.isNodeId(pid):
                     return False
                 else:
-                    threads.extend(utils.decode(kernel.message(get_threads, pid)))
+                    threads.extend(deadlock.detector.getThreads(pid))
 
             elif len(ts) > 0:
                 tid, ts = ts[0], ts[1:]
@@ -432,13 +1036,12 @@ class TupleSpace:
                 checkedts.append(tid)
 
                 # get the references and blocked processes for this tuplespace
-                refs = utils.decode(kernel.message(get_references, tid))
-                blocked = utils.decode(kernel.message(get_blocked_list, tid))
+                epoch, refs, blocked = deadlock.detector.getGraph(tid)
 
                 blocked_thread.extend(blocked)
                 process.extend(refs)
                 for tid in blocked: # for each process that is blocked on the tuplespace we're checking..
-                    if tid in notblocked_process: #..check we haven't marked as not blocked..
+                    if tid in notblocked_thread: #..check we haven't marked as not blocked..
                         del notblocked_thread[notblocked_thread.index(tid)] #.. and if we have mark it as blocked
             else:
                 break
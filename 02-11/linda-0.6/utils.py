@@ -22,12 +22,16 @@
 ## \internal
 
 import _thread
-import struct
 import socket
 
 import pickle
 encode = pickle.dumps
-decode = pickle.loads
+
+def decode(data):
+    """\internal
+    \brief Returns the value in the given data, which may have been encoded by codec.encode or pickled
+    """
+    return codec.decode(data)
 
 try:
     dontwait_flag = socket.MSG_DONTWAIT
@@ -36,7 +40,6 @@ except AttributeError:
 
 #from linda.profile import P
 
-max_msg_size = 1
 def recv(s, msgid=None):
     """\internal
     \brief Receive a message from the given socket
@@ -45,25 +48,16 @@ def recv(s, msgid=None):
     """
     if isinstance(s, connections.Connection):
         return s.recv(msgid)
-    msg = ""
-    while len(msg) < 4:
-        r = s.recv(max_msg_size)
-        if r == "":
-            return None, ""
-        msg += r
-
-    size, msg = struct.unpack("!I", msg[:4])[0], msg[4:]
-
-    if size > len(msg):
-        while size > len(msg):
-            r = s.recv(size - len(msg))
-            if r == "":
-                return None, ""
-            msg += r
-
-    assert size == len(msg)
+    if isinstance(s, framing.Framer):
+        msg = s.read()
+    else:
+        msg = framing.read(s)
+    if msg is None:
+        return None, ""
 
-    return None, decode(msg[:size])
+    if isinstance(s, codec.Framed):
+        return None, s.decode(msg)
+    return None, decode(msg)
 
 def send(s, dest_node, msgid, msg):
     """\internal
@@ -73,13 +67,73 @@ def send(s, dest_node, msgid, msg):
     """
     if isinstance(s, connections.Connection):
         return s.send(dest_node, msgid, msg)
-    msg = encode(msg)
+    if msgid is not None: # a pipelined client, which needs to know which request this replies to
+        msg = (msgid, msg)
     try:
-        s.sendall(struct.pack("!I", len(msg)) + msg, dontwait_flag)
+        if isinstance(s, codec.Framed):
+            s.write(s.encode(msg), dontwait_flag)
+        else:
+            msg = encode(msg)
+            framing.send(s, framing.header.pack(len(msg)), msg, dontwait_flag)
     except socket.error:
         # if we get an error here then just continure, we'll pick it up and exit properly when we next do a recv
         pass
 
+def frame(s, msgid, msg):
+    """\internal
+    \brief Returns a message encoded as send would send it on the given socket, so several can be sent by sendMany
+
+    \param s A socket object
+    """
+    if msgid is not None:
+        msg = (msgid, msg)
+    if isinstance(s, codec.Framed):
+        return s.encode(msg)
+    return encode(msg)
+
+def sendMany(s, frames):
+    """\internal
+    \brief Sends several messages on the given socket at once
+
+    \param s A socket object
+    \param frames A list of messages returned by frame
+    """
+    try:
+        if isinstance(s, framing.Framer):
+            s.writeMany(frames, dontwait_flag)
+        else:
+            for msg in frames:
+                framing.send(s, framing.header.pack(len(msg)), msg, dontwait_flag)
+    except socket.error:
+        pass # as in send
+
+def pack(s, value):
+    """\internal
+    \brief Returns a tuple, or list of tuples, as it is sent in a reply on the given socket
+
+    Pickled messages hold them pickled, while a connection that encodes its messages with the codec module sends them
+    as they are, so a client that asked not to be sent pickles isn't.
+    \param s A socket object
+    \param value The tuple or list of tuples
+    """
+    if isinstance(s, codec.Framed) and s.version is not None:
+        return value
+    return encode(value)
+
+def repack(s, data):
+    """\internal
+    \brief Returns a tuple, or list of tuples, pickled by another server as it is sent in a reply on the given socket
+
+    \param s A socket object
+    \param data The pickled tuple, or any other reply, which is returned as it is
+    """
+    if type(data) is bytes and isinstance(s, codec.Framed) and s.version is not None:
+        value = decode(data)
+        # the tuplespaces in it are only passing through this server, so they mustn't drop a reference when freed
+        containsTS(value, lambda t: setattr(t, "_gc", False))
+        return value
+    return data
+
 def sendrecv(s, dest_node, msgid, msg):
     return recv(s, send(s, dest_node, msgid, msg))
 
@@ -239,4 +293,6 @@ def mask(bits):
 
     return ~((1 << (32 - bits)) - 1)
 
+from linda import codec
 from linda import connections
+from linda import framing
@@ -0,0 +1,186 @@
+#    Copyright 2004 Andrew Wilkinson <aw@cs.york.ac.uk>.
+#
+#    This file is part of PyLinda (http://www-users.cs.york.ac.uk/~aw/pylinda)
+#
+#    PyLinda is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    PyLinda is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with PyLinda; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+## \namespace waiters
+## \brief This module contains the registry of processes blocked on a tuplespace
+## \internal
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+
+## \class Bucket
+## \internal
+## \brief The blocked processes whose templates share an arity and, if they have one, the value of their first
+## actual element.
+##
+## Readers and takers are kept apart as every matching reader is woken by a tuple, but only the first matching taker.
+## Both are dictionaries from sequence number to thread id, and since sequence numbers only ever increase they are
+## held in the order the processes blocked.
+class Bucket:
+    __slots__ = ("readers", "takers")
+
+    def __init__(self):
+        self.readers = {}
+        self.takers = {}
+
+    def isEmpty(self):
+        return len(self.readers) == 0 and len(self.takers) == 0
+
+## \class WaiterRegistry
+## \internal
+## \brief This class holds the processes blocked on a tuplespace, indexed so that when a tuple is output only the
+## templates that could match it are checked.
+##
+## Templates are indexed by their arity and by the position and value of their first actual element. A tuple can
+## only match a template with an actual element at position p if the tuple has an equal element at position p, so
+## for each position used by a template of the right arity we look up the tuple's element and only check the templates
+## found. Templates with no actual elements are kept in a bucket of their own for each arity, and are always checked.
+##
+## The registry behaves like the dictionary it replaced, mapping thread ids to (template, unblockable, destructive)
+## tuples in the order the processes blocked.
+##
+## \author Andrew Wilkinson <aw@cs.york.ac.uk>
+##
+class WaiterRegistry:
+    def __init__(self):
+        self.entries = {} # thread id -> (template, unblockable, destructive)
+        self.location = {} # thread id -> (arity, position, value, sequence number), to find the waiter's bucket
+        self.index = {} # arity -> {position: {value: Bucket}}, with position None holding templates with no actuals
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, tid):
+        return tid in self.entries
+
+    def __getitem__(self, tid):
+        return self.entries[tid]
+
+    def __delitem__(self, tid):
+        self.remove(tid)
+
+    def __setitem__(self, tid, value):
+        self.add(tid, *value)
+
+    def __repr__(self):
+        return repr(self.entries)
+
+    def keys(self):
+        return self.entries.keys()
+
+    ## \brief Register a process as blocked
+    ## \param tid The thread id of the blocked process
+    ## \param plan The compiled template the process is waiting on
+    ## \param unblockable True if the process may be unblocked to break a deadlock
+    ## \param destructive True if the process is doing an in, rather than a rd
+    def add(self, tid, plan, unblockable, destructive):
+        if tid in self.entries:
+            self.remove(tid)
+
+        position, value = plan.probe, None
+        if position is not None:
+            value = plan.template[position]
+            try:
+                hash(value)
+            except TypeError: # we can't index on this element, so the template has to be checked against every tuple
+                position, value = None, None
+
+        positions = self.index.setdefault(plan.arity, {})
+        buckets = positions.setdefault(position, {})
+        bucket = buckets.get(value)
+        if bucket is None:
+            bucket = buckets[value] = Bucket()
+
+        self.seq += 1
+        if destructive:
+            bucket.takers[self.seq] = tid
+        else:
+            bucket.readers[self.seq] = tid
+
+        self.entries[tid] = (plan, unblockable, destructive)
+        self.location[tid] = (plan.arity, position, value, self.seq)
+
+    ## \brief Remove a blocked process from the registry
+    ## \return The (template, unblockable, destructive) tuple the process was registered with
+    def remove(self, tid):
+        entry = self.entries.pop(tid)
+        arity, position, value, seq = self.location.pop(tid)
+
+        positions = self.index[arity]
+        buckets = positions[position]
+        bucket = buckets[value]
+        if entry[2]:
+            del bucket.takers[seq]
+        else:
+            del bucket.readers[seq]
+
+        # throw away anything that is now empty so the index doesn't grow with templates that are no longer used
+        if bucket.isEmpty():
+            del buckets[value]
+            if len(buckets) == 0:
+                del positions[position]
+                if len(positions) == 0:
+                    del self.index[arity]
+
+        return entry
+
+    ## \brief Find and remove the blocked processes that should receive a tuple that has just been output
+    ##
+    ## Every reader waiting on a matching template is woken, as a rd doesn't remove the tuple, along with the taker
+    ## that has been waiting the longest on a matching template.
+    ## \return A pair of the list of readers woken, and the taker woken or None if no taker matches
+    ## \param tup The tuple being output
+    def wake(self, tup):
+        positions = self.index.get(len(tup))
+        if positions is None:
+            return [], None
+
+        readers = []
+        taker = None
+        taker_seq = None
+        for position, buckets in positions.items():
+            if position is None:
+                bucket = buckets.get(None)
+            else:
+                try:
+                    bucket = buckets.get(tup[position])
+                except TypeError: # an unhashable element can't equal any of the indexed values
+                    continue
+            if bucket is None:
+                continue
+
+            for seq, tid in bucket.readers.items():
+                if self.entries[tid][0].matches(tup):
+                    readers.append(tid)
+
+            # takers are in the order they blocked so we only need the first match from each bucket, and only then if
+            # it blocked before the best one we've found so far
+            for seq, tid in bucket.takers.items():
+                if taker_seq is not None and seq > taker_seq:
+                    break
+                if self.entries[tid][0].matches(tup):
+                    taker, taker_seq = tid, seq
+                    break
+
+        for tid in readers:
+            self.remove(tid)
+        if taker is not None:
+            self.remove(taker)
+
+        return readers, taker